@@ -83,27 +83,36 @@ export async function generateMagazine({
     console.log('[Flask] Titre:', titre.substring(0, 50));
     console.log('[Flask] Images:', imageUrls.length);
 
-    // Appel Flask
+    // Appel Flask : le rendu est mis en file d'attente (202 + job_id)
     const response = await axios.post(
       `${FLASK_API_URL}/api/create-layout-urls`,
       params.toString(),
       {
         headers,
-        timeout: 300000 // 5 minutes
+        timeout: 30000
       }
     );
 
     console.log('[Flask] Response:', response.data);
 
-    if (response.data.success) {
+    if (!response.data.success) {
+      throw new Error(response.data.error || 'Flask generation failed');
+    }
+
+    // Attendre la fin du job
+    const job = await waitForJob(response.data.job_id, headers);
+
+    if (job.state === 'done') {
       return {
         success: true,
-        projectId: response.data.project_id,
-        outputFile: response.data.output_file,
-        downloadUrl: `${FLASK_API_URL}/api/download/${response.data.project_id}`
+        projectId: job.project_id,
+        outputFile: job.output_file,
+        downloadUrl: `${FLASK_API_URL}/api/download/${job.project_id}`
       };
+    } else if (job.state === 'cancelled') {
+      throw new Error(`Flask job ${job.job_id} cancelled${job.error ? `: ${job.error}` : ''}`);
     } else {
-      throw new Error(response.data.error || 'Flask generation failed');
+      throw new Error(job.error || 'Flask generation failed');
     }
 
   } catch (error) {
@@ -120,6 +129,34 @@ export async function generateMagazine({
   }
 }
 
+// États terminaux d'un job Flask (DELETE /api/jobs/<id> donne 'cancelled')
+const FINISHED_JOB_STATES = ['done', 'failed', 'cancelled'];
+
+/**
+ * Interroge /api/jobs/<id> jusqu'à ce que le job soit terminé
+ * @param {string} jobId - ID du job retourné par Flask
+ * @param {Object} headers - Headers (Authorization)
+ * @returns {Promise<Object>} Statut final du job (done, failed ou cancelled)
+ */
+async function waitForJob(jobId, headers, { timeoutMs = 300000, intervalMs = 2000 } = {}) {
+  const deadline = Date.now() + timeoutMs;
+
+  while (Date.now() < deadline) {
+    const { data: job } = await axios.get(`${FLASK_API_URL}/api/jobs/${jobId}`, {
+      headers: headers['Authorization'] ? { Authorization: headers['Authorization'] } : {},
+      timeout: 10000
+    });
+
+    if (FINISHED_JOB_STATES.includes(job.state)) {
+      return job;
+    }
+
+    await new Promise(resolve => setTimeout(resolve, intervalMs));
+  }
+
+  throw new Error(`Flask job ${jobId} timed out`);
+}
+
 /**
  * Vérifie le statut de l'API Flask
  * @returns {Promise<boolean>} true si l'API est accessible
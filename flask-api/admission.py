@@ -0,0 +1,95 @@
+"""
+Contrôle d'admission devant les endpoints de création et d'analyse.
+
+Quand les demandes arrivent plus vite qu'InDesign ne les traite, la file
+s'allonge sans limite et les rendus finissent par dépasser ce que le client
+peut attendre. Avant d'accepter une demande, on estime l'attente de son job :
+jobs en file (les `batch` ne comptent pas pour une demande `interactive`,
+qui passe devant) et en cours, multipliés par la durée moyenne (EWMA) de
+leur type, répartis sur la capacité des workers actifs (par instance de
+rendu, le plus petit de leurs threads de jobs et des rendus simultanés que
+l'instance accepte). Les analyses synchrones passent elles aussi par la file
+des jobs et sont donc dans cette charge. Au-delà du budget,
+la demande est refusée (`429`) avec un `Retry-After` égal au temps qu'il
+faut pour que l'attente repasse sous le budget.
+
+La charge est relue dans la base des jobs au plus une fois par
+`refresh_seconds` et par worker : /api/load et les vérifications restent
+bon marché.
+"""
+import math
+import threading
+import time
+
+from jobs import PRIORITY_BATCH, PRIORITY_INTERACTIVE, estimate_wait
+
+
+class AdmissionController:
+    """Décide d'accepter une demande selon l'attente estimée et le budget de sa priorité."""
+
+    def __init__(self, job_manager, max_wait_seconds=240, batch_max_wait_seconds=1800,
+                 default_run_seconds=60, refresh_seconds=1.0):
+        self.job_manager = job_manager
+        self.budgets = {
+            PRIORITY_INTERACTIVE: max_wait_seconds,
+            PRIORITY_BATCH: batch_max_wait_seconds
+        }
+        # Durée supposée d'un job tant qu'aucun n'a terminé (démarrage à froid)
+        self.default_run_seconds = default_run_seconds
+        self.refresh_seconds = refresh_seconds
+        self._lock = threading.Lock()
+        self._load = None
+        self._loaded_at = 0.0
+        # Demandes admises depuis la dernière lecture : (priorité, type) -> nombre
+        self._admitted = {}
+
+    def _refresh(self):
+        with self._lock:
+            if self._load and time.monotonic() - self._loaded_at < self.refresh_seconds:
+                return
+        load = self.job_manager.load()
+        with self._lock:
+            self._load, self._loaded_at, self._admitted = load, time.monotonic(), {}
+
+    def _wait(self, priority):
+        """Attente estimée d'une nouvelle demande de `priority` (sous self._lock)."""
+        pending = dict(self._admitted)
+        for queued_priority, kinds in self._load['queued'].items():
+            for kind, count in kinds.items():
+                pending[(queued_priority, kind)] = pending.get((queued_priority, kind), 0) + count
+        # Une demande interactive passe devant les jobs batch en file
+        counts = {}
+        for (queued_priority, kind), count in pending.items():
+            if priority == PRIORITY_BATCH or queued_priority == PRIORITY_INTERACTIVE:
+                counts[kind] = counts.get(kind, 0) + count
+        return estimate_wait(counts, self._load['running'], self._load['capacity'],
+                             self._load['run_seconds'], self.default_run_seconds)
+
+    def snapshot(self):
+        """Charge courante et attente estimée par priorité."""
+        self._refresh()
+        with self._lock:
+            waits = {priority: self._wait(priority) for priority in self.budgets}
+            load = self._load
+        return {
+            'queued': {priority: sum(kinds.values()) for priority, kinds in load['queued'].items()},
+            'running': sum(load['running'].values()),
+            'capacity': load['capacity'],
+            'run_seconds': {kind: round(value, 3) for kind, value in load['run_seconds'].items()},
+            'estimated_wait_seconds': waits,
+            'max_wait_seconds': dict(self.budgets),
+            'accepting': {priority: waits[priority] is None or waits[priority] <= budget
+                          for priority, budget in self.budgets.items()}
+        }
+
+    def check(self, kind, priority=PRIORITY_INTERACTIVE):
+        """None si une demande (job de type `kind`) est admise, sinon le
+        Retry-After en secondes entières."""
+        self._refresh()
+        budget = self.budgets[priority]
+        with self._lock:
+            wait = self._wait(priority)
+            if wait is None or wait <= budget:
+                self._admitted[(priority, kind)] = self._admitted.get((priority, kind), 0) + 1
+                return None
+        return max(1, math.ceil(wait - budget))
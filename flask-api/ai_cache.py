@@ -0,0 +1,164 @@
+"""
+Cache des instructions de mise en page générées par OpenAI.
+
+La clé est un hash normalisé de (prompt, text_content[:300], nombre d'images,
+modèle, version du prompt système) : une régénération ou un retry identique
+ne refait pas l'aller-retour OpenAI. Les entrées expirent après un TTL et
+les moins récemment utilisées sont évincées au-delà de max_entries.
+
+Deux backends : mémoire (par worker) ou SQLite (partagé entre workers et
+conservé au redémarrage).
+"""
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+
+def _normalize(text):
+    return ' '.join((text or '').split())
+
+
+def layout_cache_key(prompt, text_content, image_count, model, system_prompt_version):
+    payload = json.dumps([
+        _normalize(prompt),
+        _normalize((text_content or '')[:300]),
+        int(image_count),
+        model,
+        system_prompt_version
+    ], ensure_ascii=False)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+class MemoryLayoutCache:
+    """Cache LRU + TTL en mémoire du processus."""
+
+    backend = 'memory'
+
+    def __init__(self, ttl=86400, max_entries=1000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and entry[0] > time.time():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return json.loads(entry[1])
+            if entry:
+                del self._entries[key]
+            self.misses += 1
+            return None
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (time.time() + self.ttl, json.dumps(value, ensure_ascii=False))
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'backend': self.backend,
+                'entries': len(self._entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_ratio': round(self.hits / lookups, 3) if lookups else None
+            }
+
+
+class SqliteLayoutCache(MemoryLayoutCache):
+    """Même contrat, stocké dans SQLite : survit aux redémarrages."""
+
+    backend = 'sqlite'
+
+    def __init__(self, path, ttl=86400, max_entries=1000):
+        super().__init__(ttl=ttl, max_entries=max_entries)
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.path = path
+        with self._connect() as db:
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('''
+                CREATE TABLE IF NOT EXISTS layout_cache (
+                    key TEXT PRIMARY KEY,
+                    value TEXT NOT NULL,
+                    expires_at REAL NOT NULL,
+                    last_access REAL NOT NULL
+                )
+            ''')
+
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def get(self, key):
+        now = time.time()
+        with self._connect() as db:
+            row = db.execute('SELECT value, expires_at FROM layout_cache WHERE key = ?', (key,)).fetchone()
+            if row and row[1] > now:
+                db.execute('UPDATE layout_cache SET last_access = ? WHERE key = ?', (now, key))
+            elif row:
+                db.execute('DELETE FROM layout_cache WHERE key = ?', (key,))
+                row = None
+        with self._lock:
+            if row:
+                self.hits += 1
+            else:
+                self.misses += 1
+        return json.loads(row[0]) if row else None
+
+    def set(self, key, value):
+        now = time.time()
+        with self._connect() as db:
+            db.execute(
+                'INSERT OR REPLACE INTO layout_cache(key, value, expires_at, last_access) VALUES (?, ?, ?, ?)',
+                (key, json.dumps(value, ensure_ascii=False), now + self.ttl, now)
+            )
+            db.execute('DELETE FROM layout_cache WHERE expires_at <= ?', (now,))
+            evicted = db.execute(
+                'DELETE FROM layout_cache WHERE key IN ('
+                'SELECT key FROM layout_cache ORDER BY last_access DESC LIMIT -1 OFFSET ?)',
+                (self.max_entries,)
+            ).rowcount
+        with self._lock:
+            self.evictions += max(evicted, 0)
+
+    def stats(self):
+        stats = super().stats()
+        with self._connect() as db:
+            stats['entries'] = db.execute('SELECT COUNT(*) FROM layout_cache').fetchone()[0]
+        return stats
+
+
+def create_layout_cache_from_env():
+    """AI_CACHE_BACKEND = memory (défaut) | sqlite | off."""
+    backend = os.getenv('AI_CACHE_BACKEND', 'memory')
+    ttl = float(os.getenv('AI_CACHE_TTL', '86400'))
+    max_entries = int(os.getenv('AI_CACHE_MAX_ENTRIES', '1000'))
+    if backend == 'off':
+        return None
+    if backend == 'sqlite':
+        path = os.getenv('AI_CACHE_PATH', os.path.join('cache', 'ai_layouts.db'))
+        return SqliteLayoutCache(path, ttl=ttl, max_entries=max_entries)
+    if backend == 'memory':
+        return MemoryLayoutCache(ttl=ttl, max_entries=max_entries)
+    raise ValueError(f'AI_CACHE_BACKEND inconnu: {backend}')
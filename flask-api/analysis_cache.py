@@ -0,0 +1,125 @@
+"""
+Cache des analyses de templates InDesign.
+
+La clé est le SHA-256 du fichier template plus les dimensions de la
+miniature : ré-analyser des octets déjà vus ne coûte qu'un hash, pas une
+session InDesign. Le cache conserve les métadonnées `template` et la
+miniature produite ; une entrée dont la miniature a disparu est ignorée.
+
+Stockage SQLite (mode WAL), partagé entre les workers gunicorn.
+"""
+import json
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+
+class TemplateAnalysisCache:
+    """Résultats d'analyse indexés par (sha256 du template, largeur, hauteur)."""
+
+    def __init__(self, path):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.path = path
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        with self._connect() as db:
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('''
+                CREATE TABLE IF NOT EXISTS template_analyses (
+                    template_sha256 TEXT NOT NULL,
+                    thumbnail_width INTEGER NOT NULL,
+                    thumbnail_height INTEGER NOT NULL,
+                    results TEXT NOT NULL,
+                    created_at REAL NOT NULL,
+                    last_access REAL NOT NULL,
+                    PRIMARY KEY (template_sha256, thumbnail_width, thumbnail_height)
+                )
+            ''')
+
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def _count(self, hit):
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def get(self, template_sha256, thumbnail_width, thumbnail_height):
+        """Résultats en cache (dict au format de results.json) ou None."""
+        key = (template_sha256, int(thumbnail_width), int(thumbnail_height))
+        with self._connect() as db:
+            row = db.execute(
+                'SELECT results FROM template_analyses WHERE template_sha256 = ? '
+                'AND thumbnail_width = ? AND thumbnail_height = ?', key
+            ).fetchone()
+            if row:
+                db.execute(
+                    'UPDATE template_analyses SET last_access = ? WHERE template_sha256 = ? '
+                    'AND thumbnail_width = ? AND thumbnail_height = ?', (time.time(), *key)
+                )
+        results = json.loads(row[0]) if row else None
+        thumbnail_path = ((results or {}).get('thumbnail') or {}).get('path')
+        if results and thumbnail_path and not os.path.exists(thumbnail_path):
+            # Miniature supprimée : l'analyse doit être refaite
+            results = None
+        self._count(results is not None)
+        return results
+
+    def set(self, template_sha256, thumbnail_width, thumbnail_height, results):
+        now = time.time()
+        with self._connect() as db:
+            db.execute(
+                'INSERT OR REPLACE INTO template_analyses(template_sha256, thumbnail_width, '
+                'thumbnail_height, results, created_at, last_access) VALUES (?, ?, ?, ?, ?, ?)',
+                (template_sha256, int(thumbnail_width), int(thumbnail_height),
+                 json.dumps(results, ensure_ascii=False), now, now)
+            )
+
+    def latest_by_template(self):
+        """{sha256: résultats} avec l'analyse la plus récente de chaque template,
+        toutes dimensions de miniature confondues (pour le catalogue)."""
+        with self._connect() as db:
+            rows = db.execute(
+                'SELECT template_sha256, results FROM template_analyses ORDER BY created_at ASC'
+            ).fetchall()
+        return {sha256: json.loads(results) for sha256, results in rows}
+
+    def generation(self):
+        """Marqueur qui change à chaque ajout ou invalidation d'entrée."""
+        with self._connect() as db:
+            return tuple(db.execute(
+                'SELECT COUNT(*), COALESCE(MAX(created_at), 0) FROM template_analyses'
+            ).fetchone())
+
+    def invalidate(self, template_sha256=None):
+        """Supprime les entrées d'un template (toutes si sha256 est None).
+        Retourne le nombre d'entrées supprimées."""
+        with self._connect() as db:
+            if template_sha256:
+                cursor = db.execute('DELETE FROM template_analyses WHERE template_sha256 = ?', (template_sha256,))
+            else:
+                cursor = db.execute('DELETE FROM template_analyses')
+            return cursor.rowcount
+
+    def stats(self):
+        with self._connect() as db:
+            entries = db.execute('SELECT COUNT(*) FROM template_analyses').fetchone()[0]
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': entries,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': round(self.hits / lookups, 3) if lookups else None
+            }
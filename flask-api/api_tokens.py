@@ -0,0 +1,113 @@
+"""
+Tokens d'API nommés : poids d'ordonnancement et quotas de rendu par client.
+
+API_TOKENS liste les clients, séparés par des virgules, au format
+`nom:token[:poids[:max_concurrents[:par_minute[:priorité]]]]` :
+
+    API_TOKENS=web:s3cr3t:4:2:30,bulk:t0k3n:1:1:10:batch
+
+- `poids` (1 par défaut) : part de la capacité de rendu obtenue quand
+  plusieurs clients ont des jobs en file (weighted fair queuing) ;
+- `max_concurrents` : jobs exécutés en même temps pour ce client ;
+- `par_minute` : débit de démarrage (token bucket, rafale de `par_minute`) ;
+- `priorité` (`interactive` par défaut) : classe la plus haute que le client
+  peut obtenir, et classe de ses demandes sans header X-Job-Priority ; une
+  demande plus prioritaire est rétrogradée à cette classe.
+
+Un quota vide ou à 0 est illimité. L'ancien API_TOKEN reste accepté comme
+client `default` (poids 1, sans quota).
+"""
+import hmac
+
+from jobs import PRIORITIES, PRIORITY_INTERACTIVE
+
+DEFAULT_CLIENT = 'default'
+
+
+class ApiClient:
+    """Client identifié par son token Bearer."""
+
+    def __init__(self, name, token, weight=1.0, max_concurrent=None, per_minute=None,
+                 max_priority=PRIORITY_INTERACTIVE):
+        if weight <= 0:
+            raise ValueError(f'Poids invalide pour {name}: {weight}')
+        if max_priority not in PRIORITIES:
+            raise ValueError(f'Priorité invalide pour {name}: {max_priority}')
+        self.name = name
+        self.token = token
+        self.weight = weight
+        self.max_concurrent = max_concurrent or None
+        self.per_minute = per_minute or None
+        self.max_priority = max_priority
+
+    def allowed_priority(self, priority):
+        """`priority`, rétrogradée à la classe du client si elle est plus haute."""
+        if PRIORITIES.index(priority) < PRIORITIES.index(self.max_priority):
+            return self.max_priority
+        return priority
+
+    def to_dict(self):
+        return {
+            'name': self.name,
+            'weight': self.weight,
+            'max_concurrent': self.max_concurrent,
+            'per_minute': self.per_minute,
+            'max_priority': self.max_priority
+        }
+
+
+def _number(value, cast):
+    value = value.strip()
+    return cast(value) if value else None
+
+
+def parse_api_tokens(spec):
+    """Clients décrits par API_TOKENS (voir le docstring du module)."""
+    clients = []
+    for entry in (spec or '').split(','):
+        entry = entry.strip()
+        if not entry:
+            continue
+        parts = entry.split(':')
+        if len(parts) < 2 or len(parts) > 6 or not parts[0] or not parts[1]:
+            raise ValueError(f'Entrée API_TOKENS invalide: {parts[0] or entry}')
+        parts += [''] * (6 - len(parts))
+        clients.append(ApiClient(
+            parts[0].strip(),
+            parts[1].strip(),
+            weight=_number(parts[2], float) or 1.0,
+            max_concurrent=_number(parts[3], int),
+            per_minute=_number(parts[4], float),
+            max_priority=parts[5].strip().lower() or PRIORITY_INTERACTIVE
+        ))
+    return clients
+
+
+class ApiTokenRegistry:
+    """Clients connus, indexés par nom ; vide = API ouverte."""
+
+    def __init__(self, clients=()):
+        self.clients = {}
+        for client in clients:
+            if client.name in self.clients:
+                raise ValueError(f'Client API en double: {client.name}')
+            self.clients[client.name] = client
+
+    @classmethod
+    def from_env(cls, api_tokens=None, api_token=None):
+        clients = parse_api_tokens(api_tokens)
+        if api_token and all(client.name != DEFAULT_CLIENT for client in clients):
+            clients.append(ApiClient(DEFAULT_CLIENT, api_token))
+        return cls(clients)
+
+    @property
+    def enabled(self):
+        return bool(self.clients)
+
+    def authenticate(self, token):
+        """Client dont le token correspond (comparaison à temps constant), sinon None."""
+        found = None
+        for client in self.clients.values():
+            if hmac.compare_digest(client.token.encode('utf-8'), token.encode('utf-8')):
+                found = client
+        return found
@@ -1,21 +1,72 @@
-from flask import Flask, request, jsonify, render_template, send_file
+from flask import Flask, Request, request, g, jsonify, render_template, send_file, Response, stream_with_context
 from werkzeug.utils import secure_filename
 import os
 import json
-import subprocess
+import copy
+import hashlib
 import uuid
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from contextlib import contextmanager
 from datetime import datetime
-import openai
-from PIL import Image
 import shutil
 from dotenv import load_dotenv
-import requests
-import io
+import contextvars
+import threading
+from jobs import (JobManager, JobStore, JOB_STATES, JOB_QUEUED, JOB_DONE, JOB_FAILED, JOB_CANCELLED,
+                  FINISHED_STATES, PRIORITIES, PRIORITY_INTERACTIVE, PRIORITY_BATCH)
+from cancellation import CANCEL_REQUESTED, JobCancelled, current_scope
+from api_tokens import ApiTokenRegistry
+from admission import AdmissionController
+from renderers import create_renderer_pool_from_env
+from downloader import ImageDownloader
+from image_cache import ImageCache, link_or_copy, file_sha256
+from ai_cache import create_layout_cache_from_env, layout_cache_key
+from render_cache import RenderCache
+from idempotency import LayoutRequestRegistry, IdempotencyConflict, layout_request_fingerprint
+from analysis_cache import TemplateAnalysisCache
+from template_store import TemplateStore
+from template_catalog import TemplateCatalog, filter_templates
+from thumbnails import ThumbnailVariants, THUMBNAIL_SIZES, THUMBNAIL_FORMATS
+from image_prep import ImagePreprocessor
+from metrics import Metrics
+from logs import configure_logging, get_logger, request_id_var, job_id_var, tenant_var
 
 # Charger les variables d'environnement
 load_dotenv()
 
+# Préparation des images avant InDesign (orientation, mode couleur, résolution utile).
+# Le pool de processus est forké ici, avant tout thread (logs, jobs, sessions InDesign)
+image_preprocessor = None
+if os.getenv('IMAGE_PREP_ENABLED', '1') == '1':
+    image_preprocessor = ImagePreprocessor(
+        max_workers=int(os.getenv('IMAGE_PREP_WORKERS', str(os.cpu_count() or 2))),
+        target_ppi=int(os.getenv('IMAGE_PREP_TARGET_PPI', '300')),
+        default_max_edge=int(os.getenv('IMAGE_PREP_MAX_EDGE', '3508')),
+        keep_originals=os.getenv('IMAGE_PREP_KEEP_ORIGINALS', '1') == '1',
+        start_method=os.getenv('IMAGE_PREP_START_METHOD', 'fork')
+    )
+    image_preprocessor.start()
+
+# Logs JSON via une file + thread d'écriture (LOG_LEVEL, LOG_FORMAT)
+configure_logging()
+logger = get_logger('app')
+
+TEMPLATE_EXTENSIONS = ('.indt', '.indd')
+
+
+class MagflowRequest(Request):
+    """Les templates uploadés sont écrits (et hachés) directement dans le
+    stockage des templates au lieu d'un fichier temporaire générique."""
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        if filename and os.path.splitext(filename)[1].lower() in TEMPLATE_EXTENSIONS:
+            return template_store.new_upload()
+        return super()._get_file_stream(total_content_length, content_type, filename, content_length)
+
+
 app = Flask(__name__)
+app.request_class = MagflowRequest
 app.config['MAX_CONTENT_LENGTH'] = 50 * 1024 * 1024  # 50MB max file size
 app.config['UPLOAD_FOLDER'] = 'uploads'
 app.config['TEMPLATES_FOLDER'] = 'indesign_templates'
@@ -27,24 +78,184 @@ for folder in [app.config['UPLOAD_FOLDER'], app.config['TEMPLATES_FOLDER'], app.
 
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'tiff', 'psd'}
 
+
+# Histogrammes et compteurs /metrics, agrégés entre workers (METRICS_ENABLED=0 pour désactiver)
+metrics = Metrics(
+    os.getenv('METRICS_PATH', os.path.join('cache', 'metrics.db'))
+    if os.getenv('METRICS_ENABLED', '1') == '1' else None
+)
+
+# Clients d'API (API_TOKENS, ou l'ancien API_TOKEN) : poids et quotas de rendu
+api_tokens = ApiTokenRegistry.from_env(os.getenv('API_TOKENS'), os.getenv('API_TOKEN'))
+
+# Sessions InDesign longue durée partagées par les rendus et les analyses
+renderer_pool = create_renderer_pool_from_env()
+renderer_pool.start()
+
+# Jobs durables (SQLite partagé entre workers gunicorn) exécutés par un pool de
+# threads, en file équitable entre clients : les requêtes HTTP ne bloquent plus sur InDesign.
+# Le heartbeat publie l'instance de rendu et ses emplacements : la capacité vue par
+# l'admission est min(threads de jobs, rendus simultanés possibles) par instance
+job_manager = JobManager(
+    JobStore(os.getenv('JOB_STORE_PATH', os.path.join('cache', 'jobs.db'))),
+    max_workers=int(os.getenv('JOB_WORKERS', '2')),
+    metrics=metrics,
+    lease_seconds=float(os.getenv('JOB_LEASE_SECONDS', '60')),
+    max_attempts=int(os.getenv('JOB_MAX_ATTEMPTS', '3')),
+    poll_interval=float(os.getenv('JOB_POLL_SECONDS', '0.5')),
+    tenants=api_tokens.clients,
+    renderer=renderer_pool.instance,
+    render_slots=renderer_pool.slots
+)
+job_manager.start()
+
+# Contrôle d'admission : 429 + Retry-After quand l'attente estimée dépasse le budget
+admission = None
+if os.getenv('ADMISSION_ENABLED', '1') == '1':
+    admission = AdmissionController(
+        job_manager,
+        max_wait_seconds=float(os.getenv('ADMISSION_MAX_WAIT_SECONDS', '240')),
+        batch_max_wait_seconds=float(os.getenv('ADMISSION_BATCH_MAX_WAIT_SECONDS', '1800')),
+        default_run_seconds=float(os.getenv('ADMISSION_DEFAULT_RUN_SECONDS', '60')),
+        refresh_seconds=float(os.getenv('ADMISSION_REFRESH_SECONDS', '1'))
+    )
+
+# Échéance maximale acceptée dans X-Deadline-Seconds
+MAX_DEADLINE_SECONDS = float(os.getenv('MAX_DEADLINE_SECONDS', '3600'))
+
+# Cache disque des images, partagé entre projets (désactivable avec IMAGE_CACHE_ENABLED=0)
+image_cache = None
+if os.getenv('IMAGE_CACHE_ENABLED', '1') == '1':
+    image_cache = ImageCache(
+        os.getenv('IMAGE_CACHE_DIR', os.path.join('cache', 'images')),
+        max_bytes=int(os.getenv('IMAGE_CACHE_MAX_MB', '2048')) * 1024 * 1024
+    )
+
+# Appels OpenAI lancés en parallèle de la récupération des images
+ai_executor = ThreadPoolExecutor(max_workers=int(os.getenv('AI_WORKERS', '4')), thread_name_prefix='magflow-ai')
+
+# Cache des instructions de mise en page OpenAI (AI_CACHE_BACKEND=memory|sqlite|off)
+layout_cache = create_layout_cache_from_env()
+
+# Cache des rendus .indd par configuration exacte (RENDER_CACHE_ENABLED=0 pour désactiver)
+render_cache = None
+if os.getenv('RENDER_CACHE_ENABLED', '1') == '1':
+    render_cache = RenderCache(
+        os.getenv('RENDER_CACHE_DIR', os.path.join('cache', 'renders')),
+        max_bytes=int(os.getenv('RENDER_CACHE_MAX_MB', '2048')) * 1024 * 1024
+    )
+
+# Demandes de mise en page dédupliquées (Idempotency-Key + coalescence des demandes identiques)
+layout_requests = None
+if os.getenv('IDEMPOTENCY_ENABLED', '1') == '1':
+    layout_requests = LayoutRequestRegistry(
+        os.getenv('IDEMPOTENCY_PATH', os.path.join('cache', 'layout_requests.db')),
+        window=float(os.getenv('IDEMPOTENCY_WINDOW', '3600'))
+    )
+COALESCE_IDENTICAL_REQUESTS = os.getenv('COALESCE_IDENTICAL_REQUESTS', '1') == '1'
+
+# Templates adressés par contenu (.objects/) + index nom -> versions
+template_store = TemplateStore(app.config['TEMPLATES_FOLDER'])
+
+# Cache des analyses par SHA-256 du template (TEMPLATE_ANALYSIS_CACHE_ENABLED=0 pour désactiver)
+template_analysis_cache = None
+if os.getenv('TEMPLATE_ANALYSIS_CACHE_ENABLED', '1') == '1':
+    template_analysis_cache = TemplateAnalysisCache(
+        os.getenv('TEMPLATE_ANALYSIS_CACHE_PATH', os.path.join('cache', 'template_analyses.db'))
+    )
+
+# Variantes des miniatures (small/medium, JPEG/WebP) nommées par contenu
+thumbnail_variants = ThumbnailVariants(os.path.join(os.getcwd(), 'thumbnails'))
+
+# Catalogue /api/templates servi depuis la mémoire
+template_catalog = TemplateCatalog(
+    app.config['TEMPLATES_FOLDER'],
+    TEMPLATE_EXTENSIONS,
+    analysis_cache=template_analysis_cache,
+    store=template_store,
+    refresh_interval=float(os.getenv('TEMPLATE_CATALOG_REFRESH', '2'))
+)
+
+# Téléchargeur d'images partagé (session HTTP poolée, N téléchargements en parallèle)
+image_downloader = ImageDownloader(
+    ALLOWED_EXTENSIONS,
+    max_workers=int(os.getenv('DOWNLOAD_WORKERS', '8')),
+    per_host=int(os.getenv('DOWNLOAD_PER_HOST', '4')),
+    timeout=float(os.getenv('DOWNLOAD_TIMEOUT', '20')),
+    retries=int(os.getenv('DOWNLOAD_RETRIES', '2')),
+    deadline=float(os.getenv('DOWNLOAD_DEADLINE', '60')),
+    max_bytes=int(os.getenv('DOWNLOAD_MAX_MB', '100')) * 1024 * 1024,
+    cache=image_cache
+)
+
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
 def _require_bearer_or_401():
-    """Vérifie le header Authorization: Bearer <token> si API_TOKEN est défini.
+    """Vérifie le header Authorization: Bearer <token> si API_TOKENS / API_TOKEN
+    est défini, et retient le client identifié (g.api_client, tenant des jobs soumis).
     Retourne (None, None) si OK, sinon (json_response, status_code)."""
-    api_token = os.getenv('API_TOKEN')
-    if not api_token:
+    if not api_tokens.enabled:
         # Aucun token requis si non configuré
         return None, None
     auth_header = request.headers.get('Authorization', '')
     if not auth_header.startswith('Bearer '):
         return jsonify({'error': 'Unauthorized'}), 401
     provided = auth_header.replace('Bearer ', '', 1).strip()
-    if provided != api_token:
+    client = api_tokens.authenticate(provided)
+    if not client:
         return jsonify({'error': 'Forbidden'}), 403
+    g.api_client = client
+    tenant_var.set(client.name)
     return None, None
 
+def _requested_priority(default=PRIORITY_INTERACTIVE):
+    """Classe de priorité demandée par le header X-Job-Priority (interactive | batch),
+    bornée par celle du client (API_TOKENS) : une classe plus haute est rétrogradée.
+    Retourne (priorité, None) ou (None, réponse d'erreur)."""
+    priority = request.headers.get('X-Job-Priority', default).strip().lower()
+    if priority not in PRIORITIES:
+        return None, (jsonify({'error': f'Priorité inconnue: {priority}'}), 400)
+    client = g.get('api_client')
+    if client:
+        allowed = client.allowed_priority(priority)
+        if allowed != priority and 'X-Job-Priority' in request.headers:
+            logger.info('Priorité %s rétrogradée en %s pour le client %s', priority, allowed, client.name)
+        priority = allowed
+    return priority, None
+
+def _request_deadline():
+    """Échéance demandée par le header X-Deadline-Seconds (budget total en
+    secondes, file d'attente comprise). Retourne (timestamp ou None, None) ou
+    (None, réponse d'erreur)."""
+    value = request.headers.get('X-Deadline-Seconds')
+    if not value:
+        return None, None
+    try:
+        seconds = float(value)
+    except ValueError:
+        seconds = 0
+    if not 0 < seconds <= MAX_DEADLINE_SECONDS:
+        return None, (jsonify({'error': f'X-Deadline-Seconds invalide: {value}'}), 400)
+    return time.time() + seconds, None
+
+def _admission_rejection(kind, priority=PRIORITY_INTERACTIVE, project_id=None):
+    """Réponse 429 (avec Retry-After) si l'attente estimée dépasse le budget de
+    `priority`, sinon None. Libère la demande réservée pour `project_id`."""
+    if not admission:
+        return None
+    retry_after = admission.check(kind, priority)
+    if retry_after is None:
+        return None
+    if project_id and layout_requests:
+        layout_requests.finish(project_id, False)
+    metrics.inc('admission_rejections_total', kind=kind, priority=priority)
+    logger.warning('Demande refusée, capacité saturée (Retry-After %ss)', retry_after,
+                   extra={'kind': kind, 'priority': priority})
+    response = jsonify({'error': 'Capacité de rendu saturée, réessayer plus tard', 'retry_after': retry_after})
+    response.headers['Retry-After'] = str(retry_after)
+    return response, 429
+
 def _parse_image_urls_from_request(req: request):
     """Supporte JSON { image_urls: [...] }, form-data image_urls (répétés) ou string CSV."""
     urls = []
@@ -63,53 +274,14 @@ def _parse_image_urls_from_request(req: request):
     return list(dict.fromkeys(urls))  # unique, conserve l'ordre
 
 def _download_images(urls, dest_folder):
-    """Télécharge les images dans dest_folder. Retourne la liste des chemins locaux."""
-    downloaded = []
-    os.makedirs(dest_folder, exist_ok=True)
-    for i, url in enumerate(urls):
-        try:
-            r = requests.get(url, stream=True, timeout=20)
-            r.raise_for_status()
-            # Déterminer l'extension
-            ext = None
-            ct = r.headers.get('Content-Type', '').lower()
-            mapping = {
-                'image/jpeg': 'jpg',
-                'image/jpg': 'jpg',
-                'image/png': 'png',
-                'image/gif': 'gif',
-                'image/tiff': 'tiff',
-                'image/x-tiff': 'tiff',
-                'image/vnd.adobe.photoshop': 'psd'
-            }
-            if ct in mapping:
-                ext = mapping[ct]
-            # fallback depuis l'URL
-            if not ext:
-                from urllib.parse import urlparse
-                path = urlparse(url).path
-                if '.' in path:
-                    ext = path.rsplit('.', 1)[1].lower()
-            # Valider extension
-            if not ext or ext not in ALLOWED_EXTENSIONS:
-                # essayer d'ouvrir avec PIL pour valider image
-                content = r.content
-                try:
-                    img = Image.open(io.BytesIO(content))  # type: ignore
-                    fmt = (img.format or '').lower()
-                    ext = 'jpg' if fmt == 'jpeg' else fmt
-                except Exception:
-                    raise ValueError(f"Type de fichier non supporté pour {url}")
-            filename = f"image_{i+1}.{ext}"
-            filepath = os.path.join(dest_folder, filename)
-            with open(filepath, 'wb') as f:
-                for chunk in r.iter_content(chunk_size=8192):
-                    if chunk:
-                        f.write(chunk)
-            downloaded.append(filepath)
-        except Exception as e:
-            print(f"Téléchargement échoué pour {url}: {e}")
-    return downloaded
+    """Télécharge les images dans dest_folder (en parallèle), dans le budget
+    restant du job courant. Retourne (chemins locaux dans l'ordre de urls, rapports par image)."""
+    reports = image_downloader.download(urls, dest_folder, deadline=current_scope().budget())
+    for report in reports:
+        if not report['ok']:
+            logger.warning('Téléchargement échoué pour %s: %s', report['url'], report['error'],
+                           extra={'attempts': report.get('attempts')})
+    return [r['path'] for r in reports if r['ok']], reports
 
 @app.route('/')
 def index():
@@ -131,61 +303,53 @@ def create_layout():
         
         if not prompt:
             return jsonify({'error': 'Le prompt est requis'}), 400
+        priority, error = _requested_priority()
+        if error:
+            return error
+        deadline_at, error = _request_deadline()
+        if error:
+            return error
         
         # Créer un ID unique pour ce projet
         project_id = str(uuid.uuid4())
-        project_folder = os.path.join(app.config['UPLOAD_FOLDER'], project_id)
-        os.makedirs(project_folder, exist_ok=True)
-        
-        # Sauvegarder les images uploadées
-        uploaded_images = []
-        if 'images' in request.files:
-            files = request.files.getlist('images')
-            for file in files:
-                if file and file.filename and allowed_file(file.filename):
+        files = [f for f in request.files.getlist('images') if f and f.filename and allowed_file(f.filename)]
+
+        # Même demande (contenu des images compris) déjà en cours ou rendue : on s'y rattache
+        attached = _attach_to_existing_layout(project_id, layout_request_fingerprint(
+            prompt, text_content, subtitle, template_name,
+            image_hashes=[_upload_sha256(f) for f in files], rectangle_index=rectangle_index,
+            tenant=tenant_var.get()
+        ))
+        if attached:
+            return attached
+        with _releasing_layout_request(project_id):
+            rejected = _admission_rejection('layout', priority, project_id=project_id)
+            if rejected:
+                return rejected
+
+            project_folder = os.path.join(app.config['UPLOAD_FOLDER'], project_id)
+            os.makedirs(project_folder, exist_ok=True)
+            
+            # Sauvegarder les images uploadées (le flux n'est lisible que pendant la requête)
+            uploaded_images = []
+            with metrics.stage('upload_save') as upload_stage:
+                for file in files:
                     filename = secure_filename(file.filename)
                     filepath = os.path.join(project_folder, filename)
                     file.save(filepath)
                     uploaded_images.append(filepath)
-        
-        # Analyser le prompt avec l'IA
-        layout_instructions = analyze_prompt_with_ai(prompt, text_content, len(uploaded_images))
-        
-        # Créer le fichier de configuration pour InDesign
-        # Convertir les chemins d'images en chemins absolus
-        absolute_images = [os.path.abspath(img) for img in uploaded_images]
-        
-        config = {
-            'project_id': project_id,
-            'prompt': prompt,
-            'text_content': text_content,
-            'subtitle': subtitle,
-            'images': absolute_images,
-            'template': template_name,
-            'rectangle_index': rectangle_index,
-            'layout_instructions': layout_instructions,
-            'created_at': datetime.now().isoformat()
-        }
-        
-        config_path = os.path.join(project_folder, 'config.json')
-        with open(config_path, 'w', encoding='utf-8') as f:
-            json.dump(config, f, ensure_ascii=False, indent=2)
-        
-        # Exécuter le script InDesign
-        result = execute_indesign_script(project_id, config_path)
-        
-        if result['success']:
-            return jsonify({
-                'success': True,
+            
+            # Le rendu part en tâche de fond
+            return _submit_layout_job({
                 'project_id': project_id,
-                'message': 'Mise en page créée avec succès',
-                'output_file': result.get('output_file')
-            })
-        else:
-            return jsonify({
-                'success': False,
-                'error': result.get('error', 'Erreur lors de la création de la mise en page')
-            }), 500
+                'prompt': prompt,
+                'text_content': text_content,
+                'subtitle': subtitle,
+                'template': template_name,
+                'rectangle_index': rectangle_index,
+                'images': uploaded_images,
+                'upload_save_seconds': round(upload_stage.duration, 3)
+            }, priority=priority, deadline_at=deadline_at)
             
     except Exception as e:
         return jsonify({'error': f'Erreur serveur: {str(e)}'}), 500
@@ -210,68 +374,422 @@ def create_layout_urls():
             return jsonify({'error': 'Le prompt est requis'}), 400
         if not image_urls:
             return jsonify({'error': 'Aucune image fournie (image_urls)'}), 400
+        priority, error = _requested_priority()
+        if error:
+            return error
+        deadline_at, error = _request_deadline()
+        if error:
+            return error
 
-        # Créer projet
+        # Créer projet (téléchargement, IA et rendu se font dans le job)
         project_id = str(uuid.uuid4())
-        project_folder = os.path.join(app.config['UPLOAD_FOLDER'], project_id)
-        os.makedirs(project_folder, exist_ok=True)
+        attached = _attach_to_existing_layout(project_id, layout_request_fingerprint(
+            prompt, text_content, subtitle, template_name, image_urls=image_urls, tenant=tenant_var.get()
+        ))
+        if attached:
+            return attached
+        with _releasing_layout_request(project_id):
+            rejected = _admission_rejection('layout', priority, project_id=project_id)
+            if rejected:
+                return rejected
+            return _submit_layout_job({
+                'project_id': project_id,
+                'prompt': prompt,
+                'text_content': text_content,
+                'subtitle': subtitle,
+                'template': template_name,
+                'image_urls': image_urls
+            }, priority=priority, deadline_at=deadline_at)
+    except Exception as e:
+        return jsonify({'error': f'Erreur serveur: {str(e)}'}), 500
+
+def _job_accepted_response(job, message='Mise en page en file d\'attente'):
+    """Réponse 202 commune aux endpoints qui soumettent un job."""
+    status_url = f'/api/jobs/{job.id}'
+    response = jsonify({
+        'success': True,
+        'job_id': job.id,
+        'project_id': job.payload.get('project_id'),
+        'state': job.state,
+        'status_url': status_url,
+        'events_url': f'{status_url}/events',
+        'message': message
+    })
+    response.headers['Location'] = status_url
+    return response, 202
+
+def _upload_sha256(file):
+    """SHA-256 d'un fichier uploadé, sans consommer son flux."""
+    digest = hashlib.sha256()
+    for chunk in iter(lambda: file.stream.read(1024 * 1024), b''):
+        digest.update(chunk)
+    file.stream.seek(0)
+    return digest.hexdigest()
+
+def _layout_job_alive(job_id):
+    """Faux si le job d'une demande réservée a échoué ou été annulé (inconnu :
+    pas encore soumis ou déjà purgé, la réservation reste valable)."""
+    job = job_manager.get(job_id)
+    return not job or job['state'] not in (JOB_FAILED, JOB_CANCELLED)
+
+def _attach_to_existing_layout(project_id, fingerprint):
+    """Réserve la demande pour `project_id`. Si un job identique est en cours
+    (ou a réussi dans la fenêtre IDEMPOTENCY_WINDOW), retourne la réponse qui
+    y renvoie ; sinon None et le job peut être soumis."""
+    if not layout_requests:
+        return None
+    idempotency_key = request.headers.get('Idempotency-Key')
+    if idempotency_key and tenant_var.get():
+        # Les clés sont propres à chaque client d'API
+        idempotency_key = f'{tenant_var.get()}:{idempotency_key}'
+    try:
+        existing = layout_requests.claim(fingerprint, project_id, idempotency_key=idempotency_key,
+                                         coalesce=COALESCE_IDENTICAL_REQUESTS, job_alive=_layout_job_alive)
+    except IdempotencyConflict:
+        return jsonify({'error': 'Idempotency-Key déjà utilisée pour une autre demande'}), 422
+    if not existing:
+        return None
+
+    job_id = existing['job_id']
+    job = job_manager.get(job_id)
+    logger.info('Demande rattachée au job %s', job_id, extra={
+        'idempotency_key': idempotency_key, 'existing_state': existing['state']
+    })
+    status_url = f'/api/jobs/{job_id}'
+    body = {
+        'success': True,
+        'job_id': job_id,
+        'project_id': job_id,
+        'state': job['state'] if job else (JOB_DONE if existing['output_file'] else JOB_QUEUED),
+        'status_url': status_url,
+        'events_url': f'{status_url}/events',
+        'coalesced': True
+    }
+    if existing['output_file']:
+        body.update(output_file=existing['output_file'], download_url=f'/api/download/{job_id}',
+                    message='Mise en page déjà générée')
+        response, status = jsonify(body), 200
+    else:
+        body['message'] = 'Mise en page identique déjà en cours'
+        response, status = jsonify(body), 202
+    response.headers['Location'] = status_url
+    response.headers['Idempotent-Replayed'] = 'true'
+    return response, status
 
-        # Télécharger les images
-        downloaded_images = _download_images(image_urls, project_folder)
-        if not downloaded_images:
-            return jsonify({'error': 'Téléchargement des images échoué'}), 400
+@contextmanager
+def _releasing_layout_request(project_id):
+    """Entre la réservation (_attach_to_existing_layout) et la soumission du
+    job : toute exception libère la demande, sinon un retry se rattacherait
+    pendant IDEMPOTENCY_WINDOW à un job qui n'existe pas."""
+    try:
+        yield
+    except Exception:
+        if layout_requests:
+            layout_requests.finish(project_id, False)
+        raise
+
+def _submit_layout_job(payload, priority=PRIORITY_INTERACTIVE, deadline_at=None):
+    """Soumet le job 'layout' réservé par _attach_to_existing_layout (réponse 202)."""
+    job = job_manager.submit('layout', payload, job_id=payload['project_id'], priority=priority,
+                             deadline_at=deadline_at)
+    return _job_accepted_response(job)
+
+def _finish_layout_request(job):
+    """Fin d'un job 'layout' (hook on_finish) : clôt la demande dédupliquée
+    (succès) ou la libère pour qu'un retry relance le rendu. Appelé aussi quand
+    le handler n'a pas tourné (annulé ou échu en file, worker perdu)."""
+    if layout_requests:
+        layout_requests.finish(job.payload['project_id'], job.state == JOB_DONE, job.output_file)
+
+def _discard_layout_files(payload):
+    """Nettoyage d'un job 'layout' annulé : uploads du projet et rendu éventuel."""
+    project_id = payload['project_id']
+    shutil.rmtree(os.path.join(app.config['UPLOAD_FOLDER'], project_id), ignore_errors=True)
+    output_file = os.path.join(app.config['OUTPUT_FOLDER'], f'{project_id}.indd')
+    if os.path.exists(output_file):
+        os.unlink(output_file)
+
+def _discard_batch_files(payload):
+    """Nettoyage d'un job 'batch' annulé : images partagées et document unique."""
+    batch_id = payload['batch_id']
+    shutil.rmtree(os.path.join(app.config['UPLOAD_FOLDER'], f'batch-{batch_id}'), ignore_errors=True)
+    _discard_layout_files({'project_id': batch_id})
+
+@contextmanager
+def _stage(timings, name, pipeline='layout'):
+    """Chronomètre une étape du pipeline : durée ajoutée à `timings` (secondes)
+    et enregistrée dans /metrics. Produit un StageTimer (`stage.fail()`)."""
+    job_id = job_id_var.get()
+    job_manager.emit(job_id, 'stage', stage=name, status='started')
+    stage = None
+    try:
+        with metrics.stage(name, pipeline=pipeline) as stage:
+            yield stage
+    finally:
+        if stage:
+            timings[name] = round(stage.duration, 3)
+            job_manager.emit(job_id, 'stage', stage=name, status=stage.outcome, seconds=timings[name])
+
+def _run_layout_job(payload):
+    """Handler du job 'layout' : images et analyse IA en parallèle, config puis rendu InDesign."""
+    project_id = payload['project_id']
+    project_folder = os.path.join(app.config['UPLOAD_FOLDER'], project_id)
+    os.makedirs(project_folder, exist_ok=True)
+    timings = {}
+    if 'upload_save_seconds' in payload:
+        timings['upload_save'] = payload['upload_save_seconds']
+    job_started = time.monotonic()
+
+    images = list(payload.get('images') or [])
+    image_urls = payload.get('image_urls') or []
+
+    # L'IA n'a besoin que du nombre d'images, connu avant tout téléchargement :
+    # elle tourne pendant que les images sont récupérées.
+    # (les jobs d'un batch arrivent avec images et instructions déjà résolues)
+    with _stage(timings, 'images_and_ai'):
+        ai_future = None
+        if 'layout_instructions' not in payload:
+            ai_future = ai_executor.submit(
+                contextvars.copy_context().run, _timed_stage, 'ai_analysis', analyze_prompt_with_ai,
+                payload['prompt'], payload['text_content'], len(image_urls) or len(images)
+            )
+        image_downloads = payload.get('image_downloads')
+        if image_urls:
+            with _stage(timings, 'image_download') as stage:
+                images, image_downloads = _download_images(image_urls, project_folder)
+                if not images:
+                    stage.fail()
+        if ai_future:
+            (layout_instructions, ai_cache_hit), timings['ai_analysis'] = _await(ai_future)
+        else:
+            layout_instructions, ai_cache_hit = payload['layout_instructions'], payload.get('ai_cache_hit', False)
 
-        # Analyser le prompt
-        layout_instructions = analyze_prompt_with_ai(prompt, text_content, len(downloaded_images))
+    if image_urls and not images:
+        return {
+            'success': False,
+            'error': 'Téléchargement des images échoué',
+            'image_downloads': image_downloads,
+            'timings': timings
+        }
 
-        # Écrire config
+    image_prep = None
+    if image_preprocessor and images:
+        with _stage(timings, 'image_prep'):
+            images, image_prep = image_preprocessor.prepare(images, _image_max_edge(payload['template']))
+
+    with _stage(timings, 'config_write'):
+        # Créer le fichier de configuration pour InDesign
         # Convertir les chemins d'images en chemins absolus
-        absolute_images = [os.path.abspath(img) for img in downloaded_images]
-        
+        absolute_images = [os.path.abspath(img) for img in images]
+
         config = {
             'project_id': project_id,
-            'prompt': prompt,
-            'text_content': text_content,
-            'subtitle': subtitle,
+            'prompt': payload['prompt'],
+            'text_content': payload['text_content'],
+            'subtitle': payload['subtitle'],
             'images': absolute_images,
-            'template': template_name,
+            'template': payload['template'],
             'layout_instructions': layout_instructions,
             'created_at': datetime.now().isoformat()
         }
+        if 'rectangle_index' in payload:
+            config['rectangle_index'] = payload['rectangle_index']
+
         config_path = os.path.join(project_folder, 'config.json')
         with open(config_path, 'w', encoding='utf-8') as f:
             json.dump(config, f, ensure_ascii=False, indent=2)
 
-        # Exécuter InDesign
+    # Exécuter le script InDesign
+    with _stage(timings, 'render') as stage:
         result = execute_indesign_script(project_id, config_path)
-        if result['success']:
-            return jsonify({
-                'success': True,
-                'project_id': project_id,
-                'message': 'Mise en page créée avec succès',
-                'output_file': result.get('output_file')
-            })
-        else:
-            return jsonify({
-                'success': False,
-                'error': result.get('error', 'Erreur lors de la création de la mise en page')
-            }), 500
-    except Exception as e:
-        return jsonify({'error': f'Erreur serveur: {str(e)}'}), 500
+        if not result['success']:
+            stage.fail(timeout=result.get('timeout'))
+    timings['total'] = round(time.monotonic() - job_started, 3)
 
-def analyze_prompt_with_ai(prompt, text_content, image_count):
-    """Analyse le prompt avec OpenAI pour générer des instructions de mise en page"""
+    if not result['success']:
+        return {
+            'success': False,
+            'error': result.get('error', 'Erreur lors de la création de la mise en page'),
+            'config_path': config_path,
+            'image_downloads': image_downloads,
+            'image_prep': image_prep,
+            'timings': timings
+        }
+    return {
+        'success': True,
+        'project_id': project_id,
+        'message': 'Mise en page créée avec succès',
+        'output_file': result.get('output_file'),
+        'config_path': config_path,
+        'image_downloads': image_downloads,
+        'image_prep': image_prep,
+        'ai_cache_hit': ai_cache_hit,
+        'render_cache_hit': result.get('render_cache_hit', False),
+        'timings': timings
+    }
+
+def _image_max_edge(template):
+    """Côté long utile (pixels) des images pour ce template : page du template
+    analysé (en points) x PPI cible, sinon IMAGE_PREP_MAX_EDGE. Aucun cadre ne
+    dépassant la page, c'est une borne sûre pour chacun d'eux."""
+    name = os.path.basename(template or '')
+    _, entries = template_catalog.snapshot()
+    for entry in entries:
+        if name in (entry['name'], entry['filename']) and entry['width'] and entry['height']:
+            return image_preprocessor.max_edge(entry['width'], entry['height'], entry.get('units'))
+    return image_preprocessor.max_edge()
+
+def _await(future):
+    """Résultat d'un future, sans attendre au-delà de l'échéance du job courant
+    ni après son annulation (JobCancelled / DeadlineExceeded)."""
+    scope = current_scope()
+    while True:
+        try:
+            return future.result(timeout=scope.budget(0.5))
+        except FutureTimeoutError:
+            continue
+
+def _timed_stage(name, fn, *args):
+    """Exécute fn(*args) comme étape `name` (/metrics) ; retourne (résultat, durée en secondes)."""
+    with metrics.stage(name) as stage:
+        result = fn(*args)
+    return result, round(stage.duration, 3)
+
+job_manager.register('layout', _run_layout_job, cleanup=_discard_layout_files,
+                     on_finish=_finish_layout_request, renders=True)
+
+def _foreign_job(job):
+    """Réponse 403 si le job appartient à un autre client que celui de la
+    requête (API_TOKENS), sinon None."""
+    client = g.get('api_client')
+    if client and job.get('tenant') not in (None, client.name):
+        return jsonify({'error': 'Job d\'un autre client'}), 403
+    return None
+
+@app.route('/api/jobs/<job_id>')
+def get_job(job_id):
+    """Statut d'un job de rendu (queued/running/done/failed) ; en file, avec sa
+    position et son attente estimée."""
+    err, status = _require_bearer_or_401()
+    if err:
+        return err, status
+    job = job_manager.get(job_id, with_queue=True)
+    if not job:
+        return jsonify({'error': 'Job non trouvé'}), 404
+    forbidden = _foreign_job(job)
+    if forbidden:
+        return forbidden
+    return jsonify(job)
+
+@app.route('/api/jobs/<job_id>', methods=['DELETE'])
+def cancel_job(job_id):
+    """Annule un job : retiré de la file s'il n'a pas démarré, sinon son rendu
+    est interrompu (processus osascript tué) par le worker qui l'exécute, qui
+    libère la session InDesign et supprime les fichiers du projet.
+    Répond 200 si le job est annulé, 202 si l'annulation est en cours.
+    Un batch, quel que soit son état, annule aussi les rendus d'articles déjà soumis."""
+    err, status = _require_bearer_or_401()
+    if err:
+        return err, status
+    job = job_manager.get(job_id)
+    if not job:
+        return jsonify({'error': 'Job non trouvé'}), 404
+    forbidden = _foreign_job(job)
+    if forbidden:
+        return forbidden
+    if job['kind'] == 'batch':
+        # Le batch d'abord (plus aucun article soumis ensuite), puis les rendus
+        # des articles qu'il a déjà soumis, y compris pendant sa distribution
+        if job['state'] not in FINISHED_STATES:
+            job = job_manager.cancel(job_id)
+        cancelled = [job_manager.cancel(child_id) for child_id in _batch_item_job_ids(job)]
+        pending = [item for item in cancelled if item and item['state'] not in FINISHED_STATES]
+        logger.info('Annulation du batch %s et de ses articles (%s)', job_id, job['state'])
+        return jsonify({
+            'success': True,
+            'job': job,
+            'items_cancelled': sum(1 for item in cancelled if item and item['state'] == JOB_CANCELLED),
+            'items_cancelling': len(pending)
+        }), 202 if pending or job['state'] not in FINISHED_STATES else 200
+    if job['state'] in (JOB_DONE, JOB_FAILED):
+        return jsonify({'error': f"Job déjà terminé ({job['state']})", 'job': job}), 409
+
+    job = job_manager.cancel(job_id)
+    logger.info('Annulation du job %s (%s)', job_id, job['state'])
+    return jsonify({'success': True, 'job': job}), 200 if job['state'] == JOB_CANCELLED else 202
+
+@app.route('/api/jobs')
+def list_jobs():
+    """Liste des jobs récents, filtrables par ?state=, ?kind= et ?tenant=.
+    Avec API_TOKENS, un client ne voit que ses propres jobs (?tenant= ignoré)."""
+    err, status = _require_bearer_or_401()
+    if err:
+        return err, status
+    state = request.args.get('state')
+    if state and state not in JOB_STATES:
+        return jsonify({'error': f'État inconnu: {state}'}), 400
+    limit = max(1, min(500, request.args.get('limit', 50, type=int)))
+    client = g.get('api_client')
+    tenant = client.name if client else request.args.get('tenant')
+    jobs = job_manager.list(state=state, kind=request.args.get('kind'), tenant=tenant, limit=limit)
+    return jsonify({'jobs': jobs, 'count': len(jobs)})
+
+SSE_MAX_SECONDS = float(os.getenv('SSE_MAX_SECONDS', '300'))
+SSE_HEARTBEAT_SECONDS = float(os.getenv('SSE_HEARTBEAT_SECONDS', '15'))
+SSE_RETRY_MS = 2000
+
+def _sse_message(event):
+    data = {k: v for k, v in event.items() if k not in ('id', 'event')}
+    return f"id: {event['id']}\nevent: {event['event']}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+def _stream_job_events(job_id, after):
+    """Générateur SSE : rejoue les événements d'id > after puis suit le job
+    jusqu'à sa fin. Au-delà de SSE_MAX_SECONDS le flux est fermé ; le client
+    se reconnecte avec Last-Event-ID et reprend où il en était."""
+    yield f'retry: {SSE_RETRY_MS}\n\n'
+    deadline = time.monotonic() + SSE_MAX_SECONDS
+    last_sent = time.monotonic()
+    while True:
+        snapshot = job_manager.events(job_id, after)
+        if snapshot is None:
+            return
+        events, finished = snapshot
+        for event in events:
+            after = event['id']
+            yield _sse_message(event)
+            last_sent = time.monotonic()
+        if finished or time.monotonic() >= deadline:
+            return
+        if time.monotonic() - last_sent >= SSE_HEARTBEAT_SECONDS:
+            yield ': keep-alive\n\n'
+            last_sent = time.monotonic()
+        job_manager.wait_for_change(timeout=min(SSE_HEARTBEAT_SECONDS, max(0.1, deadline - time.monotonic())))
+
+@app.route('/api/jobs/<job_id>/events')
+def stream_job_events(job_id):
+    """Progression d'un job en Server-Sent Events (state, stage, progress)."""
+    err, status = _require_bearer_or_401()
+    if err:
+        return err, status
     try:
-        # Configuration OpenAI
-        api_key = os.getenv('OPENAI_API_KEY')
-        if not api_key:
-            print("Clé API OpenAI non configurée, utilisation des paramètres par défaut")
-            return get_default_layout_instructions()
-        
-        openai.api_key = api_key
-        
-        # Prompt système pour l'analyse de mise en page
-        system_prompt = """Tu es un expert en mise en page de magazines. Analyse le prompt utilisateur et génère des instructions précises pour remplir un template InDesign.
+        after = int(request.headers.get('Last-Event-ID') or request.args.get('after') or 0)
+    except ValueError:
+        return jsonify({'error': 'Last-Event-ID invalide'}), 400
+    job = job_manager.get(job_id)
+    if not job:
+        return jsonify({'error': 'Job non trouvé'}), 404
+    forbidden = _foreign_job(job)
+    if forbidden:
+        return forbidden
+    response = Response(stream_with_context(_stream_job_events(job_id, after)), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+# Prompt système pour l'analyse de mise en page.
+# Incrémenter LAYOUT_SYSTEM_PROMPT_VERSION à chaque modification : la version fait
+# partie de la clé du cache des instructions.
+LAYOUT_SYSTEM_PROMPT = """Tu es un expert en mise en page de magazines. Analyse le prompt utilisateur et génère des instructions précises pour remplir un template InDesign.
 
 Retourne uniquement un JSON valide avec cette structure exacte:
 {
@@ -298,43 +816,81 @@ Retourne uniquement un JSON valide avec cette structure exacte:
     "body_font": "Arial Regular"
   }
 }"""
-        
-        user_prompt = f"""Prompt utilisateur: "{prompt}"
+LAYOUT_SYSTEM_PROMPT_VERSION = '1'
+LAYOUT_MODEL = 'gpt-3.5-turbo'
+
+_openai_clients = {}
+
+def _get_openai_client(api_key):
+    """Client OpenAI réutilisé entre les requêtes (une instance par clé)"""
+    client = _openai_clients.get(api_key)
+    if client is None:
+        from openai import OpenAI
+        client = _openai_clients[api_key] = OpenAI(api_key=api_key)
+    return client
+
+def _request_ai_layout(api_key, prompt, text_content, image_count):
+    """Appel OpenAI brut : retourne le JSON parsé, avant validation"""
+    user_prompt = f"""Prompt utilisateur: "{prompt}"
 Contenu texte: "{text_content[:300]}..."
 Nombre d'images: {image_count}
 
 Génère des instructions de mise en page optimisées pour ce contenu."""
-        
-        from openai import OpenAI
-        client = OpenAI(api_key=api_key)
-        
-        response = client.chat.completions.create(
-            model="gpt-3.5-turbo",
-            messages=[
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": user_prompt}
-            ],
-            max_tokens=800,
-            temperature=0.7
-        )
-        
-        # Parser la réponse JSON
-        ai_response = response.choices[0].message.content.strip()
-        
-        # Nettoyer la réponse si elle contient des backticks
-        if ai_response.startswith('```json'):
-            ai_response = ai_response[7:-3]
-        elif ai_response.startswith('```'):
-            ai_response = ai_response[3:-3]
-        
-        layout_instructions = json.loads(ai_response)
-        
-        # Validation et nettoyage des données
-        return validate_and_clean_instructions(layout_instructions)
-        
+
+    # Pas plus que le budget restant du job (échéance X-Deadline-Seconds)
+    options = {}
+    remaining = current_scope().budget()
+    if remaining is not None:
+        options['timeout'] = remaining
+    response = _get_openai_client(api_key).chat.completions.create(
+        model=LAYOUT_MODEL,
+        messages=[
+            {"role": "system", "content": LAYOUT_SYSTEM_PROMPT},
+            {"role": "user", "content": user_prompt}
+        ],
+        max_tokens=800,
+        temperature=0.7,
+        **options
+    )
+
+    # Parser la réponse JSON
+    ai_response = response.choices[0].message.content.strip()
+
+    # Nettoyer la réponse si elle contient des backticks
+    if ai_response.startswith('```json'):
+        ai_response = ai_response[7:-3]
+    elif ai_response.startswith('```'):
+        ai_response = ai_response[3:-3]
+
+    return json.loads(ai_response)
+
+def analyze_prompt_with_ai(prompt, text_content, image_count):
+    """Analyse le prompt avec OpenAI pour générer des instructions de mise en page.
+    Retourne (instructions, cache_hit)."""
+    try:
+        # Configuration OpenAI
+        api_key = os.getenv('OPENAI_API_KEY')
+        if not api_key:
+            logger.warning('Clé API OpenAI non configurée, utilisation des paramètres par défaut')
+            return get_default_layout_instructions(), False
+
+        cache_key = layout_cache_key(prompt, text_content, image_count,
+                                     LAYOUT_MODEL, LAYOUT_SYSTEM_PROMPT_VERSION)
+        raw = layout_cache.get(cache_key) if layout_cache else None
+        cache_hit = raw is not None
+        if not cache_hit:
+            raw = _request_ai_layout(api_key, prompt, text_content, image_count)
+            if layout_cache:
+                layout_cache.set(cache_key, raw)
+
+        # Validation et nettoyage des données (aussi pour les résultats en cache)
+        return validate_and_clean_instructions(raw), cache_hit
+
+    except JobCancelled:
+        raise
     except Exception as e:
-        print(f"Erreur lors de l'analyse OpenAI: {e}")
-        return get_default_layout_instructions()
+        logger.exception("Erreur lors de l'analyse OpenAI: %s", e)
+        return get_default_layout_instructions(), False
 
 def get_default_layout_instructions():
     """Instructions de mise en page par défaut"""
@@ -387,58 +943,110 @@ def validate_and_clean_instructions(instructions):
     
     return instructions
 
-def execute_indesign_script(project_id, config_path):
-    """Exécute le script InDesign pour créer la mise en page"""
+PROGRESS_POLL_SECONDS = float(os.getenv('PROGRESS_POLL_SECONDS', '0.5'))
+
+def _read_progress(progress_path, position, job_id):
+    """Relaie en événements 'progress' les lignes JSON complètes ajoutées depuis `position`."""
     try:
-        script_path = os.path.join(os.getcwd(), 'scripts', 'template_simple_working.jsx')
-        indesign_app = os.getenv('INDESIGN_APP_NAME', 'Adobe InDesign 2026')
-        # Commande pour exécuter le script InDesign
-        # Sur macOS, utiliser osascript avec un fichier temporaire
-        import tempfile
-        
-        # Créer un script AppleScript temporaire avec scriptArgs pour passer le configPath
-        applescript_content = f'''
-tell application "{indesign_app}"
-    activate
-    set script args of script preferences to {{{{class:script arg, name:"configPath", value:"{config_path}"}}}}
-    do script POSIX file "{script_path}" language javascript
-end tell
-'''
-        
-        with tempfile.NamedTemporaryFile(mode='w', suffix='.applescript', delete=False) as temp_file:
-            temp_file.write(applescript_content)
-            temp_script_path = temp_file.name
-        
+        with open(progress_path, 'rb') as f:
+            f.seek(position)
+            chunk = f.read()
+    except FileNotFoundError:
+        return position
+    complete = chunk[:chunk.rfind(b'\n') + 1]
+    for line in complete.splitlines():
         try:
-            cmd = ['osascript', temp_script_path]
-            result = subprocess.run(cmd, capture_output=True, text=True, timeout=300)
-        finally:
-            # Nettoyer le fichier temporaire
-            os.unlink(temp_script_path)
-        
-        if result.returncode == 0:
-            output_file = os.path.join(app.config['OUTPUT_FOLDER'], f'{project_id}.indd')
+            progress = json.loads(line)
+        except ValueError:
+            continue
+        if isinstance(progress, dict):
+            job_manager.emit(job_id, 'progress', **progress)
+    return position + len(complete)
+
+@contextmanager
+def _follow_progress(script_args, progress_path):
+    """Pendant un script InDesign exécuté par un job, suit le fichier de progression
+    qu'il écrit (scriptArg progressPath). Sans job courant, ne fait rien."""
+    job_id = job_id_var.get()
+    if not job_id:
+        yield
+        return
+    if os.path.exists(progress_path):
+        os.unlink(progress_path)
+    script_args['progressPath'] = os.path.abspath(progress_path)
+    stop = threading.Event()
+
+    def _tail():
+        position = 0
+        while True:
+            stopping = stop.wait(PROGRESS_POLL_SECONDS)
+            position = _read_progress(progress_path, position, job_id)
+            if stopping:
+                return
+
+    follower = threading.Thread(target=_tail, name='magflow-progress', daemon=True)
+    follower.start()
+    try:
+        yield
+    finally:
+        stop.set()
+        follower.join()
+
+def _resolve_template_path(template):
+    """Fichier template qu'ouvrira le script JSX (même ordre de recherche), ou None."""
+    if not template:
+        return None
+    candidates = [
+        template,
+        os.path.join(app.config['TEMPLATES_FOLDER'], template),
+        os.path.join(os.path.dirname(os.getcwd()), 'Indesign automation v1', template)
+    ]
+    if '.indt' not in template:
+        candidates.append(os.path.join(app.config['TEMPLATES_FOLDER'], f'{template}.indt'))
+    return next((path for path in candidates if os.path.isfile(path)), None)
+
+def execute_indesign_script(project_id, config_path):
+    """Exécute le script InDesign pour créer la mise en page (via le pool de renderers).
+    Une configuration déjà rendue est servie depuis le cache des rendus."""
+    script_path = os.path.join(os.getcwd(), 'scripts', 'template_simple_working.jsx')
+    output_file = os.path.join(app.config['OUTPUT_FOLDER'], f'{project_id}.indd')
+
+    cache_key = None
+    if render_cache:
+        with open(config_path, encoding='utf-8') as f:
+            config = json.load(f)
+        cache_key = render_cache.key(config, _resolve_template_path(config.get('template')), script_path)
+        if cache_key and render_cache.fetch(cache_key, output_file):
             return {
                 'success': True,
                 'output_file': output_file,
-                'message': 'Script InDesign exécuté avec succès'
-            }
-        else:
-            return {
-                'success': False,
-                'error': f'Erreur script InDesign: {result.stderr}'
+                'message': 'Mise en page reprise du cache des rendus',
+                'render_cache_hit': True
             }
-            
-    except subprocess.TimeoutExpired:
-        return {
-            'success': False,
-            'error': 'Timeout lors de l\'exécution du script InDesign'
-        }
-    except Exception as e:
+
+    script_args = {
+        'configPath': config_path,
+        'outputPath': os.path.abspath(output_file)
+    }
+    scope = current_scope()
+    with _follow_progress(script_args, os.path.join(os.path.dirname(config_path), 'progress.jsonl')):
+        result = renderer_pool.run(script_path, script_args, timeout=scope.budget(300), cancel=scope)
+
+    if result['success']:
+        if cache_key and os.path.exists(output_file):
+            render_cache.store(cache_key, output_file)
         return {
-            'success': False,
-            'error': f'Erreur lors de l\'exécution: {str(e)}'
+            'success': True,
+            'output_file': output_file,
+            'message': 'Script InDesign exécuté avec succès',
+            'render_cache_hit': False
         }
+    return {
+        'success': False,
+        'error': result.get('error', 'Erreur script InDesign'),
+        'timeout': result.get('timeout', False),
+        'cancelled': result.get('cancelled', False)
+    }
 
 @app.route('/api/download/<project_id>')
 def download_file(project_id):
@@ -452,21 +1060,105 @@ def download_file(project_id):
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+@app.route('/api/load')
+def get_load():
+    """Charge courante (file, capacité, attente estimée par priorité) : à consulter
+    avant d'envoyer des demandes. Relue au plus une fois par ADMISSION_REFRESH_SECONDS."""
+    err, status = _require_bearer_or_401()
+    if err:
+        return err, status
+    if not admission:
+        return jsonify({'admission_enabled': False})
+    response = jsonify({'admission_enabled': True, **admission.snapshot()})
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+@app.route('/api/renderers')
+def get_renderers():
+    """État du pool de renderers InDesign"""
+    err, status = _require_bearer_or_401()
+    if err:
+        return err, status
+    return jsonify(renderer_pool.stats())
+
+@app.route('/api/cache/stats')
+def get_cache_stats():
+    """Compteurs des caches (hits, misses, évictions) pour le monitoring"""
+    err, status = _require_bearer_or_401()
+    if err:
+        return err, status
+    return jsonify({
+        'images': image_cache.stats() if image_cache else None,
+        'ai_layouts': layout_cache.stats() if layout_cache else None,
+        'template_analyses': template_analysis_cache.stats() if template_analysis_cache else None,
+        'renders': render_cache.stats() if render_cache else None,
+        'layout_requests': layout_requests.stats() if layout_requests else None
+    })
+
+@app.before_request
+def _start_request_timer():
+    g.request_started = time.monotonic()
+    # Identifiant repris dans chaque ligne de log (et dans les jobs soumis)
+    g.request_id = request.headers.get('X-Request-ID') or uuid.uuid4().hex
+    request_id_var.set(g.request_id)
+    # Un thread gunicorn enchaîne les requêtes : le client est réidentifié à chaque fois
+    tenant_var.set(None)
+
+@app.after_request
+def _record_request_metrics(response):
+    if 'request_started' in g and request.url_rule is not None:
+        endpoint = request.url_rule.rule
+        metrics.observe('http_request_duration_seconds', time.monotonic() - g.request_started,
+                        method=request.method, endpoint=endpoint)
+        metrics.inc('http_requests_total', method=request.method, endpoint=endpoint, status=response.status_code)
+    if 'request_id' in g:
+        response.headers['X-Request-ID'] = g.request_id
+    return response
+
+@app.route('/metrics')
+def prometheus_metrics():
+    """Métriques au format texte Prometheus (tous workers confondus)."""
+    err, status = _require_bearer_or_401()
+    if err:
+        return err, status
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4; charset=utf-8')
+
 @app.route('/api/templates')
 def get_templates():
-    """Récupérer la liste des templates disponibles"""
-    templates = []
-    templates_dir = app.config['TEMPLATES_FOLDER']
-    
-    if os.path.exists(templates_dir):
-        for file in os.listdir(templates_dir):
-            if file.endswith('.indt'):
-                templates.append({
-                    'name': file.replace('.indt', ''),
-                    'filename': file
-                })
-    
-    return jsonify(templates)
+    """
+    Catalogue des templates disponibles, enrichi des analyses en cache.
+
+    Filtres optionnels : ?page_count=, ?image_slots=, ?min_image_slots=, ?font=.
+    Sans ?page= ni ?per_page=, retourne une liste (format historique) ;
+    sinon {templates, total, page, per_page}.
+    """
+    version, entries = template_catalog.snapshot()
+    paginated = 'page' in request.args or 'per_page' in request.args
+    page = max(1, request.args.get('page', 1, type=int))
+    per_page = max(1, min(200, request.args.get('per_page', 50, type=int)))
+
+    etag = hashlib.sha256(f'{version}?{sorted(request.args.items(multi=True))}'.encode('utf-8')).hexdigest()[:32]
+    if request.if_none_match.contains(etag):
+        return Response(status=304, headers={'ETag': f'"{etag}"'})
+
+    templates = filter_templates(
+        entries,
+        page_count=request.args.get('page_count', type=int),
+        image_slots=request.args.get('image_slots', type=int),
+        min_image_slots=request.args.get('min_image_slots', type=int),
+        font=request.args.get('font')
+    )
+    if paginated:
+        start = (page - 1) * per_page
+        body = {'templates': templates[start:start + per_page], 'total': len(templates),
+                'page': page, 'per_page': per_page}
+    else:
+        body = templates
+
+    response = jsonify(body)
+    response.headers['ETag'] = f'"{etag}"'
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
 
 @app.route('/api/config')
 def get_config():
@@ -493,10 +1185,342 @@ def get_config():
         'port': 5003
     })
 
+# ============================================
+# GÉNÉRATION PAR LOTS (NUMÉRO COMPLET)
+# ============================================
+
+BATCH_MAX_ARTICLES = int(os.getenv('BATCH_MAX_ARTICLES', '50'))
+BATCH_MODE_SEPARATE = 'separate'              # un .indd par article
+BATCH_MODE_SINGLE_DOCUMENT = 'single_document'  # un seul .indd multi-spreads
+
+def _parse_batch_articles(data):
+    """Valide la liste `articles` d'un batch. Retourne (articles, erreur)."""
+    articles = data.get('articles')
+    if not isinstance(articles, list) or not articles:
+        return None, 'articles (liste non vide) est requis'
+    if len(articles) > BATCH_MAX_ARTICLES:
+        return None, f'Maximum {BATCH_MAX_ARTICLES} articles par batch'
+    parsed = []
+    for i, article in enumerate(articles):
+        if not isinstance(article, dict) or not article.get('prompt'):
+            return None, f'Article {i}: le prompt est requis'
+        image_urls = article.get('image_urls') or []
+        if isinstance(image_urls, str):
+            image_urls = [u.strip() for u in image_urls.split(',') if u.strip()]
+        parsed.append({
+            'prompt': article['prompt'],
+            'text_content': article.get('text_content', ''),
+            'subtitle': article.get('subtitle', ''),
+            'template': article.get('template', data.get('template', 'default')),
+            'image_urls': list(dict.fromkeys(str(u) for u in image_urls))
+        })
+    return parsed, None
+
+@app.route('/api/create-layouts/batch', methods=['POST'])
+def create_layouts_batch():
+    """
+    Génère plusieurs articles en un appel.
+
+    Body JSON:
+    {
+        "articles": [{"prompt": "...", "text_content": "...", "subtitle": "...",
+                      "template": "...", "image_urls": ["..."]}, ...],
+        "stream": false,  // true (ou Accept: application/x-ndjson) : réponse NDJSON
+        "mode": "separate",  // ou "single_document" : un seul .indd pour tout le numéro
+        "template": "..."    // optionnel, template du document en mode single_document
+    }
+
+    Les images communes ne sont téléchargées qu'une fois, les analyses IA
+    identiques sont dédupliquées, puis un job de rendu est créé par article.
+    Sans streaming, répond 202 avec un batch_id à suivre sur /api/batches/<id>.
+    """
+    try:
+        err, status = _require_bearer_or_401()
+        if err:
+            return err, status
+
+        data = request.get_json(silent=True) or {}
+        articles, error = _parse_batch_articles(data)
+        if error:
+            return jsonify({'error': error}), 400
+
+        mode = data.get('mode', BATCH_MODE_SEPARATE)
+        if mode not in (BATCH_MODE_SEPARATE, BATCH_MODE_SINGLE_DOCUMENT):
+            return jsonify({'error': f'Mode inconnu: {mode}'}), 400
+        deadline_at, error = _request_deadline()
+        if error:
+            return error
+        rejected = _admission_rejection('batch', PRIORITY_BATCH)
+        if rejected:
+            return rejected
+
+        batch_id = str(uuid.uuid4())
+        job = job_manager.submit('batch', {
+            'batch_id': batch_id,
+            'articles': articles,
+            'mode': mode,
+            'template': data.get('template')
+        }, job_id=batch_id, priority=PRIORITY_BATCH, deadline_at=deadline_at)
+
+        wants_stream = bool(data.get('stream')) or \
+            request.accept_mimetypes.best == 'application/x-ndjson'
+        if wants_stream:
+            return Response(stream_with_context(_stream_batch(batch_id)),
+                            mimetype='application/x-ndjson')
+
+        status_url = f'/api/batches/{batch_id}'
+        response = jsonify({
+            'success': True,
+            'batch_id': batch_id,
+            'job_id': job.id,
+            'mode': mode,
+            'articles': len(articles),
+            'status_url': status_url
+        })
+        response.headers['Location'] = status_url
+        return response, 202
+    except Exception as e:
+        return jsonify({'error': f'Erreur serveur: {str(e)}'}), 500
+
+def _link_article_images(article, downloads, folder, prefix='image'):
+    """Lie dans `folder` les images (déjà téléchargées) d'un article, dans son ordre."""
+    images = []
+    image_downloads = [downloads[url] for url in article['image_urls']]
+    for report in image_downloads:
+        if report['ok']:
+            ext = os.path.splitext(report['path'])[1]
+            dest = os.path.join(folder, f'{prefix}_{len(images) + 1}{ext}')
+            link_or_copy(report['path'], dest)
+            images.append(dest)
+    return images, image_downloads
+
+def _run_batch_job(payload):
+    """Handler du job 'batch' : images dédupliquées + IA groupée, puis soit un job
+    'layout' par article, soit un seul document multi-articles."""
+    batch_id = payload['batch_id']
+    articles = payload['articles']
+    timings = {}
+
+    # Analyses IA dédupliquées, lancées pendant le téléchargement des images
+    ai_keys = [layout_cache_key(a['prompt'], a['text_content'], len(a['image_urls']),
+                                LAYOUT_MODEL, LAYOUT_SYSTEM_PROMPT_VERSION) for a in articles]
+    ai_futures = {}
+    for key, article in zip(ai_keys, articles):
+        if key not in ai_futures:
+            ai_futures[key] = ai_executor.submit(
+                contextvars.copy_context().run, analyze_prompt_with_ai, article['prompt'], article['text_content'], len(article['image_urls'])
+            )
+
+    # Chaque URL distincte n'est téléchargée qu'une fois pour tout le batch
+    unique_urls = list(dict.fromkeys(u for a in articles for u in a['image_urls']))
+    shared_folder = os.path.join(app.config['UPLOAD_FOLDER'], f'batch-{batch_id}')
+    downloads = {}
+    if unique_urls:
+        with _stage(timings, 'image_download', pipeline='batch'):
+            _, reports = _download_images(unique_urls, shared_folder)
+        downloads = {r['url']: r for r in reports}
+
+    with _stage(timings, 'ai_analysis', pipeline='batch'):
+        ai_results = {key: _await(future) for key, future in ai_futures.items()}
+
+    summary = {
+        'batch_id': batch_id,
+        'mode': payload.get('mode', BATCH_MODE_SEPARATE),
+        'unique_images': len(unique_urls),
+        'unique_ai_requests': len(ai_futures),
+        'timings': timings
+    }
+    if payload.get('mode') == BATCH_MODE_SINGLE_DOCUMENT:
+        return _render_issue_document(batch_id, payload, articles, ai_keys, ai_results, downloads, summary)
+
+    items = []
+    for index, (article, key) in enumerate(zip(articles, ai_keys)):
+        project_id = str(uuid.uuid4())
+        project_folder = os.path.join(app.config['UPLOAD_FOLDER'], project_id)
+        os.makedirs(project_folder, exist_ok=True)
+        images, image_downloads = _link_article_images(article, downloads, project_folder)
+        if article['image_urls'] and not images:
+            items.append({'index': index, 'project_id': project_id, 'job_id': None,
+                          'state': JOB_FAILED, 'error': 'Téléchargement des images échoué'})
+            continue
+        layout_instructions, ai_cache_hit = ai_results[key]
+        current_scope().check()
+        job = job_manager.submit('layout', {
+            'project_id': project_id,
+            'batch_id': batch_id,
+            'prompt': article['prompt'],
+            'text_content': article['text_content'],
+            'subtitle': article['subtitle'],
+            'template': article['template'],
+            'images': images,
+            'image_downloads': image_downloads,
+            'layout_instructions': copy.deepcopy(layout_instructions),
+            'ai_cache_hit': ai_cache_hit
+        }, job_id=project_id, priority=PRIORITY_BATCH)
+        items.append({'index': index, 'project_id': project_id, 'job_id': job.id})
+        # Journalisé avant de relire la demande d'annulation : un DELETE du batch
+        # voit ce rendu dans le journal, ou bien on le voit ici et on l'annule
+        job_manager.emit(batch_id, 'item', index=index, project_id=job.id)
+        if job_manager.get(batch_id)['cancel_requested']:
+            job_manager.cancel(job.id)
+            current_scope().cancel(CANCEL_REQUESTED)
+            current_scope().check()
+
+    return {'success': True, 'items': items, **summary}
+
+def _batch_item_job_ids(batch):
+    """Jobs 'layout' soumis par un batch (id = project_id de l'article) : événements
+    `item` du journal, écrits dès chaque soumission, et articles du résultat une
+    fois le batch terminé."""
+    events, _ = job_manager.events(batch['job_id']) or ([], True)
+    job_ids = [event['project_id'] for event in events if event['event'] == 'item']
+    job_ids += [item['job_id'] for item in (batch.get('result') or {}).get('items', []) if item.get('job_id')]
+    return list(dict.fromkeys(job_ids))
+
+def _render_issue_document(batch_id, payload, articles, ai_keys, ai_results, downloads, summary):
+    """Mode single_document : tous les articles dans un seul .indd, une seule
+    ouverture/sauvegarde du template dans InDesign."""
+    project_id = batch_id
+    timings = summary['timings']
+    project_folder = os.path.join(app.config['UPLOAD_FOLDER'], project_id)
+    os.makedirs(project_folder, exist_ok=True)
+
+    items = []
+    config_articles = []
+    for index, (article, key) in enumerate(zip(articles, ai_keys)):
+        images, _ = _link_article_images(article, downloads, project_folder, prefix=f'article_{index + 1}_image')
+        if article['image_urls'] and not images:
+            items.append({'index': index, 'project_id': project_id, 'job_id': None,
+                          'state': JOB_FAILED, 'error': 'Téléchargement des images échoué'})
+            continue
+        config_articles.append({
+            'index': index,
+            'prompt': article['prompt'],
+            'text_content': article['text_content'],
+            'subtitle': article['subtitle'],
+            'images': [os.path.abspath(img) for img in images],
+            'layout_instructions': copy.deepcopy(ai_results[key][0])
+        })
+    if not config_articles:
+        return {'success': False, 'error': 'Aucun article à mettre en page', 'items': items, **summary}
+
+    template = payload.get('template') or articles[0]['template']
+    all_images = [img for article in config_articles for img in article['images']]
+    if image_preprocessor and all_images:
+        # Toutes les images du numéro en un seul passage sur le pool
+        with _stage(timings, 'image_prep', pipeline='batch'):
+            prepared, _ = image_preprocessor.prepare(all_images, _image_max_edge(template))
+        prepared_by_original = dict(zip(all_images, prepared))
+        for article in config_articles:
+            article['images'] = [prepared_by_original[img] for img in article['images']]
+
+    with _stage(timings, 'config_write', pipeline='batch'):
+        config = {
+            'project_id': project_id,
+            'template': template,
+            'articles': config_articles,
+            'created_at': datetime.now().isoformat()
+        }
+        config_path = os.path.join(project_folder, 'config.json')
+        with open(config_path, 'w', encoding='utf-8') as f:
+            json.dump(config, f, ensure_ascii=False, indent=2)
+
+    with _stage(timings, 'render', pipeline='batch') as stage:
+        result = execute_indesign_script(project_id, config_path)
+        if not result['success']:
+            stage.fail(timeout=result.get('timeout'))
+
+    state = JOB_DONE if result['success'] else JOB_FAILED
+    for article in config_articles:
+        items.append({'index': article['index'], 'project_id': project_id, 'job_id': None,
+                      'state': state, 'output_file': result.get('output_file'), 'error': result.get('error')})
+    items.sort(key=lambda item: item['index'])
+    return {
+        'success': result['success'],
+        'error': result.get('error'),
+        'project_id': project_id,
+        'output_file': result.get('output_file'),
+        'render_cache_hit': result.get('render_cache_hit', False),
+        'items': items,
+        **summary
+    }
+
+job_manager.register('batch', _run_batch_job, cleanup=_discard_batch_files)
+
+def _batch_status(batch_id):
+    """Statut agrégé d'un batch (None si inconnu)."""
+    batch_job = job_manager.get(batch_id)
+    if not batch_job or batch_job['kind'] != 'batch':
+        return None
+    items = []
+    for item in (batch_job['result'] or {}).get('items', []):
+        item = dict(item)
+        child = job_manager.get(item['job_id']) if item.get('job_id') else None
+        if child:
+            item.update({'state': child['state'], 'output_file': child['output_file'], 'error': child['error']})
+        items.append(item)
+    states = [item.get('state') for item in items]
+    result = batch_job['result'] or {}
+    return {
+        'batch_id': batch_id,
+        'state': batch_job['state'],
+        'mode': result.get('mode'),
+        'output_file': result.get('output_file'),
+        'error': batch_job['error'],
+        'items': items,
+        'counts': {state: states.count(state) for state in JOB_STATES},
+        'finished': batch_job['state'] in (JOB_FAILED, JOB_CANCELLED) or (
+            batch_job['state'] == JOB_DONE and all(s in FINISHED_STATES for s in states)
+        )
+    }
+
+def _stream_batch(batch_id):
+    """Générateur NDJSON : une ligne d'entête, une ligne par article terminé, une
+    ligne finale. Au-delà de SSE_MAX_SECONDS, une ligne `continue` renvoie le
+    client vers /api/batches/<id> plutôt que de tenir la connexion tout le numéro."""
+    yield json.dumps({'type': 'batch', 'batch_id': batch_id}) + '\n'
+    reported = set()
+    deadline = time.monotonic() + SSE_MAX_SECONDS
+    while True:
+        status = _batch_status(batch_id)
+        for item in status['items']:
+            if item['index'] not in reported and item.get('state') in FINISHED_STATES:
+                reported.add(item['index'])
+                yield json.dumps({'type': 'item', **item}, ensure_ascii=False) + '\n'
+        if status['finished']:
+            yield json.dumps({'type': 'summary', 'state': status['state'], 'error': status['error'],
+                              'counts': status['counts']}) + '\n'
+            return
+        if time.monotonic() >= deadline:
+            yield json.dumps({'type': 'continue', 'status_url': f'/api/batches/{batch_id}',
+                              'counts': status['counts']}) + '\n'
+            return
+        job_manager.wait_for_change(timeout=5)
+
+@app.route('/api/batches/<batch_id>')
+def get_batch(batch_id):
+    """Statut d'un batch et de chacun de ses articles."""
+    err, status = _require_bearer_or_401()
+    if err:
+        return err, status
+    batch_job = job_manager.get(batch_id)
+    if batch_job:
+        forbidden = _foreign_job(batch_job)
+        if forbidden:
+            return forbidden
+    batch = _batch_status(batch_id)
+    if not batch:
+        return jsonify({'error': 'Batch non trouvé'}), 404
+    return jsonify(batch)
+
 # ============================================
 # ANALYSE DE TEMPLATES ET GÉNÉRATION MINIATURES
 # ============================================
 
+# Un sous-dossier par analyse (config.json + results.json)
+ANALYSIS_JOBS_DIR = os.path.join(os.getcwd(), 'analysis', 'jobs')
+
+
 @app.route('/api/templates/analyze', methods=['POST'])
 def analyze_template():
     """
@@ -506,19 +1530,16 @@ def analyze_template():
     {
         "template_path": "/chemin/vers/template.indt",
         "thumbnail_width": 800,  // optionnel
-        "thumbnail_height": 600  // optionnel
+        "thumbnail_height": 600,  // optionnel
+        "force": false,  // optionnel, ignore le cache d'analyse
+        "async": false  // optionnel, analyse en job (202 + /api/jobs/<id>/events)
     }
     
     Retourne les métadonnées extraites et le chemin de la miniature.
     """
-    import time
     start_time = time.time()
 
     try:
-        print('\n' + '='*70)
-        print('🔍 FLASK: Template Analysis Request Received')
-        print('='*70)
-
         # Auth (optionnelle si API_TOKEN non défini)
         err, status = _require_bearer_or_401()
         if err:
@@ -527,152 +1548,303 @@ def analyze_template():
         data = request.get_json(silent=True) or {}
         template_path = data.get('template_path')
 
-        print(f'📄 Template path: {template_path}')
-        print(f'📐 Thumbnail dimensions: {data.get("thumbnail_width", 800)}x{data.get("thumbnail_height", 600)}')
-
         if not template_path:
-            print('❌ ERROR: No template_path provided')
+            logger.warning('Analyse de template sans template_path')
             return jsonify({'error': 'template_path is required'}), 400
 
         if not os.path.exists(template_path):
-            print(f'❌ ERROR: File not found at {template_path}')
+            logger.warning('Template introuvable: %s', template_path)
             return jsonify({'error': f'Template not found: {template_path}'}), 404
 
-        file_size = os.path.getsize(template_path) / 1024 / 1024
-        print(f'✅ Template file exists ({file_size:.2f} MB)')
-
-        # Configuration pour le script InDesign
-        print('\n📁 Setting up directories and config...')
-        analysis_dir = os.path.join(os.getcwd(), 'analysis')
-        os.makedirs(analysis_dir, exist_ok=True)
-
-        thumbnails_dir = os.path.join(os.getcwd(), 'thumbnails')
-        os.makedirs(thumbnails_dir, exist_ok=True)
+        logger.info('Analyse de template demandée: %s', template_path, extra={
+            'size_bytes': os.path.getsize(template_path),
+            'thumbnail_width': data.get('thumbnail_width', 800),
+            'thumbnail_height': data.get('thumbnail_height', 600)
+        })
 
-        config = {
+        priority, error = _requested_priority()
+        if error:
+            return error
+        deadline_at, error = _request_deadline()
+        if error:
+            return error
+        payload = {
             'template_path': template_path,
-            'output_dir': thumbnails_dir + '/',
             'thumbnail_width': data.get('thumbnail_width', 800),
-            'thumbnail_height': data.get('thumbnail_height', 600)
+            'thumbnail_height': data.get('thumbnail_height', 600),
+            'force': bool(data.get('force'))
         }
+        # Une analyse en cache ne touche pas InDesign : ni admission ni file
+        analysis = None
+        if not data.get('async') and not payload['force']:
+            analysis = cached_template_analysis(template_path, payload['thumbnail_width'],
+                                                payload['thumbnail_height'])
+        if not analysis:
+            rejected = _admission_rejection('analysis', priority)
+            if rejected:
+                return rejected
 
-        config_path = os.path.join(analysis_dir, 'config.json')
-        with open(config_path, 'w', encoding='utf-8') as f:
-            json.dump(config, f, ensure_ascii=False, indent=2)
-
-        print(f'✅ Config written to: {config_path}')
-
-        # Exécuter le script InDesign
-        print('\n🖥️  Executing InDesign script...')
-        print('⏱️  Timeout: 600 seconds (10 minutes)')
-        print('⏳ This may take several minutes, please wait...')
+        if data.get('async'):
+            job = job_manager.submit('analysis', payload, priority=priority, deadline_at=deadline_at)
+            return _job_accepted_response(job, message='Analyse en file d\'attente')
 
-        script_path = os.path.join(os.getcwd(), 'scripts', 'analyze_and_thumbnail.jsx')
+        # Sinon le script InDesign passe par la file des jobs, comme les rendus
         script_start_time = time.time()
-        result = execute_analysis_script(script_path, config_path)
+        if not analysis:
+            analysis, error = _run_analysis_in_queue(payload, priority, deadline_at)
+            if error:
+                return error
         script_duration = time.time() - script_start_time
 
-        print(f'⏱️  InDesign script completed in {script_duration:.2f}s')
-        
-        if not result['success']:
-            print(f'❌ InDesign script failed: {result.get("error")}')
-            return jsonify({
+        if not analysis['success']:
+            logger.error('Analyse échouée pour %s: %s', template_path, analysis.get('error'),
+                         extra={'details': analysis.get('details'), 'script_seconds': round(script_duration, 3)})
+            response = {'success': False, 'error': analysis['error']}
+            if 'details' in analysis:
+                response['details'] = analysis['details']
+            return jsonify(response), 500
+
+        analysis_results = analysis['results']
+        template_info = analysis_results.get('template') or {}
+        logger.info('Analyse terminée: %s', template_path, extra={
+            'cached': analysis['cached'],
+            'script_seconds': round(script_duration, 3),
+            'total_seconds': round(time.time() - start_time, 3),
+            'placeholders': len(template_info.get('placeholders', [])),
+            'image_slots': template_info.get('image_slots', 0)
+        })
+
+        return jsonify(_analysis_response(analysis))
+
+    except Exception as e:
+        logger.exception('Erreur serveur pendant l\'analyse après %.2fs', time.time() - start_time)
+        return jsonify({'error': f'Server error: {str(e)}'}), 500
+
+
+def _analysis_response(analysis):
+    """Corps de réponse d'une analyse réussie (endpoint synchrone et résultat de job)."""
+    analysis_results = analysis['results']
+    return {
+        'success': True,
+        'template': analysis_results.get('template'),
+        'thumbnail': analysis_results.get('thumbnail'),
+        'errors': analysis_results.get('errors', []),
+        'cached': analysis['cached'],
+        'template_sha256': analysis['template_sha256']
+    }
+
+def _run_analysis_job(payload):
+    """Handler du job 'analysis' (analyses synchrones et analyze avec "async": true)."""
+    analysis = run_template_analysis(
+        payload['template_path'],
+        payload['thumbnail_width'],
+        payload['thumbnail_height'],
+        force=payload['force'],
+        template_sha256=payload.get('template_sha256')
+    )
+    if not analysis['success']:
+        return {'success': False, 'error': analysis['error'], 'details': analysis.get('details')}
+    return _analysis_response(analysis)
+
+job_manager.register('analysis', _run_analysis_job, renders=True)
+
+# Attente maximale d'une analyse synchrone (file + script) avant de rendre la main
+ANALYSIS_SYNC_WAIT_SECONDS = float(os.getenv('ANALYSIS_SYNC_WAIT_SECONDS', '900'))
+
+def _run_analysis_in_queue(payload, priority, deadline_at):
+    """
+    Analyse synchrone exécutée en job 'analysis' : elle attend son tour derrière
+    les rendus (une instance InDesign, un script à la fois) et compte dans la
+    charge vue par le contrôle d'admission.
+
+    Retourne (analysis, None) au format de run_template_analysis, ou
+    (None, réponse 504) si le job n'est pas terminé après
+    ANALYSIS_SYNC_WAIT_SECONDS : il continue et reste consultable via status_url.
+    """
+    job = job_manager.submit('analysis', payload, priority=priority, deadline_at=deadline_at)
+    wait_until = time.monotonic() + ANALYSIS_SYNC_WAIT_SECONDS
+    status = job_manager.get(job.id)
+    while status['state'] not in FINISHED_STATES:
+        if time.monotonic() >= wait_until:
+            return None, (jsonify({
                 'success': False,
-                'error': result.get('error', 'Analysis script failed')
-            }), 500
+                'error': 'Analyse toujours en cours',
+                'job_id': job.id,
+                'state': status['state'],
+                'status_url': f'/api/jobs/{job.id}'
+            }), 504)
+        job_manager.wait_for_change(timeout=max(0.1, wait_until - time.monotonic()))
+        status = job_manager.get(job.id)
+
+    result = status['result'] or {}
+    if status['state'] != JOB_DONE or not result.get('success'):
+        analysis = {'success': False, 'error': result.get('error') or status['error'] or status['state']}
+        if result.get('details'):
+            analysis['details'] = result['details']
+        return analysis, None
+    return {
+        'success': True,
+        'results': {key: result[key] for key in ('template', 'thumbnail', 'errors')},
+        'cached': result['cached'],
+        'template_sha256': result['template_sha256']
+    }, None
+
+def cached_template_analysis(template_path, thumbnail_width=800, thumbnail_height=600, template_sha256=None):
+    """Analyse en cache pour ces octets et ces dimensions de miniature, au format
+    de run_template_analysis, sinon None."""
+    if not template_analysis_cache:
+        return None
+    template_sha256 = template_sha256 or file_sha256(template_path)
+    cached = template_analysis_cache.get(template_sha256, thumbnail_width, thumbnail_height)
+    if not cached:
+        return None
+    # Mêmes octets, éventuellement sous un autre chemin
+    cached['template'] = dict(cached.get('template') or {},
+                              path=template_path, filename=os.path.basename(template_path))
+    return {'success': True, 'results': cached, 'cached': True, 'template_sha256': template_sha256}
+
+def run_template_analysis(template_path, thumbnail_width=800, thumbnail_height=600, force=False,
+                          template_sha256=None):
+    """
+    Analyse un template, en réutilisant le cache si ces octets (SHA-256) ont déjà
+    été analysés avec les mêmes dimensions de miniature (sauf force=True).
+    `template_sha256` évite de re-hacher un fichier dont le hash est déjà connu.
+
+    Retourne {'success': True, 'results': {...}, 'cached': bool, 'template_sha256': '...'}
+    ou {'success': False, 'error': '...', 'details': [...]}.
+    """
+    template_sha256 = template_sha256 or file_sha256(template_path)
+    if not force:
+        cached = cached_template_analysis(template_path, thumbnail_width, thumbnail_height, template_sha256)
+        if cached:
+            return cached
 
-        print('✅ InDesign script execution successful')
+    analysis = _analyze_template_with_indesign(template_path, thumbnail_width, thumbnail_height, template_sha256)
+    if analysis['success']:
+        thumbnail = analysis['results'].get('thumbnail') or {}
+        if thumbnail.get('path') and os.path.exists(thumbnail['path']):
+            try:
+                thumbnail.update(thumbnail_variants.generate(thumbnail['path']))
+            except Exception as e:
+                logger.warning('Variantes de miniature échouées pour %s: %s', thumbnail['path'], e)
+        if template_analysis_cache:
+            template_analysis_cache.set(template_sha256, thumbnail_width, thumbnail_height, analysis['results'])
+            template_catalog.invalidate()
+        analysis.update({'cached': False, 'template_sha256': template_sha256})
+    return analysis
 
-        # Lire les résultats
-        print('\n📄 Reading analysis results...')
-        results_path = os.path.join(analysis_dir, 'results.json')
+
+def _analyze_template_with_indesign(template_path, thumbnail_width, thumbnail_height, template_sha256):
+    """
+    Lance analyze_and_thumbnail.jsx dans un dossier de travail propre
+    (analysis/jobs/<id>/) : config et résultats ne sont jamais partagés entre
+    deux analyses (qui passent l'une après l'autre dans l'instance InDesign).
+    La miniature est nommée d'après le contenu du template et ses dimensions :
+    une nouvelle version du même template n'écrase pas celle que le cache
+    d'analyse renvoie pour l'ancienne.
+    """
+    job_dir = os.path.join(ANALYSIS_JOBS_DIR, str(uuid.uuid4()))
+    os.makedirs(job_dir, exist_ok=True)
+
+    thumbnails_dir = os.path.join(os.getcwd(), 'thumbnails')
+    os.makedirs(thumbnails_dir, exist_ok=True)
+
+    config_path = os.path.join(job_dir, 'config.json')
+    results_path = os.path.join(job_dir, 'results.json')
+    stem = os.path.splitext(os.path.basename(template_path))[0]
+    config = {
+        'template_path': template_path,
+        'output_dir': thumbnails_dir + '/',
+        'thumbnail_name': f'{stem}_{template_sha256[:16]}_{thumbnail_width}x{thumbnail_height}_thumbnail.jpg',
+        'thumbnail_width': thumbnail_width,
+        'thumbnail_height': thumbnail_height
+    }
+    timings = {}
+    try:
+        with _stage(timings, 'config_write', pipeline='analysis'):
+            with open(config_path, 'w', encoding='utf-8') as f:
+                json.dump(config, f, ensure_ascii=False, indent=2)
+
+        script_path = os.path.join(os.getcwd(), 'scripts', 'analyze_and_thumbnail.jsx')
+        with _stage(timings, 'render', pipeline='analysis') as stage:
+            result = execute_analysis_script(script_path, config_path, results_path)
+            if not result['success']:
+                stage.fail(timeout=result.get('timeout'))
+        if not result['success']:
+            return {'success': False, 'error': result.get('error', 'Analysis script failed')}
 
         if not os.path.exists(results_path):
-            print(f'❌ ERROR: Results file not found at {results_path}')
-            return jsonify({
-                'success': False,
-                'error': 'Analysis results not found'
-            }), 500
+            return {'success': False, 'error': 'Analysis results not found'}
 
         # Lire et nettoyer le JSON pour échapper les caractères de contrôle
-        with open(results_path, 'r', encoding='utf-8') as f:
-            raw_json = f.read()
+        with _stage(timings, 'result_read', pipeline='analysis'):
+            with open(results_path, 'r', encoding='utf-8') as f:
+                raw_json = f.read()
 
         # Remplacer les tabulations littérales par des espaces
         # (InDesign peut écrire "Playfair Display\tBold" au lieu de "Playfair Display Bold")
         cleaned_json = raw_json.replace('\t', ' ')
 
-        print(f'📄 JSON file size: {len(raw_json)} bytes')
-
         try:
             analysis_results = json.loads(cleaned_json)
         except json.JSONDecodeError as e:
-            print(f'❌ JSON parsing error: {e}')
-            print(f'📄 Problematic JSON around char {e.pos}:')
             start = max(0, e.pos - 50)
             end = min(len(cleaned_json), e.pos + 50)
-            print(f'   ...{cleaned_json[start:end]}...')
-            return jsonify({
-                'success': False,
-                'error': f'Invalid JSON from InDesign script: {str(e)}'
-            }), 500
+            logger.error('JSON invalide renvoyé par InDesign: %s autour de ...%s...', e, cleaned_json[start:end])
+            return {'success': False, 'error': f'Invalid JSON from InDesign script: {str(e)}'}
 
         if not analysis_results.get('success'):
-            print(f'❌ Analysis returned success=false')
-            print(f'   Errors: {analysis_results.get("errors", [])}')
-            return jsonify({
+            return {
                 'success': False,
                 'error': 'Analysis failed',
                 'details': analysis_results.get('errors', [])
-            }), 500
+            }
+        return {'success': True, 'results': analysis_results}
+    finally:
+        shutil.rmtree(job_dir, ignore_errors=True)
 
-        total_duration = time.time() - start_time
-        print(f'\n✅ Analysis completed successfully in {total_duration:.2f}s')
-        print(f'📊 Results: {len(analysis_results.get("template", {}).get("placeholders", []))} placeholders, '
-              f'{analysis_results.get("template", {}).get("image_slots", 0)} image slots')
-        print('='*70 + '\n')
 
-        return jsonify({
-            'success': True,
-            'template': analysis_results.get('template'),
-            'thumbnail': analysis_results.get('thumbnail'),
-            'errors': analysis_results.get('errors', [])
-        })
+def execute_analysis_script(script_path, config_path, results_path):
+    """Exécute le script d'analyse InDesign (via le pool de renderers)"""
+    if not os.path.exists(script_path):
+        return {'success': False, 'error': f'Script not found: {script_path}'}
 
-    except Exception as e:
-        total_duration = time.time() - start_time
-        print(f'\n❌ FLASK ERROR after {total_duration:.2f}s: {str(e)}')
-        print('='*70 + '\n')
-        return jsonify({'error': f'Server error: {str(e)}'}), 500
+    script_args = {
+        'configPath': config_path,
+        'resultsPath': results_path
+    }
+    # Timeout de 600 secondes (10 minutes) pour les gros templates, borné par l'échéance
+    scope = current_scope()
+    with _follow_progress(script_args, os.path.join(os.path.dirname(config_path), 'progress.jsonl')):
+        result = renderer_pool.run(script_path, script_args, timeout=scope.budget(600), cancel=scope)
+    if result['success']:
+        return {'success': True}
+    return {'success': False, 'error': result.get('error', 'Script error'), 'timeout': result.get('timeout', False)}
 
 
-def execute_analysis_script(script_path, config_path):
-    """Exécute le script d'analyse InDesign"""
-    try:
-        if not os.path.exists(script_path):
-            return {'success': False, 'error': f'Script not found: {script_path}'}
-        
-        indesign_app = os.getenv('INDESIGN_APP_NAME', 'Adobe InDesign 2026')
-        
-        # Utiliser osascript -e directement (plus fiable)
-        applescript_cmd = f'tell application "{indesign_app}" to do script POSIX file "{script_path}" language javascript'
-        
-        cmd = ['osascript', '-e', applescript_cmd]
-        # Augmenter le timeout à 600 secondes (10 minutes) pour les gros templates
-        result = subprocess.run(cmd, capture_output=True, text=True, timeout=600)
-        
-        if result.returncode == 0:
-            return {'success': True}
-        else:
-            return {
-                'success': False,
-                'error': f'Script error: {result.stderr}'
-            }
-            
-    except subprocess.TimeoutExpired:
-        return {'success': False, 'error': 'Script timeout'}
-    except Exception as e:
-        return {'success': False, 'error': str(e)}
+@app.route('/api/templates/analysis-cache', methods=['DELETE'])
+def invalidate_template_analysis_cache():
+    """
+    Invalide le cache d'analyse.
+
+    Body JSON (optionnel) : {"template_path": "..."} ou {"template_sha256": "..."}.
+    Sans corps, vide tout le cache.
+    """
+    err, status = _require_bearer_or_401()
+    if err:
+        return err, status
+    if not template_analysis_cache:
+        return jsonify({'success': True, 'invalidated': 0})
+
+    data = request.get_json(silent=True) or {}
+    template_sha256 = data.get('template_sha256')
+    if data.get('template_path'):
+        if not os.path.exists(data['template_path']):
+            return jsonify({'error': f"Template not found: {data['template_path']}"}), 404
+        template_sha256 = file_sha256(data['template_path'])
+    invalidated = template_analysis_cache.invalidate(template_sha256)
+    template_catalog.invalidate()
+    return jsonify({'success': True, 'invalidated': invalidated, 'template_sha256': template_sha256})
 
 
 @app.route('/api/templates/upload-and-analyze', methods=['POST'])
@@ -684,6 +1856,9 @@ def upload_and_analyze_template():
     - template: Fichier .indt ou .indd
     - name: Nom du template (optionnel, déduit du fichier)
     
+    Le fichier est haché pendant l'upload et rangé par contenu : ré-uploader
+    les mêmes octets ne réécrit rien et réutilise l'analyse en cache.
+    
     Retourne les métadonnées et la miniature uploadée vers Supabase.
     """
     try:
@@ -691,6 +1866,12 @@ def upload_and_analyze_template():
         err, status = _require_bearer_or_401()
         if err:
             return err, status
+        priority, error = _requested_priority()
+        if error:
+            return error
+        deadline_at, error = _request_deadline()
+        if error:
+            return error
         
         if 'template' not in request.files:
             return jsonify({'error': 'No template file provided'}), 400
@@ -702,66 +1883,50 @@ def upload_and_analyze_template():
         # Valider l'extension
         filename = secure_filename(template_file.filename)
         ext = os.path.splitext(filename)[1].lower()
-        if ext not in ['.indt', '.indd']:
+        if ext not in TEMPLATE_EXTENSIONS:
             return jsonify({'error': 'Only .indt and .indd files are allowed'}), 400
         
-        # Sauvegarder le fichier temporairement
-        templates_dir = os.path.join(os.getcwd(), 'indesign_templates')
-        os.makedirs(templates_dir, exist_ok=True)
-        
-        template_path = os.path.join(templates_dir, filename)
-        template_file.save(template_path)
-        
-        print(f'[TemplateUpload] Saved template to: {template_path}')
-        
-        # Configurer l'analyse
-        analysis_dir = os.path.join(os.getcwd(), 'analysis')
-        os.makedirs(analysis_dir, exist_ok=True)
-        
-        thumbnails_dir = os.path.join(os.getcwd(), 'thumbnails')
-        os.makedirs(thumbnails_dir, exist_ok=True)
-        
-        config = {
-            'template_path': template_path,
-            'output_dir': thumbnails_dir + '/',
-            'thumbnail_width': 800,
-            'thumbnail_height': 600
-        }
-        
-        config_path = os.path.join(analysis_dir, 'config.json')
-        with open(config_path, 'w', encoding='utf-8') as f:
-            json.dump(config, f, ensure_ascii=False, indent=2)
-        
-        # Exécuter l'analyse
-        script_path = os.path.join(os.getcwd(), 'scripts', 'analyze_and_thumbnail.jsx')
-        result = execute_analysis_script(script_path, config_path)
-        
-        if not result['success']:
-            return jsonify({
-                'success': False,
-                'error': result.get('error', 'Analysis script failed'),
-                'template_path': template_path
-            }), 500
-        
-        # Lire les résultats
-        results_path = os.path.join(analysis_dir, 'results.json')
-        if not os.path.exists(results_path):
-            return jsonify({
-                'success': False,
-                'error': 'Analysis results not found',
-                'template_path': template_path
-            }), 500
+        # Le flux a normalement déjà été haché pendant le parsing multipart
+        upload = template_file.stream
+        if not hasattr(upload, 'sha256'):
+            upload = template_store.new_upload()
+            shutil.copyfileobj(template_file.stream, upload)
+        try:
+            stored = template_store.put(filename, upload)
+        finally:
+            upload.close()
+        template_catalog.invalidate()
+        template_path = os.path.abspath(stored['path'])
         
-        with open(results_path, 'r', encoding='utf-8') as f:
-            analysis_results = json.load(f)
+        logger.info('Template %s v%s %s', filename, stored['version'],
+                    'inchangé' if stored['unchanged'] else 'enregistré',
+                    extra={'sha256': stored['sha256'], 'path': template_path, 'deduplicated': not stored['stored']})
         
-        if not analysis_results.get('success'):
-            return jsonify({
+        # Analyse instantanée si ces octets ont déjà été analysés, sinon en job
+        analysis = cached_template_analysis(template_path, 800, 600, template_sha256=stored['sha256'])
+        if not analysis:
+            rejected = _admission_rejection('analysis', priority)
+            if rejected:
+                return rejected
+            analysis, error = _run_analysis_in_queue({
+                'template_path': template_path,
+                'thumbnail_width': 800,
+                'thumbnail_height': 600,
+                'force': False,
+                'template_sha256': stored['sha256']
+            }, priority, deadline_at)
+            if error:
+                return error
+        if not analysis['success']:
+            response = {
                 'success': False,
-                'error': 'Analysis failed',
-                'details': analysis_results.get('errors', []),
+                'error': analysis['error'],
                 'template_path': template_path
-            }), 500
+            }
+            if 'details' in analysis:
+                response['details'] = analysis['details']
+            return jsonify(response), 500
+        analysis_results = analysis['results']
         
         # Préparer la réponse
         template_info = analysis_results.get('template', {})
@@ -782,9 +1947,14 @@ def upload_and_analyze_template():
                 'colors': template_info.get('colors', []),
                 'page_count': template_info.get('page_count', 1),
                 'width': template_info.get('width', 0),
-                'height': template_info.get('height', 0)
+                'height': template_info.get('height', 0),
+                'units': template_info.get('units')
             },
-            'thumbnail': thumbnail_info
+            'thumbnail': thumbnail_info,
+            'cached': analysis['cached'],
+            'template_sha256': analysis['template_sha256'],
+            'version': stored['version'],
+            'deduplicated': not stored['stored']
         }
         
         return jsonify(response_data)
@@ -795,15 +1965,37 @@ def upload_and_analyze_template():
 
 @app.route('/api/thumbnails/<filename>')
 def serve_thumbnail(filename):
-    """Sert les fichiers de miniatures générés"""
+    """
+    Sert les miniatures générés.
+
+    ?size=small|medium|full et ?format=jpg|webp sélectionnent une variante
+    (ignorés pour les miniatures historiques dans un autre format, servies telles quelles).
+    Les noms adressés par contenu (<stem>.<hash>...) sont immuables et mis en
+    cache un an ; les noms historiques sont revalidés via ETag (304).
+    Les requêtes Range sont supportées.
+    """
     try:
-        thumbnails_dir = os.path.join(os.getcwd(), 'thumbnails')
-        filepath = os.path.join(thumbnails_dir, secure_filename(filename))
-        
-        if not os.path.exists(filepath):
+        size = request.args.get('size', 'full')
+        ext = request.args.get('format')
+        if ext == 'jpeg':
+            ext = 'jpg'
+        if size not in THUMBNAIL_SIZES or (ext and ext not in THUMBNAIL_FORMATS):
+            return jsonify({'error': 'Invalid size or format'}), 400
+
+        resolved = thumbnail_variants.resolve(secure_filename(filename), size, ext)
+        if not resolved:
             return jsonify({'error': 'Thumbnail not found'}), 404
-        
-        return send_file(filepath, mimetype='image/jpeg')
+        filepath, etag, immutable = resolved
+
+        # Autres extensions : type deviné par send_file (mimetypes)
+        served_ext = os.path.splitext(filepath)[1].lstrip('.').lower()
+        mimetype = THUMBNAIL_FORMATS[served_ext][1] if served_ext in THUMBNAIL_FORMATS else None
+        response = send_file(filepath, mimetype=mimetype, conditional=True, etag=etag)
+        if immutable:
+            response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+        else:
+            response.headers['Cache-Control'] = 'no-cache'
+        return response
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
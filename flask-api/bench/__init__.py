@@ -0,0 +1 @@
+"""Benchmarks de l'API Flask (renderer fake, serveur d'images local)."""
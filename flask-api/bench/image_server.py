@@ -0,0 +1,95 @@
+"""
+Serveur HTTP local d'images de test pour les benchmarks.
+
+Les JPEG sont générés une fois en mémoire (Pillow) puis servis pour toute
+URL `/images/<nom>.jpg` : le nom (et la query string) choisit l'image de
+façon déterministe. ETag et `If-None-Match` sont gérés comme par un CDN,
+et une latence par requête peut être simulée.
+"""
+import hashlib
+import io
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from PIL import Image
+
+
+def generate_jpegs(count=4, size=(1600, 1200), quality=85):
+    """`count` JPEG distincts (dégradés de couleurs différentes), en octets."""
+    width, height = size
+    images = []
+    for index in range(count):
+        base = (index * 67 % 256, index * 131 % 256, index * 197 % 256)
+        image = Image.new('RGB', (width, height), base)
+        # Un dégradé plutôt qu'un aplat : taille de fichier réaliste
+        gradient = Image.linear_gradient('L').resize((width, height))
+        image = Image.composite(image, Image.new('RGB', (width, height), (255, 255, 255)), gradient)
+        buffer = io.BytesIO()
+        image.save(buffer, 'JPEG', quality=quality)
+        images.append(buffer.getvalue())
+    return images
+
+
+class ImageServer:
+    """ThreadingHTTPServer sur 127.0.0.1, démarré dans un thread démon."""
+
+    def __init__(self, images, latency=0.0, host='127.0.0.1', port=0):
+        self.images = [(data, '"%s"' % hashlib.sha256(data).hexdigest()[:16]) for data in images]
+        self.latency = latency
+        self.requests = 0
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer((host, port), self._handler_class())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def base_url(self):
+        host, port = self._server.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def url(self, name):
+        return f'{self.base_url}/images/{name}.jpg'
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, name='bench-images', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def _handler_class(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                with server._lock:
+                    server.requests += 1
+                if server.latency:
+                    time.sleep(server.latency)
+                if not self.path.startswith('/images/'):
+                    self.send_error(404)
+                    return
+                index = int(hashlib.md5(self.path.encode('utf-8')).hexdigest(), 16) % len(server.images)
+                data, etag = server.images[index]
+                if self.headers.get('If-None-Match') == etag:
+                    self.send_response(304)
+                    self.send_header('ETag', etag)
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+                self.send_response(200)
+                self.send_header('Content-Type', 'image/jpeg')
+                self.send_header('Content-Length', str(len(data)))
+                self.send_header('ETag', etag)
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
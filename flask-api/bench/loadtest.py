@@ -0,0 +1,420 @@
+"""
+Benchmark / test de charge de l'API Flask, sans InDesign.
+
+Par défaut l'application est chargée dans ce processus, dans un dossier de
+travail temporaire, avec le backend de rendu `fake` (latence configurable)
+et un appel OpenAI simulé ; les images d'URL sont servies par un serveur
+HTTP local. Tout le reste du chemin (téléchargements, préparation des
+images, caches, jobs, écriture de config, pool de renderers) est réel.
+
+    cd flask-api
+    python -m bench.loadtest --requests 100 --concurrency 8 --output bench.json
+
+Avec `--url`, les requêtes visent un serveur déjà lancé (par exemple gunicorn
+avec RENDERER_BACKEND=fake) ; il doit tourner sur la même machine pour lire
+les templates et joindre le serveur d'images.
+
+Le rapport JSON donne, par scénario : débit (req/s), latences p50/p95/p99,
+et la répartition par étape (timings des jobs et delta de /metrics).
+`--baseline` compare le p95 à un rapport précédent et sort en erreur au-delà
+de `--max-regression`.
+"""
+import argparse
+import io
+import json
+import os
+import re
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+from bench.image_server import ImageServer, generate_jpegs
+
+SCENARIOS = ('create-layout', 'create-layout-urls', 'analyze', 'thumbnails')
+JOB_FINISHED = ('done', 'failed', 'cancelled')
+
+_STAGE_METRIC = re.compile(
+    r'^magflow_stage_duration_seconds_(sum|count)\{pipeline="([^"]*)",stage="([^"]*)"\} (\S+)$'
+)
+
+
+def percentile(sorted_values, q):
+    """Percentile par interpolation linéaire (q entre 0 et 100)."""
+    if not sorted_values:
+        return None
+    rank = (len(sorted_values) - 1) * q / 100.0
+    low = int(rank)
+    high = min(low + 1, len(sorted_values) - 1)
+    return sorted_values[low] + (sorted_values[high] - sorted_values[low]) * (rank - low)
+
+
+def summarize(values, scale=1000.0):
+    """p50/p95/p99/moyenne/min/max (en ms par défaut) d'une liste de durées en secondes."""
+    values = sorted(v * scale for v in values)
+    if not values:
+        return None
+    return {
+        'count': len(values),
+        'p50': round(percentile(values, 50), 2),
+        'p95': round(percentile(values, 95), 2),
+        'p99': round(percentile(values, 99), 2),
+        'mean': round(sum(values) / len(values), 2),
+        'min': round(values[0], 2),
+        'max': round(values[-1], 2)
+    }
+
+
+# ============================================
+# CLIENTS (application en processus ou serveur HTTP)
+# ============================================
+
+class InProcessClient:
+    """Client de test Flask, un par thread."""
+
+    def __init__(self, flask_app):
+        self.flask_app = flask_app
+        self._local = threading.local()
+
+    def request(self, method, path, json_body=None, form=None, files=None):
+        client = getattr(self._local, 'client', None)
+        if client is None:
+            client = self._local.client = self.flask_app.test_client()
+        data = dict(form or {})
+        for field, entries in (files or {}).items():
+            data[field] = [(io.BytesIO(content), filename) for filename, content in entries]
+        response = client.open(path, method=method, json=json_body, data=data or None)
+        return response.status_code, response.get_json(silent=True), response.get_data()
+
+
+class HttpClient:
+    """Session requests (pool de connexions) par thread vers `base_url`."""
+
+    def __init__(self, base_url, token=None, timeout=300):
+        import requests
+        self._requests = requests
+        self.base_url = base_url.rstrip('/')
+        self.headers = {'Authorization': f'Bearer {token}'} if token else {}
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def request(self, method, path, json_body=None, form=None, files=None):
+        session = getattr(self._local, 'session', None)
+        if session is None:
+            session = self._local.session = self._requests.Session()
+            session.headers.update(self.headers)
+        multipart = [(field, entry) for field, entries in (files or {}).items() for entry in entries]
+        response = session.request(method, self.base_url + path, json=json_body, data=form,
+                                   files=multipart or None, timeout=self.timeout)
+        try:
+            body = response.json()
+        except ValueError:
+            body = None
+        return response.status_code, body, response.content
+
+
+# ============================================
+# SCÉNARIOS
+# ============================================
+
+class Bench:
+    """Exécute les scénarios et agrège les mesures."""
+
+    def __init__(self, client, image_server, images, args, workdir):
+        self.client = client
+        self.image_server = image_server
+        self.images = images
+        self.args = args
+        self.workdir = workdir
+        self.thumbnail_path = None
+
+    def _unique(self, index):
+        # Contenus distincts par requête : ni coalescence, ni cache de rendu
+        return 'repeat' if self.args.repeat else f'{index}-{uuid.uuid4().hex[:8]}'
+
+    def _wait_for_job(self, job_id):
+        deadline = time.monotonic() + self.args.timeout
+        while time.monotonic() < deadline:
+            status, job, _ = self.client.request('GET', f'/api/jobs/{job_id}')
+            if status == 200 and job['state'] in JOB_FINISHED:
+                return job
+            time.sleep(self.args.poll)
+        raise TimeoutError(f'job {job_id} non terminé après {self.args.timeout} s')
+
+    def _run_job(self, status, body):
+        if status not in (200, 202) or not body or 'job_id' not in body:
+            raise RuntimeError(f'HTTP {status}: {(body or {}).get("error")}')
+        job = self._wait_for_job(body['job_id'])
+        if job['state'] != 'done':
+            raise RuntimeError(f'job {job["state"]}: {job.get("error")}')
+        stages = dict((job.get('result') or {}).get('timings') or {})
+        stages['queue'] = job['timings']['queue_seconds']
+        return stages
+
+    def create_layout(self, index):
+        tag = self._unique(index)
+        files = {'images': [(f'image_{i}.jpg', self.images[(index + i) % len(self.images)] + tag.encode())
+                            for i in range(self.args.images)]}
+        started = time.monotonic()
+        status, body, _ = self.client.request('POST', '/api/create-layout', form={
+            'prompt': f'Article de benchmark {tag}',
+            'text_content': 'Lorem ipsum dolor sit amet. ' * 40,
+            'template': self.args.template
+        }, files=files)
+        submit = time.monotonic() - started
+        return submit, self._run_job(status, body)
+
+    def create_layout_urls(self, index):
+        tag = self._unique(index)
+        urls = [f'{self.image_server.url(f"img{i}")}?r={tag}' for i in range(self.args.images)]
+        started = time.monotonic()
+        status, body, _ = self.client.request('POST', '/api/create-layout-urls', json_body={
+            'prompt': f'Article de benchmark {tag}',
+            'text_content': 'Lorem ipsum dolor sit amet. ' * 40,
+            'template': self.args.template,
+            'image_urls': urls
+        })
+        submit = time.monotonic() - started
+        return submit, self._run_job(status, body)
+
+    def _template_file(self, tag):
+        path = os.path.join(self.workdir, 'bench_templates', f'bench_{tag}.indt')
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if not os.path.exists(path):
+            # Écriture puis rename : en mode --repeat plusieurs threads créent le même fichier
+            tmp_path = f'{path}.{threading.get_ident()}.tmp'
+            with open(tmp_path, 'wb') as f:
+                f.write(b'MAGFLOW-BENCH-TEMPLATE ' + tag.encode() + b'\0' * 64 * 1024)
+            os.replace(tmp_path, path)
+        return os.path.abspath(path)
+
+    def analyze(self, index):
+        status, body, _ = self.client.request('POST', '/api/templates/analyze', json_body={
+            'template_path': self._template_file(self._unique(index)),
+            'thumbnail_width': 800,
+            'thumbnail_height': 600
+        })
+        if status != 200 or not (body or {}).get('success'):
+            raise RuntimeError(f'HTTP {status}: {(body or {}).get("error")}')
+        return None, {}
+
+    def setup_thumbnails(self):
+        status, body, _ = self.client.request('POST', '/api/templates/analyze', json_body={
+            'template_path': self._template_file('thumbnails')
+        })
+        thumbnail = (body or {}).get('thumbnail') or {}
+        if status != 200 or not thumbnail.get('filename'):
+            raise RuntimeError(f'analyse préalable échouée (HTTP {status})')
+        self.thumbnail_path = f"/api/thumbnails/{thumbnail['filename']}"
+
+    def thumbnails(self, index):
+        size, fmt = (('small', 'webp'), ('medium', 'jpg'), ('full', 'jpg'))[index % 3]
+        status, _, content = self.client.request('GET', f'{self.thumbnail_path}?size={size}&format={fmt}')
+        if status != 200 or not content:
+            raise RuntimeError(f'HTTP {status}')
+        return None, {}
+
+    def run_scenario(self, name):
+        action = getattr(self, name.replace('-', '_'))
+        if name == 'thumbnails' and not self.thumbnail_path:
+            self.setup_thumbnails()
+        metrics_before = self.stage_metrics()
+        latencies, submits, errors = [], [], []
+        stages = {}
+        lock = threading.Lock()
+
+        def one(index):
+            started = time.monotonic()
+            try:
+                submit, stage_timings = action(index)
+            except Exception as e:
+                with lock:
+                    errors.append(str(e))
+                return
+            elapsed = time.monotonic() - started
+            with lock:
+                latencies.append(elapsed)
+                if submit is not None:
+                    submits.append(submit)
+                for stage, seconds in stage_timings.items():
+                    if isinstance(seconds, (int, float)):
+                        stages.setdefault(stage, []).append(seconds)
+
+        wall_started = time.monotonic()
+        with ThreadPoolExecutor(max_workers=self.args.concurrency) as pool:
+            list(pool.map(one, range(self.args.requests)))
+        wall = time.monotonic() - wall_started
+
+        return {
+            'requests': self.args.requests,
+            'ok': len(latencies),
+            'errors': len(errors),
+            'error_samples': sorted(set(errors))[:5],
+            'wall_seconds': round(wall, 3),
+            'rps': round(len(latencies) / wall, 2) if wall else None,
+            'latency_ms': summarize(latencies),
+            'submit_latency_ms': summarize(submits),
+            'stages_ms': {stage: summarize(values) for stage, values in sorted(stages.items())},
+            'metrics_stages': self.metrics_delta(metrics_before, self.stage_metrics())
+        }
+
+    def stage_metrics(self):
+        """{(pipeline, étape): [somme, nombre]} lus sur /metrics (vide si désactivé)."""
+        try:
+            status, _, content = self.client.request('GET', '/metrics')
+        except Exception:
+            return {}
+        if status != 200:
+            return {}
+        totals = {}
+        for line in content.decode('utf-8').splitlines():
+            match = _STAGE_METRIC.match(line)
+            if match:
+                kind, pipeline, stage, value = match.groups()
+                totals.setdefault((pipeline, stage), [0.0, 0])[0 if kind == 'sum' else 1] = float(value)
+        return totals
+
+    @staticmethod
+    def metrics_delta(before, after):
+        delta = {}
+        for (pipeline, stage), (total, count) in sorted(after.items()):
+            prev_total, prev_count = before.get((pipeline, stage), (0.0, 0))
+            if count > prev_count:
+                delta[f'{pipeline}/{stage}'] = {
+                    'count': int(count - prev_count),
+                    'mean_ms': round((total - prev_total) / (count - prev_count) * 1000, 2)
+                }
+        return delta
+
+
+# ============================================
+# MISE EN PLACE ET RAPPORT
+# ============================================
+
+def load_app_in_process(args, workdir):
+    """Importe app.py dans un dossier de travail temporaire, backend `fake`."""
+    api_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    os.symlink(os.path.join(api_dir, 'scripts'), os.path.join(workdir, 'scripts'))
+    os.makedirs(os.path.join(workdir, 'thumbnails'))
+    os.chdir(workdir)
+    os.environ.update({
+        'RENDERER_BACKEND': 'fake',
+        'FAKE_RENDER_LATENCY': str(args.render_latency),
+        'FAKE_RENDER_JITTER': str(args.render_jitter),
+        'RENDERER_POOL_SIZE': str(args.pool_size),
+        'JOB_WORKERS': str(args.job_workers),
+        'OPENAI_API_KEY': 'bench'
+    })
+    os.environ.pop('API_TOKEN', None)
+    os.environ.pop('API_TOKENS', None)
+    os.environ.setdefault('LOG_LEVEL', 'WARNING')
+    if api_dir not in sys.path:
+        sys.path.insert(0, api_dir)
+    import app as app_module
+
+    def fake_ai_layout(api_key, prompt, text_content, image_count):
+        time.sleep(args.ai_latency)
+        return {'title_text': prompt[:60]}
+
+    app_module._request_ai_layout = fake_ai_layout
+    return app_module
+
+
+def compare_to_baseline(report, baseline, max_regression):
+    """Scénarios dont le p95 dépasse celui de la référence de plus de max_regression."""
+    regressions = []
+    for name, result in report['scenarios'].items():
+        reference = (baseline.get('scenarios') or {}).get(name)
+        if not reference or not reference.get('latency_ms') or not result.get('latency_ms'):
+            continue
+        before, after = reference['latency_ms']['p95'], result['latency_ms']['p95']
+        if before and after > before * (1 + max_regression):
+            regressions.append({'scenario': name, 'p95_before_ms': before, 'p95_after_ms': after,
+                                'ratio': round(after / before, 3)})
+    return regressions
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark MagFlow Flask API (renderer fake)')
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS),
+                        help=f'Liste séparée par des virgules parmi {", ".join(SCENARIOS)}')
+    parser.add_argument('--requests', type=int, default=50, help='Requêtes par scénario')
+    parser.add_argument('--concurrency', type=int, default=8, help='Clients simultanés')
+    parser.add_argument('--url', help='Serveur à tester (sinon application chargée en processus)')
+    parser.add_argument('--token', default=os.getenv('API_TOKEN'), help='Bearer token pour --url')
+    parser.add_argument('--render-latency', type=float, default=0.5, help='Latence du renderer fake (s)')
+    parser.add_argument('--render-jitter', type=float, default=0.2, help='Variation relative de cette latence')
+    parser.add_argument('--pool-size', type=int, default=2, help='RENDERER_POOL_SIZE')
+    parser.add_argument('--job-workers', type=int, default=2, help='JOB_WORKERS')
+    parser.add_argument('--ai-latency', type=float, default=0.3, help='Latence simulée de l\'appel OpenAI (s)')
+    parser.add_argument('--images', type=int, default=2, help='Images par mise en page')
+    parser.add_argument('--image-size', default='1600x1200', help='Dimensions des images de test')
+    parser.add_argument('--image-latency', type=float, default=0.0, help='Latence du serveur d\'images (s)')
+    parser.add_argument('--template', default='default', help='Template des mises en page')
+    parser.add_argument('--repeat', action='store_true',
+                        help='Requêtes identiques (mesure coalescence et caches)')
+    parser.add_argument('--poll', type=float, default=0.05, help='Intervalle de suivi des jobs (s)')
+    parser.add_argument('--timeout', type=float, default=300, help='Attente max d\'un job (s)')
+    parser.add_argument('--output', help='Fichier du rapport JSON (sinon stdout)')
+    parser.add_argument('--baseline', help='Rapport de référence pour détecter les régressions')
+    parser.add_argument('--max-regression', type=float, default=0.2, help='Hausse de p95 tolérée (0.2 = 20 %%)')
+    parser.add_argument('--keep-workdir', action='store_true', help='Conserver le dossier de travail')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    scenarios = [s.strip() for s in args.scenarios.split(',') if s.strip()]
+    unknown = [s for s in scenarios if s not in SCENARIOS]
+    if unknown:
+        sys.exit(f'Scénario inconnu: {", ".join(unknown)}')
+
+    width, height = (int(v) for v in args.image_size.lower().split('x'))
+    images = generate_jpegs(size=(width, height))
+    image_server = ImageServer(images, latency=args.image_latency).start()
+    workdir = tempfile.mkdtemp(prefix='magflow-bench-')
+    cwd = os.getcwd()
+    try:
+        if args.url:
+            client = HttpClient(args.url, token=args.token, timeout=args.timeout)
+        else:
+            client = InProcessClient(load_app_in_process(args, workdir).app)
+
+        bench = Bench(client, image_server, images, args, workdir)
+        report = {
+            'started_at': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+            'target': args.url or 'in-process',
+            'config': {key: value for key, value in vars(args).items()
+                       if key not in ('token', 'output', 'baseline', 'keep_workdir')},
+            'scenarios': {}
+        }
+        for name in scenarios:
+            report['scenarios'][name] = bench.run_scenario(name)
+        report['image_server_requests'] = image_server.requests
+    finally:
+        image_server.stop()
+        os.chdir(cwd)
+        if not args.keep_workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    exit_code = 0
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            report['regressions'] = compare_to_baseline(report, json.load(f), args.max_regression)
+        exit_code = 1 if report['regressions'] else 0
+
+    output = json.dumps(report, indent=2, ensure_ascii=False)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+    return exit_code
+
+
+if __name__ == '__main__':
+    sys.exit(main())
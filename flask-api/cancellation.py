@@ -0,0 +1,109 @@
+"""
+Annulation et échéances des jobs.
+
+Un job en cours d'exécution tourne dans une CancelScope, accessible partout
+dans son contexte (threads de l'IA compris, via contextvars) :
+
+- `scope.budget(plafond)` : temps restant avant l'échéance, borné par le
+  timeout propre à l'étape ; lève DeadlineExceeded si elle est dépassée et
+  JobCancelled si le job a été annulé. Chaque étape (téléchargement, IA,
+  rendu) ne dispose ainsi que du budget restant ;
+- `scope.on_cancel(callback)` : enregistre une action (tuer le processus
+  osascript) déclenchée dès l'annulation, ou à l'échéance ;
+- `scope.wait(secondes)` : attente interrompue par l'annulation.
+
+Hors job (requête synchrone sans échéance), current_scope() retourne une
+scope sans échéance qui n'est jamais annulée.
+"""
+import contextvars
+import threading
+import time
+from contextlib import contextmanager
+
+CANCEL_REQUESTED = 'cancelled'
+DEADLINE_EXCEEDED = 'deadline'
+
+
+class JobCancelled(Exception):
+    """Le job a été annulé (DELETE /api/jobs/<id>)."""
+
+
+class DeadlineExceeded(JobCancelled, TimeoutError):
+    """L'échéance du job (X-Deadline-Seconds) est dépassée."""
+
+
+class CancelScope:
+    """Jeton d'annulation d'un job, avec échéance optionnelle (timestamp epoch)."""
+
+    def __init__(self, deadline=None):
+        self.deadline = deadline
+        self.reason = None
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._callbacks = []
+
+    @property
+    def cancelled(self):
+        return self._event.is_set()
+
+    @property
+    def expired(self):
+        return self.deadline is not None and time.time() >= self.deadline
+
+    def cancel(self, reason=CANCEL_REQUESTED):
+        """Annule la scope et déclenche les callbacks enregistrés (une seule fois)."""
+        with self._lock:
+            if self._event.is_set():
+                return
+            self.reason = reason
+            self._event.set()
+            callbacks = list(self._callbacks)
+        for callback in callbacks:
+            callback()
+
+    def check(self):
+        if self.cancelled and self.reason != DEADLINE_EXCEEDED:
+            raise JobCancelled('Job annulé')
+        if self.cancelled or self.expired:
+            raise DeadlineExceeded('Échéance du job dépassée')
+
+    def remaining(self):
+        """Secondes avant l'échéance (None sans échéance)."""
+        return None if self.deadline is None else self.deadline - time.time()
+
+    def budget(self, limit=None):
+        """Temps accordé à une étape : `limit` (None : illimité) borné par le temps restant."""
+        self.check()
+        remaining = self.remaining()
+        if remaining is None:
+            return limit
+        return remaining if limit is None else min(limit, remaining)
+
+    def wait(self, seconds):
+        """Attend `seconds` ; True si la scope a été annulée entre-temps."""
+        return self._event.wait(seconds)
+
+    @contextmanager
+    def on_cancel(self, callback):
+        """Pendant le bloc, `callback()` est appelé dès l'annulation (tout de
+        suite si elle a déjà eu lieu)."""
+        with self._lock:
+            already = self._event.is_set()
+            if not already:
+                self._callbacks.append(callback)
+        if already:
+            callback()
+        try:
+            yield
+        finally:
+            with self._lock:
+                if callback in self._callbacks:
+                    self._callbacks.remove(callback)
+
+
+cancel_scope_var = contextvars.ContextVar('cancel_scope', default=None)
+
+
+def current_scope():
+    """Scope du job (ou de la requête) courant ; à défaut une scope inerte."""
+    return cancel_scope_var.get() or CancelScope()
@@ -0,0 +1,211 @@
+"""
+Téléchargement parallèle des images de create-layout-urls.
+
+Une session requests partagée (pool de connexions keep-alive) est utilisée
+par un pool de threads ; le nombre de téléchargements simultanés par hôte
+est plafonné, chaque image a droit à quelques tentatives avec backoff, et
+l'ensemble est borné par une deadline globale.
+
+Chaque réponse est écrite par morceaux dans un fichier temporaire puis
+renommée atomiquement : la mémoire reste constante quelle que soit la taille
+de l'image, et le format est déterminé par les premiers octets.
+"""
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from image_cache import link_or_copy
+
+# Signatures (magic numbers) des formats acceptés
+MAGIC_NUMBERS = (
+    (b'\xff\xd8\xff', 'jpg'),
+    (b'\x89PNG\r\n\x1a\n', 'png'),
+    (b'GIF87a', 'gif'),
+    (b'GIF89a', 'gif'),
+    (b'II*\x00', 'tiff'),
+    (b'MM\x00*', 'tiff'),
+    (b'8BPS', 'psd'),
+)
+SNIFF_BYTES = 16
+CHUNK_SIZE = 64 * 1024
+
+
+def sniff_image_extension(head):
+    """Extension déduite des premiers octets d'un fichier, ou None."""
+    for magic, ext in MAGIC_NUMBERS:
+        if head.startswith(magic):
+            return ext
+    return None
+
+
+# Codes HTTP pour lesquels une nouvelle tentative a du sens
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+
+class DownloadError(Exception):
+    """Échec définitif (pas de nouvelle tentative)."""
+
+
+class ImageDownloader:
+    """Télécharge une liste d'URLs en parallèle en conservant l'ordre d'entrée."""
+
+    def __init__(self, allowed_extensions, max_workers=8, per_host=4, timeout=20,
+                 retries=2, backoff=0.5, deadline=60, max_bytes=100 * 1024 * 1024, cache=None):
+        self.allowed_extensions = set(allowed_extensions)
+        self.max_bytes = max_bytes
+        self.cache = cache
+        self.per_host = per_host
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.deadline = deadline
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='magflow-download')
+        self._host_slots = {}
+        self._host_lock = threading.Lock()
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=max_workers, pool_maxsize=max_workers)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def _host_slot(self, url):
+        host = urlparse(url).netloc
+        with self._host_lock:
+            if host not in self._host_slots:
+                self._host_slots[host] = threading.BoundedSemaphore(self.per_host)
+            return self._host_slots[host]
+
+    def download(self, urls, dest_folder, deadline=None):
+        """Retourne un rapport par URL, dans l'ordre de `urls`. `deadline` (s)
+        réduit la deadline globale au budget restant du job appelant.
+
+        Chaque rapport : {index, url, ok, path, error, attempts, duration_ms, cache}.
+        """
+        os.makedirs(dest_folder, exist_ok=True)
+        expires_at = time.monotonic() + (self.deadline if deadline is None else min(self.deadline, deadline))
+        futures = [
+            self._executor.submit(self._download_one, i, url, dest_folder, expires_at)
+            for i, url in enumerate(urls)
+        ]
+        return [f.result() for f in futures]
+
+    def _download_one(self, index, url, dest_folder, expires_at):
+        started = time.monotonic()
+        report = {'index': index, 'url': url, 'ok': False, 'path': None, 'error': None, 'attempts': 0, 'cache': None}
+        slot = self._host_slot(url)
+        for attempt in range(self.retries + 1):
+            remaining = expires_at - time.monotonic()
+            if remaining <= 0:
+                report['error'] = 'Deadline de téléchargement dépassée'
+                break
+            if not slot.acquire(timeout=remaining):
+                report['error'] = 'Deadline de téléchargement dépassée'
+                break
+            report['attempts'] = attempt + 1
+            try:
+                try:
+                    report['path'], report['cache'] = self._fetch(index, url, dest_folder, min(self.timeout, remaining))
+                except requests.RequestException:
+                    raise
+                except OSError as e:
+                    # Blob du cache évincé entre lookup et lien, .part impossible à
+                    # écrire ou renommer : nouveau GET complet, sans passer par le cache
+                    report['error'] = str(e)
+                    remaining = expires_at - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    report['path'], report['cache'] = self._fetch(index, url, dest_folder,
+                                                                  min(self.timeout, remaining), use_cache=False)
+                report['ok'] = True
+                report['error'] = None
+                break
+            except DownloadError as e:
+                report['error'] = str(e)
+                break
+            except requests.RequestException as e:
+                report['error'] = str(e)
+            except OSError as e:
+                report['error'] = str(e)
+                break
+            finally:
+                slot.release()
+            delay = self.backoff * (2 ** attempt)
+            if time.monotonic() + delay >= expires_at:
+                break
+            time.sleep(delay)
+        report['duration_ms'] = round((time.monotonic() - started) * 1000, 1)
+        return report
+
+    def _fetch(self, index, url, dest_folder, timeout, use_cache=True):
+        """Télécharge une URL. Retourne (chemin local, statut cache)."""
+        cache = self.cache if use_cache else None
+        entry = cache.lookup(url) if cache else None
+        headers = cache.conditional_headers(entry) if entry else {}
+        if headers:
+            cache.record('revalidations')
+        with self.session.get(url, stream=True, timeout=timeout, headers=headers) as r:
+            if r.status_code == 304 and entry:
+                filepath = os.path.join(dest_folder, f"image_{index+1}.{entry['ext']}")
+                link_or_copy(cache.touch(entry), filepath)
+                return filepath, 'hit'
+            if r.status_code in RETRY_STATUS_CODES:
+                r.raise_for_status()
+            if r.status_code >= 400:
+                raise DownloadError(f'HTTP {r.status_code} pour {url}')
+            declared = r.headers.get('Content-Length')
+            if declared and declared.isdigit() and int(declared) > self.max_bytes:
+                raise DownloadError(f'Image trop volumineuse ({declared} octets) pour {url}')
+
+            tmp_path = cache.new_temp_path('.part') if cache else \
+                os.path.join(dest_folder, f'.image_{index+1}.part')
+            try:
+                ext = self._stream_to_file(r, url, tmp_path)
+                if cache:
+                    blob = cache.store(url, tmp_path, ext,
+                                            etag=r.headers.get('ETag'),
+                                            last_modified=r.headers.get('Last-Modified'))
+                    filepath = os.path.join(dest_folder, f"image_{index+1}.{ext}")
+                    link_or_copy(blob, filepath)
+                    return filepath, 'miss'
+                filepath = os.path.join(dest_folder, f"image_{index+1}.{ext}")
+                os.replace(tmp_path, filepath)
+                return filepath, None
+            finally:
+                if os.path.exists(tmp_path):
+                    os.unlink(tmp_path)
+
+    def _stream_to_file(self, r, url, tmp_path):
+        """Écrit la réponse par morceaux dans tmp_path, sans jamais la bufferiser
+        en entier. Le format est déduit des premiers octets. Retourne l'extension."""
+        ext = None
+        head = b''
+        written = 0
+        with open(tmp_path, 'wb') as f:
+            for chunk in r.iter_content(chunk_size=CHUNK_SIZE):
+                if not chunk:
+                    continue
+                written += len(chunk)
+                if written > self.max_bytes:
+                    raise DownloadError(f'Image trop volumineuse (> {self.max_bytes} octets) pour {url}')
+                if ext is None:
+                    head += chunk
+                    if len(head) < SNIFF_BYTES:
+                        continue
+                    ext = self._sniff(head, url)
+                    chunk, head = head, b''
+                f.write(chunk)
+            if ext is None:
+                # Fichier plus court que SNIFF_BYTES
+                ext = self._sniff(head, url)
+                f.write(head)
+        return ext
+
+    def _sniff(self, head, url):
+        ext = sniff_image_extension(head)
+        if not ext or ext not in self.allowed_extensions:
+            raise DownloadError(f"Type de fichier non supporté pour {url}")
+        return ext
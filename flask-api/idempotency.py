@@ -0,0 +1,159 @@
+"""
+Déduplication des demandes de mise en page (Idempotency-Key et coalescence).
+
+Une demande est identifiée par l'empreinte de sa configuration normalisée
+(prompt, texte, sous-titre, template, URLs ou contenu des images, client
+d'API : deux clients ne partagent jamais un job) et, si le
+client en fournit un, par son header `Idempotency-Key`. Tant qu'un job pour
+la même demande est en cours, les demandes identiques s'y rattachent ; une
+fois terminé avec succès, son `output_file` est renvoyé pendant `window`
+secondes. Un job en échec libère la demande : le retry relance un rendu.
+
+Stockage SQLite (mode WAL), partagé entre les workers gunicorn : la
+réservation se fait sous verrou d'écriture, deux workers ne peuvent pas
+lancer le même rendu.
+"""
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+STATE_PENDING = 'pending'
+STATE_DONE = 'done'
+
+
+class IdempotencyConflict(Exception):
+    """Idempotency-Key déjà utilisée pour une demande différente."""
+
+
+def layout_request_fingerprint(prompt, text_content, subtitle, template, image_urls=None,
+                               image_hashes=None, rectangle_index=None, tenant=None):
+    """Empreinte de la configuration normalisée d'une demande de mise en page,
+    propre au client d'API `tenant`."""
+    payload = json.dumps({
+        'tenant': tenant,
+        'prompt': ' '.join((prompt or '').split()),
+        'text_content': (text_content or '').strip(),
+        'subtitle': (subtitle or '').strip(),
+        'template': (template or '').strip(),
+        'image_urls': [u.strip() for u in image_urls or []],
+        'image_hashes': list(image_hashes or []),
+        'rectangle_index': rectangle_index
+    }, ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+class LayoutRequestRegistry:
+    """Demandes de mise en page récentes -> job qui les sert."""
+
+    def __init__(self, path, window=3600):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.path = path
+        self.window = window
+        self._lock = threading.Lock()
+        self.coalesced = 0
+        self.replayed = 0
+        with self._connect() as db:
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('''
+                CREATE TABLE IF NOT EXISTS layout_requests (
+                    request_key TEXT PRIMARY KEY,
+                    fingerprint TEXT NOT NULL,
+                    job_id TEXT NOT NULL,
+                    state TEXT NOT NULL,
+                    output_file TEXT,
+                    created_at REAL NOT NULL,
+                    finished_at REAL
+                )
+            ''')
+            db.execute('CREATE INDEX IF NOT EXISTS layout_requests_job ON layout_requests(job_id)')
+
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def _usable(self, job_id, state, output_file, created_at, finished_at, now, job_alive=None):
+        if state == STATE_PENDING:
+            # Réservation dont le job a échoué ou été annulé sans la libérer : reprise
+            return created_at > now - self.window and (job_alive is None or job_alive(job_id))
+        return finished_at > now - self.window and bool(output_file) and os.path.exists(output_file)
+
+    def claim(self, fingerprint, job_id, idempotency_key=None, coalesce=True, job_alive=None):
+        """Réserve la demande pour `job_id`.
+
+        Retourne None si le job doit être lancé, sinon la demande existante
+        {'job_id', 'state', 'output_file'} à laquelle se rattacher. Une
+        demande en cours n'est reprise que si `job_alive(job_id)` (quand il est
+        fourni) confirme que son job peut encore aboutir. Lève
+        IdempotencyConflict si la clé a servi pour une autre configuration.
+        """
+        keys = []
+        if idempotency_key:
+            keys.append(f'key:{idempotency_key}')
+        if coalesce:
+            keys.append(f'config:{fingerprint}')
+        if not keys:
+            return None
+        now = time.time()
+        with self._connect() as db:
+            db.execute('BEGIN IMMEDIATE')
+            existing = None
+            for key in keys:
+                row = db.execute(
+                    'SELECT fingerprint, job_id, state, output_file, created_at, finished_at '
+                    'FROM layout_requests WHERE request_key = ?', (key,)
+                ).fetchone()
+                if not row or not self._usable(*row[1:], now, job_alive=job_alive):
+                    continue
+                if row[0] != fingerprint:
+                    raise IdempotencyConflict(idempotency_key)
+                existing = {'job_id': row[1], 'state': row[2], 'output_file': row[3]}
+                break
+            if existing:
+                # La clé du client pointe désormais aussi vers le job rattaché
+                db.executemany(
+                    'INSERT OR REPLACE INTO layout_requests(request_key, fingerprint, job_id, state, '
+                    'output_file, created_at, finished_at) SELECT ?, fingerprint, job_id, state, '
+                    'output_file, created_at, finished_at FROM layout_requests WHERE request_key = ?',
+                    [(k, key) for k in keys if k != key]
+                )
+            else:
+                db.executemany(
+                    'INSERT OR REPLACE INTO layout_requests(request_key, fingerprint, job_id, state, '
+                    'created_at) VALUES (?, ?, ?, ?, ?)',
+                    [(k, fingerprint, job_id, STATE_PENDING, now) for k in keys]
+                )
+            db.execute('DELETE FROM layout_requests WHERE created_at < ? AND '
+                       '(finished_at IS NULL OR finished_at < ?)', (now - self.window, now - self.window))
+        if existing:
+            with self._lock:
+                if existing['state'] == STATE_DONE:
+                    self.replayed += 1
+                else:
+                    self.coalesced += 1
+        return existing
+
+    def finish(self, job_id, success, output_file=None):
+        """Enregistre l'issue du job ; un échec libère la demande."""
+        with self._connect() as db:
+            if success:
+                db.execute(
+                    'UPDATE layout_requests SET state = ?, output_file = ?, finished_at = ? WHERE job_id = ?',
+                    (STATE_DONE, output_file, time.time(), job_id)
+                )
+            else:
+                db.execute('DELETE FROM layout_requests WHERE job_id = ?', (job_id,))
+
+    def stats(self):
+        with self._connect() as db:
+            entries = db.execute('SELECT COUNT(*) FROM layout_requests').fetchone()[0]
+        with self._lock:
+            return {'entries': entries, 'coalesced': self.coalesced, 'replayed': self.replayed}
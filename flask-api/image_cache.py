@@ -0,0 +1,218 @@
+"""
+Cache disque des images téléchargées, partagé entre projets et workers.
+
+- Les fichiers sont stockés par contenu (SHA-256) : des octets identiques
+  servis par plusieurs URLs ne sont stockés qu'une fois.
+- Chaque URL garde son ETag / Last-Modified pour une revalidation
+  conditionnelle (304 Not Modified = hit, aucun octet retransféré).
+- La taille totale est bornée ; les blobs les moins récemment utilisés sont
+  évincés en premier.
+- Les images sont liées (hardlink, sinon symlink, sinon copie) dans le
+  dossier du projet plutôt que copiées.
+
+L'index est une base SQLite (mode WAL) afin d'être partagé par les workers
+gunicorn ; les compteurs hit/miss/eviction y sont aussi stockés.
+"""
+import hashlib
+import os
+import shutil
+import sqlite3
+import tempfile
+import time
+from contextlib import contextmanager
+
+COUNTERS = ('hits', 'misses', 'revalidations', 'dedup', 'evictions', 'evicted_bytes')
+
+
+def file_sha256(path, chunk_size=1024 * 1024):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def link_or_copy(src, dest):
+    """Lie `src` à `dest` : hardlink, puis symlink, puis copie en dernier recours."""
+    if os.path.lexists(dest):
+        os.unlink(dest)
+    try:
+        os.link(src, dest)
+        return 'hardlink'
+    except OSError:
+        pass
+    try:
+        os.symlink(os.path.abspath(src), dest)
+        return 'symlink'
+    except OSError:
+        shutil.copy2(src, dest)
+        return 'copy'
+
+
+class ImageCache:
+    """Cache d'images adressé par contenu avec index SQLite et éviction LRU."""
+
+    def __init__(self, root, max_bytes=2 * 1024 ** 3):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.blobs_dir = os.path.join(root, 'blobs')
+        self.tmp_dir = os.path.join(root, 'tmp')
+        os.makedirs(self.blobs_dir, exist_ok=True)
+        os.makedirs(self.tmp_dir, exist_ok=True)
+        self.db_path = os.path.join(root, 'index.db')
+        with self._connect() as db:
+            db.execute('PRAGMA journal_mode=WAL')
+            db.executescript('''
+                CREATE TABLE IF NOT EXISTS urls (
+                    url TEXT PRIMARY KEY,
+                    sha256 TEXT NOT NULL,
+                    etag TEXT,
+                    last_modified TEXT,
+                    fetched_at REAL
+                );
+                CREATE TABLE IF NOT EXISTS blobs (
+                    sha256 TEXT PRIMARY KEY,
+                    ext TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    last_access REAL NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS blobs_last_access ON blobs(last_access);
+                CREATE TABLE IF NOT EXISTS counters (
+                    name TEXT PRIMARY KEY,
+                    value INTEGER NOT NULL
+                );
+            ''')
+
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path, timeout=30)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def blob_path(self, sha256, ext):
+        return os.path.join(self.blobs_dir, sha256[:2], f'{sha256}.{ext}')
+
+    def _incr(self, db, name, amount=1):
+        db.execute(
+            'INSERT INTO counters(name, value) VALUES (?, ?) '
+            'ON CONFLICT(name) DO UPDATE SET value = value + excluded.value',
+            (name, amount)
+        )
+
+    def record(self, name, amount=1):
+        with self._connect() as db:
+            self._incr(db, name, amount)
+
+    def lookup(self, url):
+        """Entrée du cache pour `url` (ou None si absente / blob disparu)."""
+        with self._connect() as db:
+            row = db.execute(
+                'SELECT u.sha256, b.ext, u.etag, u.last_modified FROM urls u '
+                'JOIN blobs b ON b.sha256 = u.sha256 WHERE u.url = ?', (url,)
+            ).fetchone()
+        if not row:
+            return None
+        sha256, ext, etag, last_modified = row
+        path = self.blob_path(sha256, ext)
+        if not os.path.exists(path):
+            return None
+        return {'sha256': sha256, 'ext': ext, 'etag': etag, 'last_modified': last_modified, 'path': path}
+
+    @staticmethod
+    def conditional_headers(entry):
+        headers = {}
+        if entry and entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry and entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+        return headers
+
+    def touch(self, entry):
+        """Hit : l'URL est toujours valide (304), met à jour l'ordre LRU."""
+        now = time.time()
+        with self._connect() as db:
+            db.execute('UPDATE blobs SET last_access = ? WHERE sha256 = ?', (now, entry['sha256']))
+            self._incr(db, 'hits')
+        return entry['path']
+
+    def new_temp_path(self, suffix=''):
+        """Chemin temporaire sur le même système de fichiers que les blobs."""
+        fd, path = tempfile.mkstemp(dir=self.tmp_dir, suffix=suffix)
+        os.close(fd)
+        return path
+
+    def store(self, url, tmp_path, ext, etag=None, last_modified=None):
+        """Miss : range le fichier téléchargé par contenu et indexe l'URL.
+        Retourne le chemin du blob."""
+        sha256 = file_sha256(tmp_path)
+        path = self.blob_path(sha256, ext)
+        size = os.path.getsize(tmp_path)
+        now = time.time()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with self._connect() as db:
+            self._incr(db, 'misses')
+            if os.path.exists(path):
+                # Octets déjà connus (autre URL ou contenu inchangé)
+                os.unlink(tmp_path)
+                self._incr(db, 'dedup')
+            else:
+                os.replace(tmp_path, path)
+            db.execute(
+                'INSERT INTO blobs(sha256, ext, size, last_access) VALUES (?, ?, ?, ?) '
+                'ON CONFLICT(sha256) DO UPDATE SET last_access = excluded.last_access',
+                (sha256, ext, size, now)
+            )
+            db.execute(
+                'INSERT INTO urls(url, sha256, etag, last_modified, fetched_at) VALUES (?, ?, ?, ?, ?) '
+                'ON CONFLICT(url) DO UPDATE SET sha256 = excluded.sha256, etag = excluded.etag, '
+                'last_modified = excluded.last_modified, fetched_at = excluded.fetched_at',
+                (url, sha256, etag, last_modified, now)
+            )
+        self.evict(keep=sha256)
+        return path
+
+    def evict(self, keep=None):
+        """Supprime les blobs LRU tant que la taille totale dépasse max_bytes
+        (sauf `keep`, le blob qu'on vient de ranger)."""
+        with self._connect() as db:
+            total = db.execute('SELECT COALESCE(SUM(size), 0) FROM blobs').fetchone()[0]
+            if total <= self.max_bytes:
+                return 0
+            evicted = 0
+            for sha256, ext, size in db.execute(
+                'SELECT sha256, ext, size FROM blobs ORDER BY last_access ASC'
+            ).fetchall():
+                if total <= self.max_bytes:
+                    break
+                if sha256 == keep:
+                    continue
+                try:
+                    os.unlink(self.blob_path(sha256, ext))
+                except FileNotFoundError:
+                    pass
+                db.execute('DELETE FROM blobs WHERE sha256 = ?', (sha256,))
+                db.execute('DELETE FROM urls WHERE sha256 = ?', (sha256,))
+                total -= size
+                evicted += 1
+                self._incr(db, 'evictions')
+                self._incr(db, 'evicted_bytes', size)
+            return evicted
+
+    def stats(self):
+        with self._connect() as db:
+            counters = dict(db.execute('SELECT name, value FROM counters').fetchall())
+            blobs, size = db.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM blobs').fetchone()
+            urls = db.execute('SELECT COUNT(*) FROM urls').fetchone()[0]
+        stats = {name: counters.get(name, 0) for name in COUNTERS}
+        lookups = stats['hits'] + stats['misses']
+        stats.update({
+            'hit_ratio': round(stats['hits'] / lookups, 3) if lookups else None,
+            'blobs': blobs,
+            'urls': urls,
+            'size_bytes': size,
+            'max_bytes': self.max_bytes
+        })
+        return stats
@@ -0,0 +1,174 @@
+"""
+Préparation des images avant placement dans InDesign.
+
+Entre la récupération des images (upload ou téléchargement) et le rendu :
+- orientation EXIF appliquée aux pixels (InDesign ignore souvent le tag) ;
+- mode couleur normalisé (16 bits, LAB, TIFF/PSD... -> RGB en JPEG ; CMYK
+  et niveaux de gris conservés ; la transparence est conservée en PNG) ;
+- sous-échantillonnage au-delà de la résolution utile : côté long de la page
+  du template (points) x PPI cible.
+
+Les fichiers déjà conformes (JPEG/PNG, orientation normale, assez petits) ne
+sont pas réencodés. Le travail tourne dans un pool de processus ; en cas
+d'erreur sur une image, l'original est utilisé tel quel.
+
+Les processus du pool sont forkés par `start()`, au démarrage, avant que
+l'application lance ses threads (logs, jobs, sessions InDesign) : forker
+plus tard, depuis un thread de job, copierait des verrous tenus par les
+autres threads. Si le pool casse, il n'est pas reforké : les images sont
+préparées dans le thread du job. Un processus du pool s'arrête de lui-même
+quand le worker qui l'a forké meurt sans le fermer (tué par gunicorn après
+un timeout, par exemple).
+"""
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from PIL import Image, ImageOps
+
+# Les TIFF/PSD de production dépassent vite la limite anti-bombe de Pillow
+Image.MAX_IMAGE_PIXELS = None
+
+KEPT_MODES = ('RGB', 'CMYK', 'L')
+ALPHA_MODES = ('RGBA', 'LA', 'PA')
+PASSTHROUGH_FORMATS = ('JPEG', 'PNG')
+EXIF_ORIENTATION = 0x0112
+
+
+def max_edge_for_page(width_pt, height_pt, target_ppi):
+    """Côté long utile (pixels) pour une page de width_pt x height_pt points."""
+    return int(round(max(width_pt, height_pt) / 72.0 * target_ppi))
+
+
+def prepare_image(path, max_edge, keep_original=True, jpeg_quality=92):
+    """Prépare une image ; retourne un rapport dont `path` est le fichier à placer.
+
+    Fonction de module (et non méthode) : elle est exécutée dans les processus
+    du pool.
+    """
+    started = time.monotonic()
+    report = {'original': path, 'path': path, 'action': 'unchanged', 'original_bytes': os.path.getsize(path)}
+    with Image.open(path) as image:
+        report['original_size'] = list(image.size)
+        orientation = image.getexif().get(EXIF_ORIENTATION, 1)
+        too_large = max(image.size) > max_edge
+        has_alpha = image.mode in ALPHA_MODES or (image.mode == 'P' and 'transparency' in image.info)
+        needs_mode = image.mode not in KEPT_MODES + ALPHA_MODES + ('P',)
+        if (image.format in PASSTHROUGH_FORMATS and orientation == 1
+                and not too_large and not needs_mode):
+            report.update(size=list(image.size), bytes=report['original_bytes'],
+                          duration_ms=int((time.monotonic() - started) * 1000))
+            return report
+
+        icc_profile = image.info.get('icc_profile')
+        image = ImageOps.exif_transpose(image)
+        if has_alpha:
+            image = image.convert('RGBA')
+        elif image.mode not in KEPT_MODES:
+            image = image.convert('RGB')
+        if too_large:
+            image.thumbnail((max_edge, max_edge), Image.LANCZOS)
+
+        stem = os.path.splitext(path)[0]
+        if has_alpha:
+            dest = f'{stem}.prepared.png'
+            image.save(dest, 'PNG', optimize=False, icc_profile=icc_profile)
+        else:
+            dest = f'{stem}.prepared.jpg'
+            image.save(dest, 'JPEG', quality=jpeg_quality, subsampling=0, icc_profile=icc_profile)
+        report.update(path=dest, action='prepared', size=list(image.size), bytes=os.path.getsize(dest))
+
+    if not keep_original:
+        os.unlink(path)
+        report['original'] = None
+    report['duration_ms'] = int((time.monotonic() - started) * 1000)
+    return report
+
+
+def _ready():
+    return os.getpid()
+
+
+def _exit_with_parent(parent_pid):
+    """Initializer des processus du pool : surveille le processus parent."""
+    def watch():
+        while os.getppid() == parent_pid:
+            time.sleep(1)
+        os._exit(0)
+    threading.Thread(target=watch, name='magflow-prep-parent', daemon=True).start()
+
+
+class ImagePreprocessor:
+    """Pool de processus pour préparer les images d'un rendu en parallèle."""
+
+    def __init__(self, max_workers=None, target_ppi=300, default_max_edge=3508, keep_originals=True,
+                 start_method='fork'):
+        self.max_workers = max_workers if max_workers is not None else (os.cpu_count() or 2)
+        self.start_method = start_method
+        self.target_ppi = target_ppi
+        self.default_max_edge = default_max_edge
+        self.keep_originals = keep_originals
+        self._executor = None
+
+    def start(self):
+        """Crée le pool et forke tous ses processus (à appeler avant de lancer des threads)."""
+        if self.max_workers == 0 or self._executor is not None:
+            return
+        executor = self._pool()
+        for future in [executor.submit(_ready) for _ in range(self.max_workers)]:
+            future.result()
+
+    def _pool(self):
+        if self._executor is None:
+            # fork par défaut : avec spawn, `python app.py` réimporterait toute
+            # l'application (pool InDesign compris) dans chaque processus
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.max_workers, mp_context=multiprocessing.get_context(self.start_method),
+                initializer=_exit_with_parent, initargs=(os.getpid(),)
+            )
+        return self._executor
+
+    def max_edge(self, page_width_pt=None, page_height_pt=None, units='points'):
+        """Côté long utile pour la page donnée ; default_max_edge si elle est
+        inconnue ou mesurée dans une autre unité que le point (analyses
+        antérieures, dont les dimensions suivaient les règles du document)."""
+        if page_width_pt and page_height_pt and units == 'points':
+            return max_edge_for_page(page_width_pt, page_height_pt, self.target_ppi)
+        return self.default_max_edge
+
+    def prepare(self, paths, max_edge=None):
+        """Prépare `paths` ; retourne (chemins à placer, rapports), dans l'ordre."""
+        max_edge = max_edge or self.default_max_edge
+        if not paths:
+            return [], []
+        if self.max_workers == 0:
+            outcomes = [self._safe_call(p, max_edge) for p in paths]
+        else:
+            try:
+                futures = [self._pool().submit(prepare_image, p, max_edge, self.keep_originals) for p in paths]
+                outcomes = [self._outcome(f, p) for f, p in zip(futures, paths)]
+            except BrokenProcessPool:
+                self._executor = None
+                if self.start_method == 'fork':
+                    # Le processus a maintenant des threads : ne plus forker
+                    self.max_workers = 0
+                outcomes = [self._safe_call(p, max_edge) for p in paths]
+        return [o['path'] for o in outcomes], outcomes
+
+    def _safe_call(self, path, max_edge):
+        try:
+            return prepare_image(path, max_edge, self.keep_originals)
+        except Exception as e:
+            return {'original': path, 'path': path, 'action': 'failed', 'error': str(e)}
+
+    @staticmethod
+    def _outcome(future, path):
+        try:
+            return future.result()
+        except BrokenProcessPool:
+            raise
+        except Exception as e:
+            return {'original': path, 'path': path, 'action': 'failed', 'error': str(e)}
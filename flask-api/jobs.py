@@ -0,0 +1,895 @@
+"""
+Sous-système de jobs asynchrones pour les rendus InDesign.
+
+Les endpoints de création soumettent un job (type + payload JSON) et répondent
+immédiatement. Les jobs sont écrits dans une base SQLite (mode WAL) partagée
+par tous les workers gunicorn : chaque processus fait tourner un pool de
+threads qui réclament (claim) le prochain job en file, sous verrou
+d'écriture, et le tiennent par un bail (lease) renouvelé tant qu'il tourne.
+Un job n'est donc exécuté que par un seul worker, et son statut est visible
+depuis n'importe lequel.
+
+Un worker qui meurt en plein rendu laisse un job `running` dont le bail
+expire : il est remis en file (au démarrage d'un worker, puis
+périodiquement), jusqu'à JOB_MAX_ATTEMPTS tentatives.
+
+L'ordre de passage est celui d'une file équitable pondérée (start-time fair
+queuing) entre clients d'API : chaque job reçoit à la soumission une
+étiquette virtuelle `fair_finish = max(V, dernière étiquette du client) +
+1 / poids`, et les workers prennent la plus petite. Un client qui soumet en
+masse n'avance donc que de sa part de capacité, sans bloquer les autres.
+Les jobs `interactive` passent avant les jobs `batch`, et un client peut
+être limité en jobs simultanés et en démarrages par minute (token bucket) :
+ses jobs restent alors en file sans retenir ceux des autres.
+
+Un job peut être annulé (DELETE /api/jobs/<id>) depuis n'importe quel
+worker : en file, il passe directement à `cancelled` ; en cours, la demande
+est notée dans la base et le worker qui l'exécute annule sa CancelScope, ce
+qui tue le rendu InDesign. Il en va de même à l'échéance du job
+(X-Deadline-Seconds). Le nettoyage propre à chaque type (uploads du projet)
+est enregistré avec son handler, ainsi qu'un hook `on_finish(job)` appelé
+à chaque fin de job, y compris quand le handler n'a pas tourné (annulé ou
+échu en file) ou n'a pas pu finir.
+
+Chaque job tient aussi un journal d'événements (changements d'état, étapes,
+progression des scripts InDesign) diffusé en SSE par /api/jobs/<id>/events.
+"""
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from datetime import datetime
+
+from cancellation import CANCEL_REQUESTED, DEADLINE_EXCEEDED, CancelScope, JobCancelled, cancel_scope_var
+from logs import get_logger, job_id_var, request_id_var, tenant_var
+
+JOB_QUEUED = 'queued'
+JOB_RUNNING = 'running'
+JOB_DONE = 'done'
+JOB_FAILED = 'failed'
+JOB_CANCELLED = 'cancelled'
+
+JOB_STATES = (JOB_QUEUED, JOB_RUNNING, JOB_DONE, JOB_FAILED, JOB_CANCELLED)
+FINISHED_STATES = (JOB_DONE, JOB_FAILED, JOB_CANCELLED)
+
+PRIORITY_INTERACTIVE = 'interactive'
+PRIORITY_BATCH = 'batch'
+PRIORITIES = (PRIORITY_INTERACTIVE, PRIORITY_BATCH)
+
+# Événements conservés par job (les plus anciens sont oubliés au-delà)
+MAX_JOB_EVENTS = 500
+
+# Lissage de la moyenne mobile exponentielle des durées d'exécution par type
+RUN_SECONDS_EWMA_ALPHA = 0.2
+
+logger = get_logger('jobs')
+
+
+def _iso(ts):
+    return datetime.fromtimestamp(ts).isoformat() if ts else None
+
+
+def _process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def estimate_wait(queued, running, capacity, run_seconds, default_run_seconds=None):
+    """Attente (s) avant qu'un nouveau job démarre : travail en file (compté en
+    entier) et en cours (à moitié fait en moyenne) réparti sur `capacity`
+    threads. `queued` / `running` : type -> nombre de jobs ; `run_seconds` :
+    type -> durée moyenne. None si rien ne permet d'estimer."""
+    if not capacity:
+        return None
+    if sum(queued.values()) + sum(running.values()) < capacity:
+        return 0.0
+    known = list(run_seconds.values())
+    fallback = sum(known) / len(known) if known else default_run_seconds
+    work = 0.0
+    for counts, share in ((queued, 1.0), (running, 0.5)):
+        for kind, count in counts.items():
+            duration = run_seconds.get(kind, fallback)
+            if duration is None:
+                return None
+            work += count * duration * share
+    return round(work / capacity, 1)
+
+
+class Job:
+    """Un rendu soumis : type, payload d'entrée et état d'exécution."""
+
+    COLUMNS = ('id', 'kind', 'payload', 'state', 'attempts', 'result', 'error', 'output_file',
+               'request_id', 'worker_id', 'lease_expires_at', 'created_at', 'started_at', 'finished_at',
+               'tenant', 'priority', 'fair_start', 'fair_finish', 'deadline_at', 'cancel_requested_at')
+
+    def __init__(self, kind, payload, job_id=None, tenant=None, priority=PRIORITY_INTERACTIVE, deadline_at=None):
+        if priority not in PRIORITIES:
+            raise ValueError(f'Priorité inconnue: {priority}')
+        self.id = job_id or str(uuid.uuid4())
+        self.kind = kind
+        self.payload = payload
+        self.tenant = tenant
+        self.priority = priority
+        self.fair_start = 0.0
+        self.fair_finish = 0.0
+        self.deadline_at = deadline_at
+        self.cancel_requested_at = None
+        self.state = JOB_QUEUED
+        self.attempts = 0
+        self.result = None
+        self.error = None
+        self.output_file = None
+        self.request_id = None
+        self.worker_id = None
+        self.lease_expires_at = None
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+
+    @classmethod
+    def from_row(cls, row):
+        job = cls.__new__(cls)
+        for column, value in zip(cls.COLUMNS, row):
+            setattr(job, column, value)
+        job.payload = json.loads(job.payload)
+        job.result = json.loads(job.result) if job.result else None
+        return job
+
+    @property
+    def finished(self):
+        return self.state in FINISHED_STATES
+
+    def to_dict(self):
+        now = time.time()
+        queue_end = self.started_at or self.finished_at or now
+        run_end = self.finished_at or now
+        return {
+            'job_id': self.id,
+            'kind': self.kind,
+            'state': self.state,
+            'tenant': self.tenant,
+            'priority': self.priority,
+            'attempts': self.attempts,
+            'project_id': self.payload.get('project_id'),
+            'output_file': self.output_file,
+            'result': self.result,
+            'error': self.error,
+            'created_at': _iso(self.created_at),
+            'started_at': _iso(self.started_at),
+            'finished_at': _iso(self.finished_at),
+            'deadline': _iso(self.deadline_at),
+            'cancel_requested': self.cancel_requested_at is not None,
+            'timings': {
+                'queue_seconds': round(queue_end - self.created_at, 3),
+                'run_seconds': round(run_end - self.started_at, 3) if self.started_at else None,
+            },
+        }
+
+
+class JobStore:
+    """Table `jobs` + journal `job_events` dans une base SQLite partagée, avec
+    l'état de l'ordonnanceur (temps virtuel, token buckets, workers actifs)."""
+
+    # Colonnes ajoutées après la première version du schéma
+    MIGRATIONS = (
+        ('jobs', 'tenant', 'TEXT'),
+        ('jobs', 'priority', f"TEXT NOT NULL DEFAULT '{PRIORITY_INTERACTIVE}'"),
+        ('jobs', 'fair_start', 'REAL NOT NULL DEFAULT 0'),
+        ('jobs', 'fair_finish', 'REAL NOT NULL DEFAULT 0'),
+        ('jobs', 'deadline_at', 'REAL'),
+        ('jobs', 'cancel_requested_at', 'REAL'),
+        ('job_workers', 'renderer', 'TEXT'),
+        ('job_workers', 'render_slots', 'INTEGER'),
+    )
+
+    def __init__(self, path):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.path = path
+        with self._connect() as db:
+            db.execute('PRAGMA journal_mode=WAL')
+            db.executescript('''
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id TEXT PRIMARY KEY,
+                    kind TEXT NOT NULL,
+                    payload TEXT NOT NULL,
+                    state TEXT NOT NULL,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    result TEXT,
+                    error TEXT,
+                    output_file TEXT,
+                    request_id TEXT,
+                    worker_id TEXT,
+                    lease_expires_at REAL,
+                    created_at REAL NOT NULL,
+                    started_at REAL,
+                    finished_at REAL
+                );
+                CREATE TABLE IF NOT EXISTS job_events (
+                    job_id TEXT NOT NULL,
+                    seq INTEGER NOT NULL,
+                    event TEXT NOT NULL,
+                    data TEXT NOT NULL,
+                    ts REAL NOT NULL,
+                    PRIMARY KEY (job_id, seq)
+                );
+                CREATE TABLE IF NOT EXISTS scheduler (
+                    name TEXT PRIMARY KEY,
+                    value REAL NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS token_buckets (
+                    tenant TEXT PRIMARY KEY,
+                    tokens REAL NOT NULL,
+                    updated_at REAL NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS job_workers (
+                    worker_id TEXT PRIMARY KEY,
+                    threads INTEGER NOT NULL,
+                    heartbeat_at REAL NOT NULL
+                );
+            ''')
+            for table, column, declaration in self.MIGRATIONS:
+                if column not in {row[1] for row in db.execute(f'PRAGMA table_info({table})')}:
+                    db.execute(f'ALTER TABLE {table} ADD COLUMN {column} {declaration}')
+            db.executescript('''
+                CREATE INDEX IF NOT EXISTS jobs_state ON jobs(state, created_at);
+                CREATE INDEX IF NOT EXISTS jobs_fair ON jobs(state, priority, fair_finish);
+                CREATE INDEX IF NOT EXISTS jobs_tenant ON jobs(tenant, state);
+            ''')
+
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30)
+        try:
+            conn.execute('PRAGMA synchronous=NORMAL')
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    @staticmethod
+    def _append_event(db, job_id, event, data, ts=None):
+        seq = db.execute('SELECT COALESCE(MAX(seq), 0) + 1 FROM job_events WHERE job_id = ?',
+                         (job_id,)).fetchone()[0]
+        db.execute('INSERT INTO job_events(job_id, seq, event, data, ts) VALUES (?, ?, ?, ?, ?)',
+                   (job_id, seq, event, json.dumps(data, ensure_ascii=False, default=str), ts or time.time()))
+        if seq > MAX_JOB_EVENTS:
+            db.execute('DELETE FROM job_events WHERE job_id = ? AND seq <= ?', (job_id, seq - MAX_JOB_EVENTS))
+
+    @staticmethod
+    def _virtual_time(db):
+        row = db.execute("SELECT value FROM scheduler WHERE name = 'virtual_time'").fetchone()
+        return row[0] if row else 0.0
+
+    def insert(self, job, weight=1.0):
+        """Met le job en file ; ses étiquettes équitables dépendent du poids de son client."""
+        with self._connect() as db:
+            db.execute('BEGIN IMMEDIATE')
+            # Un client sans job en attente repart du temps virtuel courant :
+            # pas de crédit accumulé pendant l'inactivité
+            last_finish = db.execute(
+                'SELECT MAX(fair_finish) FROM jobs WHERE tenant IS ? AND state IN (?, ?)',
+                (job.tenant, JOB_QUEUED, JOB_RUNNING)
+            ).fetchone()[0]
+            job.fair_start = max(self._virtual_time(db), last_finish or 0.0)
+            job.fair_finish = job.fair_start + 1.0 / weight
+            db.execute(
+                'INSERT INTO jobs(id, kind, payload, state, request_id, created_at, tenant, priority, '
+                'fair_start, fair_finish, deadline_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (job.id, job.kind, json.dumps(job.payload, ensure_ascii=False), job.state,
+                 job.request_id, job.created_at, job.tenant, job.priority, job.fair_start, job.fair_finish,
+                 job.deadline_at)
+            )
+            self._append_event(db, job.id, 'state', {'state': JOB_QUEUED})
+
+    def get(self, job_id):
+        with self._connect() as db:
+            row = db.execute(f'SELECT {", ".join(Job.COLUMNS)} FROM jobs WHERE id = ?', (job_id,)).fetchone()
+        return Job.from_row(row) if row else None
+
+    def list(self, state=None, kind=None, tenant=None, limit=50):
+        clauses, params = [], []
+        if state:
+            clauses.append('state = ?')
+            params.append(state)
+        if kind:
+            clauses.append('kind = ?')
+            params.append(kind)
+        if tenant:
+            clauses.append('tenant = ?')
+            params.append(tenant)
+        where = f'WHERE {" AND ".join(clauses)}' if clauses else ''
+        with self._connect() as db:
+            rows = db.execute(
+                f'SELECT {", ".join(Job.COLUMNS)} FROM jobs {where} ORDER BY created_at DESC LIMIT ?',
+                (*params, limit)
+            ).fetchall()
+        return [Job.from_row(row) for row in rows]
+
+    @staticmethod
+    def _bucket_tokens(db, tenant, per_minute, now):
+        """Jetons disponibles du client : rafale de `per_minute`, recharge continue."""
+        row = db.execute('SELECT tokens, updated_at FROM token_buckets WHERE tenant = ?', (tenant,)).fetchone()
+        if not row:
+            return per_minute
+        tokens, updated_at = row
+        return min(per_minute, tokens + (now - updated_at) * per_minute / 60.0)
+
+    def _within_quota(self, db, tenant, client, now):
+        if client.max_concurrent:
+            running = db.execute('SELECT COUNT(*) FROM jobs WHERE tenant = ? AND state = ?',
+                                 (tenant, JOB_RUNNING)).fetchone()[0]
+            if running >= client.max_concurrent:
+                return False
+        if client.per_minute and self._bucket_tokens(db, tenant, client.per_minute, now) < 1:
+            return False
+        return True
+
+    @staticmethod
+    def _rendering(db, worker_id, renderer, render_kinds):
+        """Jobs de rendu en cours sur l'instance `renderer` (tous les workers qui
+        la partagent), ou sur le seul `worker_id` si son instance lui est propre."""
+        kinds = ", ".join("?" * len(render_kinds))
+        if renderer:
+            return db.execute(
+                f'SELECT COUNT(*) FROM jobs WHERE state = ? AND kind IN ({kinds}) '
+                'AND worker_id IN (SELECT worker_id FROM job_workers WHERE renderer = ?)',
+                (JOB_RUNNING, *render_kinds, renderer)
+            ).fetchone()[0]
+        return db.execute(
+            f'SELECT COUNT(*) FROM jobs WHERE state = ? AND kind IN ({kinds}) AND worker_id = ?',
+            (JOB_RUNNING, *render_kinds, worker_id)
+        ).fetchone()[0]
+
+    def claim(self, kinds, worker_id, lease_seconds, tenants=None, renderer=None, render_slots=None,
+              render_kinds=()):
+        """Passe à `running` pour `worker_id`, atomiquement, le prochain job en
+        file (d'un type connu) : interactifs d'abord, puis plus petite étiquette
+        équitable, en sautant les clients au bout de leur quota. `tenants` :
+        nom -> client (max_concurrent, per_minute). Les jobs de `render_kinds`
+        ne sont pas réclamés tant que l'instance de rendu a déjà `render_slots`
+        rendus en cours : ils attendent dans la file, dans son ordre, plutôt
+        que devant le verrou de l'instance. Retourne le Job ou None."""
+        if not kinds:
+            return None
+        tenants = tenants or {}
+        with self._connect() as db:
+            db.execute('BEGIN IMMEDIATE')
+            # Horodaté une fois le verrou obtenu : le job précédent est bien terminé
+            now = time.time()
+            render_kinds = [kind for kind in render_kinds if kind in kinds]
+            if render_slots and render_kinds and \
+                    self._rendering(db, worker_id, renderer, render_kinds) >= render_slots:
+                kinds = [kind for kind in kinds if kind not in render_kinds]
+                if not kinds:
+                    return None
+            rows = db.execute(
+                f'SELECT id, tenant, fair_start FROM jobs WHERE state = ? '
+                f'AND kind IN ({", ".join("?" * len(kinds))}) '
+                'ORDER BY priority = ?, fair_finish, created_at', (JOB_QUEUED, *kinds, PRIORITY_BATCH)
+            )
+            chosen, throttled = None, set()
+            for job_id, tenant, fair_start in rows:
+                if tenant in throttled:
+                    continue
+                client = tenants.get(tenant)
+                if client and not self._within_quota(db, tenant, client, now):
+                    throttled.add(tenant)
+                    continue
+                chosen = (job_id, tenant, fair_start, client)
+                break
+            rows.close()
+            if not chosen:
+                return None
+            job_id, tenant, fair_start, client = chosen
+            db.execute(
+                'UPDATE jobs SET state = ?, worker_id = ?, lease_expires_at = ?, started_at = ?, '
+                'attempts = attempts + 1 WHERE id = ?',
+                (JOB_RUNNING, worker_id, now + lease_seconds, now, job_id)
+            )
+            db.execute(
+                "INSERT INTO scheduler(name, value) VALUES ('virtual_time', ?) "
+                'ON CONFLICT(name) DO UPDATE SET value = MAX(value, excluded.value)', (fair_start,)
+            )
+            if client and client.per_minute:
+                db.execute(
+                    'INSERT INTO token_buckets(tenant, tokens, updated_at) VALUES (?, ?, ?) '
+                    'ON CONFLICT(tenant) DO UPDATE SET tokens = excluded.tokens, updated_at = excluded.updated_at',
+                    (tenant, self._bucket_tokens(db, tenant, client.per_minute, now) - 1, now)
+                )
+            self._append_event(db, job_id, 'state', {'state': JOB_RUNNING}, now)
+            job_row = db.execute(f'SELECT {", ".join(Job.COLUMNS)} FROM jobs WHERE id = ?', (job_id,)).fetchone()
+        return Job.from_row(job_row)
+
+    @staticmethod
+    def _capacity(db, stale_after):
+        """Jobs exécutables en même temps : par instance de rendu, le plus petit
+        du total des threads de ses workers et de ses emplacements de rendu (une
+        instance InDesign partagée par plusieurs workers ne compte qu'une fois)."""
+        return db.execute(
+            'SELECT COALESCE(SUM(slots), 0) FROM ('
+            ' SELECT MIN(SUM(threads), COALESCE(MAX(render_slots), SUM(threads))) AS slots'
+            ' FROM job_workers WHERE heartbeat_at > ? GROUP BY COALESCE(renderer, worker_id))',
+            (time.time() - stale_after,)
+        ).fetchone()[0]
+
+    @staticmethod
+    def _run_seconds(db):
+        """Durée d'exécution moyenne (EWMA) par type de job."""
+        return {name.split(':', 1)[1]: value for name, value in db.execute(
+            "SELECT name, value FROM scheduler WHERE name LIKE 'run_seconds:%'"
+        )}
+
+    def queue_status(self, job, stale_after=60):
+        """Position d'un job en file et attente estimée (jobs devant lui et en
+        cours, sur les threads des workers actifs). None s'il n'est plus en file."""
+        if job.state != JOB_QUEUED:
+            return None
+        with self._connect() as db:
+            ahead = dict(db.execute(
+                'SELECT kind, COUNT(*) FROM jobs WHERE state = ? '
+                'AND (priority = ?, fair_finish, created_at) < (?, ?, ?) GROUP BY kind',
+                (JOB_QUEUED, PRIORITY_BATCH, job.priority == PRIORITY_BATCH, job.fair_finish, job.created_at)
+            ).fetchall())
+            running = dict(db.execute('SELECT kind, COUNT(*) FROM jobs WHERE state = ? GROUP BY kind',
+                                      (JOB_RUNNING,)).fetchall())
+            capacity = self._capacity(db, stale_after)
+            run_seconds = self._run_seconds(db)
+        return {
+            'position': sum(ahead.values()) + 1,
+            'running': sum(running.values()),
+            'estimated_wait_seconds': estimate_wait(ahead, running, capacity, run_seconds)
+        }
+
+    def load(self, stale_after=60):
+        """Charge courante : jobs en file (par priorité et type) et en cours,
+        threads des workers actifs et durées moyennes par type."""
+        with self._connect() as db:
+            rows = db.execute('SELECT state, priority, kind, COUNT(*) FROM jobs WHERE state IN (?, ?) '
+                              'GROUP BY state, priority, kind', (JOB_QUEUED, JOB_RUNNING)).fetchall()
+            capacity = self._capacity(db, stale_after)
+            run_seconds = self._run_seconds(db)
+        queued = {priority: {} for priority in PRIORITIES}
+        running = {}
+        for state, priority, kind, count in rows:
+            if state == JOB_RUNNING:
+                running[kind] = running.get(kind, 0) + count
+            else:
+                queued.setdefault(priority, {})[kind] = count
+        return {'queued': queued, 'running': running, 'capacity': capacity, 'run_seconds': run_seconds}
+
+    def heartbeat(self, worker_id, threads, stale_after=60, renderer=None, render_slots=None):
+        """Signale un worker actif (capacité utilisée pour estimer les attentes) :
+        ses threads de jobs et, s'il en partage une avec d'autres workers,
+        l'instance de rendu et le nombre de rendus simultanés qu'elle accepte."""
+        now = time.time()
+        with self._connect() as db:
+            db.execute(
+                'INSERT INTO job_workers(worker_id, threads, renderer, render_slots, heartbeat_at) '
+                'VALUES (?, ?, ?, ?, ?) ON CONFLICT(worker_id) DO UPDATE SET threads = excluded.threads, '
+                'renderer = excluded.renderer, render_slots = excluded.render_slots, '
+                'heartbeat_at = excluded.heartbeat_at',
+                (worker_id, threads, renderer, render_slots, now)
+            )
+            db.execute('DELETE FROM job_workers WHERE heartbeat_at < ?', (now - 10 * stale_after,))
+
+    def remove_worker(self, worker_id):
+        with self._connect() as db:
+            db.execute('DELETE FROM job_workers WHERE worker_id = ?', (worker_id,))
+
+    def renew(self, job_ids, worker_id, lease_seconds):
+        """Prolonge le bail des jobs que `worker_id` exécute encore."""
+        if not job_ids:
+            return
+        with self._connect() as db:
+            db.execute(
+                f'UPDATE jobs SET lease_expires_at = ? WHERE worker_id = ? AND state = ? '
+                f'AND id IN ({", ".join("?" * len(job_ids))})',
+                (time.time() + lease_seconds, worker_id, JOB_RUNNING, *job_ids)
+            )
+
+    def finish(self, job, worker_id):
+        """Enregistre l'issue d'un job ; False si le bail avait été perdu entre-temps."""
+        with self._connect() as db:
+            db.execute('BEGIN IMMEDIATE')
+            cursor = db.execute(
+                'UPDATE jobs SET state = ?, result = ?, error = ?, output_file = ?, finished_at = ?, '
+                'lease_expires_at = NULL WHERE id = ? AND worker_id = ? AND state = ?',
+                (job.state, json.dumps(job.result, ensure_ascii=False, default=str) if job.result is not None else None,
+                 job.error, job.output_file, job.finished_at, job.id, worker_id, JOB_RUNNING)
+            )
+            if cursor.rowcount:
+                self._append_event(db, job.id, 'state', {
+                    'state': job.state, 'output_file': job.output_file, 'error': job.error
+                }, job.finished_at)
+                # Échecs compris : ils ont occupé la capacité (timeouts InDesign notamment)
+                db.execute(
+                    'INSERT INTO scheduler(name, value) VALUES (?, ?) ON CONFLICT(name) DO UPDATE SET '
+                    'value = value + ? * (excluded.value - value)',
+                    (f'run_seconds:{job.kind}', job.finished_at - job.started_at, RUN_SECONDS_EWMA_ALPHA)
+                )
+            return bool(cursor.rowcount)
+
+    def request_cancel(self, job_id):
+        """Annule un job : en file, il passe à `cancelled` ; en cours, la demande
+        est notée pour le worker qui l'exécute. Retourne (Job à jour, retiré de
+        la file par cet appel), ou (None, False) si le job est inconnu."""
+        now = time.time()
+        with self._connect() as db:
+            db.execute('BEGIN IMMEDIATE')
+            row = db.execute('SELECT state, cancel_requested_at FROM jobs WHERE id = ?', (job_id,)).fetchone()
+            if not row:
+                return None, False
+            state, cancel_requested_at = row
+            if state == JOB_QUEUED:
+                db.execute('UPDATE jobs SET state = ?, error = ?, finished_at = ?, cancel_requested_at = ? '
+                           'WHERE id = ?', (JOB_CANCELLED, 'Job annulé', now, now, job_id))
+                self._append_event(db, job_id, 'state', {'state': JOB_CANCELLED, 'output_file': None,
+                                                         'error': 'Job annulé'}, now)
+            elif state == JOB_RUNNING and cancel_requested_at is None:
+                db.execute('UPDATE jobs SET cancel_requested_at = ? WHERE id = ?', (now, job_id))
+                self._append_event(db, job_id, 'cancel', {'status': 'requested'}, now)
+            job_row = db.execute(f'SELECT {", ".join(Job.COLUMNS)} FROM jobs WHERE id = ?', (job_id,)).fetchone()
+        return Job.from_row(job_row), state == JOB_QUEUED
+
+    def cancel_requests(self, worker_id):
+        """Jobs en cours sur `worker_id` dont l'annulation a été demandée."""
+        with self._connect() as db:
+            return [row[0] for row in db.execute(
+                'SELECT id FROM jobs WHERE worker_id = ? AND state = ? AND cancel_requested_at IS NOT NULL',
+                (worker_id, JOB_RUNNING)
+            )]
+
+    def requeue_orphans(self, max_attempts, hostname=None):
+        """Remet en file les jobs `running` dont le bail a expiré ou dont le
+        processus propriétaire (sur cette machine) n'existe plus. Au-delà de
+        max_attempts, le job passe en échec. Retourne (ids remis en file,
+        Jobs abandonnés : en échec ou annulés)."""
+        now = time.time()
+        requeued, abandoned = [], []
+        with self._connect() as db:
+            db.execute('BEGIN IMMEDIATE')
+            rows = db.execute('SELECT id, worker_id, lease_expires_at, attempts, deadline_at, cancel_requested_at '
+                              'FROM jobs WHERE state = ?', (JOB_RUNNING,)).fetchall()
+            for job_id, worker_id, lease_expires_at, attempts, deadline_at, cancel_requested_at in rows:
+                host, pid, _ = (worker_id or '::').split(':', 2)
+                dead_owner = host == hostname and pid.isdigit() and not _process_alive(int(pid))
+                if not dead_owner and (lease_expires_at or 0) > now:
+                    continue
+                # Un job annulé ou échu n'est pas relancé
+                if cancel_requested_at is not None:
+                    state, error = JOB_CANCELLED, 'Job annulé'
+                elif deadline_at is not None and deadline_at <= now:
+                    state, error = JOB_FAILED, 'Échéance du job dépassée'
+                elif attempts >= max_attempts:
+                    state, error = JOB_FAILED, f'Job abandonné après {attempts} tentatives (worker perdu)'
+                else:
+                    state = JOB_QUEUED
+                if state != JOB_QUEUED:
+                    db.execute('UPDATE jobs SET state = ?, error = ?, finished_at = ?, lease_expires_at = NULL '
+                               'WHERE id = ?', (state, error, now, job_id))
+                    self._append_event(db, job_id, 'state', {'state': state, 'output_file': None,
+                                                             'error': error}, now)
+                    abandoned.append(Job.from_row(db.execute(
+                        f'SELECT {", ".join(Job.COLUMNS)} FROM jobs WHERE id = ?', (job_id,)).fetchone()))
+                else:
+                    db.execute('UPDATE jobs SET state = ?, worker_id = NULL, lease_expires_at = NULL, '
+                               'started_at = NULL WHERE id = ?', (JOB_QUEUED, job_id))
+                    self._append_event(db, job_id, 'state', {'state': JOB_QUEUED, 'requeued': True}, now)
+                    requeued.append(job_id)
+        return requeued, abandoned
+
+    def emit(self, job_id, event, data):
+        with self._connect() as db:
+            db.execute('BEGIN IMMEDIATE')
+            if db.execute('SELECT 1 FROM jobs WHERE id = ?', (job_id,)).fetchone():
+                self._append_event(db, job_id, event, data)
+
+    def events(self, job_id, after=0):
+        with self._connect() as db:
+            state = db.execute('SELECT state FROM jobs WHERE id = ?', (job_id,)).fetchone()
+            if not state:
+                return None
+            rows = db.execute('SELECT seq, event, data, ts FROM job_events WHERE job_id = ? AND seq > ? '
+                              'ORDER BY seq', (job_id, after)).fetchall()
+        events = [{'id': seq, 'event': event, 'ts': ts, **json.loads(data)} for seq, event, data, ts in rows]
+        return events, state[0] in FINISHED_STATES
+
+    def prune(self, max_history):
+        """Oublie les jobs terminés les plus anciens au-delà de max_history."""
+        with self._connect() as db:
+            db.execute('BEGIN IMMEDIATE')
+            stale = [row[0] for row in db.execute(
+                f'SELECT id FROM jobs WHERE state IN ({", ".join("?" * len(FINISHED_STATES))}) '
+                'ORDER BY created_at DESC LIMIT -1 OFFSET ?',
+                (*FINISHED_STATES, max_history)
+            ).fetchall()]
+            for job_id in stale:
+                db.execute('DELETE FROM jobs WHERE id = ?', (job_id,))
+                db.execute('DELETE FROM job_events WHERE job_id = ?', (job_id,))
+            return len(stale)
+
+
+class JobManager:
+    """Exécute les jobs du store : handlers par type + pool de threads qui réclament le travail."""
+
+    def __init__(self, store, max_workers=2, max_history=500, metrics=None, lease_seconds=60,
+                 max_attempts=3, poll_interval=0.5, tenants=None, renderer=None, render_slots=None):
+        self.store = store
+        # Instance de rendu partagée et ses emplacements, publiés avec le heartbeat
+        self.renderer = renderer
+        self.render_slots = render_slots
+        # Clients d'API (nom -> poids et quotas) ; les inconnus ont un poids de 1, sans quota
+        self.tenants = tenants or {}
+        self._metrics = metrics
+        self._handlers = {}
+        self._max_history = max_history
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.poll_interval = poll_interval
+        self.hostname = socket.gethostname()
+        self.worker_id = f'{self.hostname}:{os.getpid()}:{uuid.uuid4().hex[:6]}'
+        self._lock = threading.Lock()
+        self._changed = threading.Condition(self._lock)
+        self._running = {}  # job_id -> CancelScope des jobs exécutés par ce worker
+        self._cleanups = {}
+        self._on_finish = {}
+        self._render_kinds = set()
+        self._max_workers = max_workers
+        self._threads = []
+        self._stopping = threading.Event()
+        self._submitted = 0
+
+    def register(self, kind, handler, cleanup=None, on_finish=None, renders=False):
+        """Associe un handler `handler(payload) -> dict` à un type de job, et
+        éventuellement `cleanup(payload)`, appelé quand un job de ce type est
+        annulé, et `on_finish(job)`, appelé une fois quand il se termine
+        (done, failed ou cancelled), que le handler ait tourné ou non.
+        `renders` : le job occupe un emplacement de l'instance de rendu."""
+        with self._changed:
+            self._handlers[kind] = handler
+            if renders:
+                self._render_kinds.add(kind)
+            if cleanup:
+                self._cleanups[kind] = cleanup
+            if on_finish:
+                self._on_finish[kind] = on_finish
+            self._changed.notify_all()
+
+    def _heartbeat(self):
+        self.store.heartbeat(self.worker_id, self._max_workers, self.lease_seconds,
+                             renderer=self.renderer, render_slots=self.render_slots)
+
+    def start(self):
+        """Remet en file les jobs orphelins puis démarre les threads d'exécution
+        et de renouvellement des baux (idempotent)."""
+        if self._threads:
+            return
+        self._heartbeat()
+        self._reap()
+        for index in range(self._max_workers):
+            thread = threading.Thread(target=self._worker_loop, name=f'magflow-job-{index}', daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        thread = threading.Thread(target=self._supervise_loop, name='magflow-job-supervisor', daemon=True)
+        thread.start()
+        self._threads.append(thread)
+
+    def stop(self):
+        self._stopping.set()
+        with self._changed:
+            self._changed.notify_all()
+        self.store.remove_worker(self.worker_id)
+
+    def submit(self, kind, payload, job_id=None, priority=PRIORITY_INTERACTIVE, deadline_at=None):
+        """Met un job en file pour le client courant (tenant_var : celui de la
+        requête, ou du job qui soumet). Sans `deadline_at`, un job soumis par un
+        autre job hérite de son échéance."""
+        if kind not in self._handlers:
+            raise ValueError(f'Type de job inconnu: {kind}')
+        tenant = tenant_var.get()
+        if deadline_at is None and cancel_scope_var.get():
+            deadline_at = cancel_scope_var.get().deadline
+        job = Job(kind, payload, job_id=job_id, tenant=tenant, priority=priority, deadline_at=deadline_at)
+        # Le job garde le request_id de la requête (repris dans ses logs)
+        job.request_id = request_id_var.get()
+        client = self.tenants.get(tenant)
+        self.store.insert(job, weight=client.weight if client else 1.0)
+        with self._changed:
+            self._submitted += 1
+            prune = self._submitted % 50 == 0
+            self._changed.notify_all()
+        if prune:
+            self.store.prune(self._max_history)
+        return job
+
+    def get(self, job_id, with_queue=False):
+        """Statut d'un job ; avec `with_queue`, un job en file porte aussi sa
+        position et son attente estimée (`queue`)."""
+        job = self.store.get(job_id)
+        if not job:
+            return None
+        status = job.to_dict()
+        if with_queue and job.state == JOB_QUEUED:
+            status['queue'] = self.store.queue_status(job, stale_after=self.lease_seconds)
+        return status
+
+    def cancel(self, job_id):
+        """Annule un job (voir JobStore.request_cancel) ; l'exécution locale est
+        interrompue sans attendre la scrutation. Retourne son statut, None si inconnu."""
+        job, dequeued = self.store.request_cancel(job_id)
+        if not job:
+            return None
+        if dequeued:
+            # Jamais démarré : le nettoyage revient à celui qui annule
+            self._cleanup(job)
+            self._finished(job)
+        with self._changed:
+            scope = self._running.get(job_id)
+            self._changed.notify_all()
+        if scope and job.cancel_requested_at is not None:
+            scope.cancel(CANCEL_REQUESTED)
+        return job.to_dict()
+
+    def _cleanup(self, job):
+        cleanup = self._cleanups.get(job.kind)
+        if not cleanup:
+            return
+        try:
+            cleanup(job.payload)
+        except Exception:
+            logger.exception('Job %s: nettoyage après annulation en échec', job.kind)
+
+    def _finished(self, job):
+        on_finish = self._on_finish.get(job.kind)
+        if not on_finish:
+            return
+        try:
+            on_finish(job)
+        except Exception:
+            logger.exception('Job %s: hook de fin en échec', job.kind)
+
+    def list(self, state=None, kind=None, tenant=None, limit=50):
+        return [job.to_dict() for job in self.store.list(state=state, kind=kind, tenant=tenant, limit=limit)]
+
+    def load(self):
+        return self.store.load(stale_after=self.lease_seconds)
+
+    def wait_for_change(self, timeout=None):
+        """Bloque jusqu'au prochain événement local, ou au plus poll_interval
+        (les changements faits par les autres workers ne sont vus qu'en relisant)."""
+        timeout = self.poll_interval if timeout is None else min(timeout, self.poll_interval)
+        with self._changed:
+            self._changed.wait(timeout)
+
+    def emit(self, job_id, event, **data):
+        """Ajoute un événement au journal du job (ignoré si le job est inconnu)."""
+        if not job_id:
+            return
+        self.store.emit(job_id, event, data)
+        with self._changed:
+            self._changed.notify_all()
+
+    def events(self, job_id, after=0):
+        """(événements d'id > after, job terminé) ; None si le job est inconnu."""
+        return self.store.events(job_id, after)
+
+    def _reap(self):
+        """Reprend les jobs orphelins ; ceux qui ne sont pas relancés passent
+        par le nettoyage (annulés) et le hook on_finish de leur type."""
+        requeued, abandoned = self.store.requeue_orphans(self.max_attempts, self.hostname)
+        if requeued or abandoned:
+            logger.warning('Jobs orphelins: %d remis en file, %d abandonnés', len(requeued), len(abandoned),
+                           extra={'requeued': requeued, 'abandoned': [job.id for job in abandoned]})
+        for job in abandoned:
+            if job.state == JOB_CANCELLED:
+                self._cleanup(job)
+            self._finished(job)
+
+    def _worker_loop(self):
+        last_reap = time.monotonic()
+        while not self._stopping.is_set():
+            if time.monotonic() - last_reap >= self.lease_seconds:
+                last_reap = time.monotonic()
+                self._reap()
+            with self._lock:
+                kinds = sorted(self._handlers)
+                render_kinds = sorted(self._render_kinds)
+            try:
+                job = self.store.claim(kinds, self.worker_id, self.lease_seconds, tenants=self.tenants,
+                                       renderer=self.renderer, render_slots=self.render_slots,
+                                       render_kinds=render_kinds)
+            except sqlite3.Error as e:
+                logger.warning('Réclamation de job impossible: %s', e)
+                job = None
+            if job is None:
+                with self._changed:
+                    self._changed.wait(self.poll_interval)
+                continue
+            scope = CancelScope(deadline=job.deadline_at)
+            if job.cancel_requested_at is not None:
+                scope.cancel(CANCEL_REQUESTED)
+            with self._lock:
+                self._running[job.id] = scope
+            try:
+                self._run(job, scope)
+            finally:
+                with self._changed:
+                    self._running.pop(job.id, None)
+                    self._changed.notify_all()
+
+    def _supervise_loop(self):
+        """Toutes les poll_interval : annulations demandées (par n'importe quel
+        worker) et échéances des jobs locaux ; tous les tiers de bail :
+        renouvellement des baux et heartbeat."""
+        last_renew = time.monotonic()
+        while not self._stopping.wait(self.poll_interval):
+            with self._lock:
+                running = dict(self._running)
+            try:
+                if running:
+                    for job_id in self.store.cancel_requests(self.worker_id):
+                        if job_id in running:
+                            running[job_id].cancel(CANCEL_REQUESTED)
+                for scope in running.values():
+                    if scope.expired:
+                        scope.cancel(DEADLINE_EXCEEDED)
+                if time.monotonic() - last_renew >= self.lease_seconds / 3:
+                    last_renew = time.monotonic()
+                    self.store.renew(list(running), self.worker_id, self.lease_seconds)
+                    self._heartbeat()
+            except sqlite3.Error as e:
+                logger.warning('Supervision des jobs impossible: %s', e)
+
+    def _run(self, job, scope):
+        job_id_var.set(job.id)
+        request_id_var.set(job.request_id)
+        tenant_var.set(job.tenant)
+        cancel_scope_var.set(scope)
+        with self._changed:
+            self._changed.notify_all()
+        logger.info('Job %s démarré', job.kind, extra={
+            'queue_seconds': round(job.started_at - job.created_at, 3), 'attempt': job.attempts
+        })
+        try:
+            # Échu ou annulé pendant l'attente en file : le handler n'est pas lancé
+            scope.check()
+            result = self._handlers[job.kind](job.payload) or {}
+            success = result.get('success', True)
+            error = None if success else result.get('error', 'Job en échec')
+        except JobCancelled as e:
+            result, success, error = None, False, str(e)
+        except Exception as e:
+            logger.exception('Job %s: exception dans le handler', job.kind)
+            result, success, error = None, False, str(e)
+        cancelled = scope.reason == CANCEL_REQUESTED
+        if not success and not cancelled and scope.expired:
+            error = 'Échéance du job dépassée'
+        job.result = result
+        job.error = 'Job annulé' if cancelled else error
+        job.output_file = (result or {}).get('output_file')
+        job.state = JOB_CANCELLED if cancelled else JOB_DONE if success else JOB_FAILED
+        job.finished_at = time.time()
+        if cancelled:
+            self._cleanup(job)
+        if not self.store.finish(job, self.worker_id):
+            logger.warning('Job %s: bail perdu, résultat ignoré', job.kind)
+            return
+        self._finished(job)
+        logger.info('Job %s terminé: %s', job.kind, job.state, extra={
+            'run_seconds': round(job.finished_at - job.started_at, 3), 'error': error
+        })
+        if self._metrics:
+            tenant = job.tenant or 'anonymous'
+            self._metrics.inc('jobs_total', kind=job.kind, state=job.state, tenant=tenant)
+            self._metrics.observe('job_queue_seconds', job.started_at - job.created_at, kind=job.kind,
+                                  tenant=tenant, priority=job.priority)
+            self._metrics.observe('job_duration_seconds', job.finished_at - job.started_at, kind=job.kind)
@@ -0,0 +1,111 @@
+"""
+Logs structurés (une ligne JSON par événement), écrits hors du chemin critique.
+
+- Les loggers `magflow.*` passent par une QueueHandler : l'appelant ne fait
+  qu'empiler l'enregistrement ; le formatage et l'écriture sur stdout sont
+  faits par le thread d'un QueueListener. Les messages utilisent le style
+  `logger.info('... %s', valeur)` : rien n'est formaté si le niveau est
+  désactivé.
+- Chaque ligne porte le `request_id` (header X-Request-ID ou généré), le
+  `job_id` et le client d'API (`tenant`) courants, via des contextvars
+  propagées aux threads des jobs.
+- Les champs passés en `extra={...}` sont ajoutés tels quels au JSON.
+
+LOG_LEVEL (INFO par défaut) et LOG_FORMAT (`json` ou `text`) se règlent par
+variables d'environnement.
+"""
+import atexit
+import contextvars
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+from datetime import datetime, timezone
+
+request_id_var = contextvars.ContextVar('request_id', default=None)
+job_id_var = contextvars.ContextVar('job_id', default=None)
+tenant_var = contextvars.ContextVar('tenant', default=None)
+
+# Attributs standard d'un LogRecord : tout le reste vient de `extra`
+_RECORD_ATTRS = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime'}
+
+
+class ContextFilter(logging.Filter):
+    """Capture request_id / job_id / tenant dans le thread appelant, avant la mise en file."""
+
+    def filter(self, record):
+        record.request_id = request_id_var.get()
+        record.job_id = job_id_var.get()
+        record.tenant = tenant_var.get()
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            'ts': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+            'pid': record.process,
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRS and value is not None:
+                entry[key] = value
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    """Format lisible pour le développement local (LOG_FORMAT=text)."""
+
+    def format(self, record):
+        ids = ' '.join(f'{k}={getattr(record, k)}' for k in ('request_id', 'job_id', 'tenant') if getattr(record, k, None))
+        line = f'{self.formatTime(record)} {record.levelname:<7} {record.name} {record.getMessage()}'
+        line = f'{line} [{ids}]' if ids else line
+        if record.exc_info:
+            line = f'{line}\n{self.formatException(record.exc_info)}'
+        return line
+
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler qui laisse le formatage au thread du listener."""
+
+    def prepare(self, record):
+        return record
+
+
+_listener = None
+
+
+def configure_logging(level=None, fmt=None, stream=None):
+    """Installe la file + le listener sur le logger `magflow` (idempotent)."""
+    global _listener
+    level = (level or os.getenv('LOG_LEVEL', 'INFO')).upper()
+    fmt = fmt or os.getenv('LOG_FORMAT', 'json')
+
+    root = logging.getLogger('magflow')
+    root.setLevel(level)
+    if _listener:
+        return root
+
+    output = logging.StreamHandler(stream or sys.stdout)
+    output.setFormatter(TextFormatter() if fmt == 'text' else JsonFormatter())
+
+    log_queue = queue.SimpleQueue()
+    handler = DeferredQueueHandler(log_queue)
+    handler.addFilter(ContextFilter())
+    root.addHandler(handler)
+    root.propagate = False
+
+    _listener = logging.handlers.QueueListener(log_queue, output, respect_handler_level=True)
+    _listener.start()
+    atexit.register(_listener.stop)
+    return root
+
+
+def get_logger(name):
+    return logging.getLogger(f'magflow.{name}')
@@ -0,0 +1,206 @@
+"""
+Instrumentation : histogrammes de latence et compteurs, exposés au format
+texte Prometheus sur /metrics.
+
+Les valeurs sont agrégées dans une base SQLite (mode WAL) partagée par tous
+les workers gunicorn : un scrape voit le total, quel que soit le worker qui
+répond. Une écriture en échec n'interrompt jamais le pipeline instrumenté.
+
+    with metrics.stage('render', pipeline='layout') as stage:
+        result = ...
+        if not result['success']:
+            stage.fail(timeout=result.get('timeout'))
+"""
+import json
+import os
+import sqlite3
+import subprocess
+import time
+from contextlib import contextmanager
+
+from logs import get_logger
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+logger = get_logger('metrics')
+
+STAGE_SUCCESS = 'success'
+STAGE_FAILURE = 'failure'
+STAGE_TIMEOUT = 'timeout'
+
+# Aide affichée dans /metrics (noms sans le préfixe)
+METRIC_HELP = {
+    'stage_duration_seconds': "Durée d'une étape du pipeline",
+    'stage_total': "Étapes exécutées, par issue (success, failure, timeout)",
+    'job_duration_seconds': "Durée d'exécution d'un job",
+    'job_queue_seconds': "Attente d'un job dans la file, par client et priorité",
+    'jobs_total': "Jobs terminés, par type, état final et client",
+    'admission_rejections_total': "Demandes refusées par le contrôle d'admission (429)",
+    'http_request_duration_seconds': "Durée de traitement des requêtes HTTP",
+    'http_requests_total': "Requêtes HTTP, par endpoint et code de statut",
+}
+
+
+class StageTimer:
+    """Handle d'une étape en cours : durée et issue."""
+
+    def __init__(self):
+        self.outcome = STAGE_SUCCESS
+        self.duration = 0.0
+
+    def fail(self, timeout=False):
+        self.outcome = STAGE_TIMEOUT if timeout else STAGE_FAILURE
+
+
+def _labels_key(labels):
+    return json.dumps(sorted((k, str(v)) for k, v in labels.items() if v is not None))
+
+
+def _escape(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(pairs):
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{k}="{_escape(v)}"' for k, v in pairs) + '}'
+
+
+def _format_number(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) and not value.is_integer() else str(int(value))
+
+
+class Metrics:
+    """Registre de métriques ; `path=None` les désactive (seul le chronométrage reste)."""
+
+    def __init__(self, path=None, namespace='magflow', buckets=DEFAULT_BUCKETS):
+        self.path = path
+        self.namespace = namespace
+        self.buckets = tuple(sorted(buckets))
+        if not path:
+            return
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        with self._connect() as db:
+            db.execute('PRAGMA journal_mode=WAL')
+            db.executescript('''
+                CREATE TABLE IF NOT EXISTS metric_counters (
+                    name TEXT NOT NULL,
+                    labels TEXT NOT NULL,
+                    value REAL NOT NULL,
+                    PRIMARY KEY (name, labels)
+                );
+                CREATE TABLE IF NOT EXISTS metric_buckets (
+                    name TEXT NOT NULL,
+                    labels TEXT NOT NULL,
+                    le REAL NOT NULL,
+                    count INTEGER NOT NULL,
+                    PRIMARY KEY (name, labels, le)
+                );
+                CREATE TABLE IF NOT EXISTS metric_histograms (
+                    name TEXT NOT NULL,
+                    labels TEXT NOT NULL,
+                    count INTEGER NOT NULL,
+                    sum REAL NOT NULL,
+                    PRIMARY KEY (name, labels)
+                );
+            ''')
+
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=5)
+        try:
+            conn.execute('PRAGMA synchronous=NORMAL')
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def _write(self, statements):
+        if not self.path:
+            return
+        try:
+            with self._connect() as db:
+                for sql, params in statements:
+                    db.execute(sql, params)
+        except sqlite3.Error as e:
+            logger.warning('Écriture de métrique ignorée: %s', e)
+
+    def inc(self, name, amount=1, **labels):
+        self._write([(
+            'INSERT INTO metric_counters(name, labels, value) VALUES (?, ?, ?) '
+            'ON CONFLICT(name, labels) DO UPDATE SET value = value + excluded.value',
+            (name, _labels_key(labels), amount)
+        )])
+
+    def observe(self, name, value, **labels):
+        key = _labels_key(labels)
+        le = next((b for b in self.buckets if value <= b), float('inf'))
+        self._write([
+            ('INSERT INTO metric_buckets(name, labels, le, count) VALUES (?, ?, ?, 1) '
+             'ON CONFLICT(name, labels, le) DO UPDATE SET count = count + 1', (name, key, le)),
+            ('INSERT INTO metric_histograms(name, labels, count, sum) VALUES (?, ?, 1, ?) '
+             'ON CONFLICT(name, labels) DO UPDATE SET count = count + 1, sum = sum + excluded.sum',
+             (name, key, value)),
+        ])
+
+    @contextmanager
+    def stage(self, name, pipeline='layout'):
+        """Chronomètre une étape : histogramme de durée + compteur par issue.
+        Une exception marque l'étape en échec (timeout pour un TimeoutError)."""
+        timer = StageTimer()
+        started = time.monotonic()
+        try:
+            yield timer
+        except (TimeoutError, subprocess.TimeoutExpired):
+            timer.fail(timeout=True)
+            raise
+        except Exception:
+            timer.fail()
+            raise
+        finally:
+            timer.duration = time.monotonic() - started
+            self.observe('stage_duration_seconds', timer.duration, stage=name, pipeline=pipeline)
+            self.inc('stage_total', stage=name, pipeline=pipeline, outcome=timer.outcome)
+
+    def render(self):
+        """Toutes les métriques au format texte Prometheus (0.0.4)."""
+        if not self.path:
+            return ''
+        with self._connect() as db:
+            counters = db.execute('SELECT name, labels, value FROM metric_counters ORDER BY name, labels').fetchall()
+            histograms = db.execute('SELECT name, labels, count, sum FROM metric_histograms ORDER BY name, labels').fetchall()
+            buckets = db.execute('SELECT name, labels, le, count FROM metric_buckets').fetchall()
+
+        per_bucket = {}
+        for name, labels, le, count in buckets:
+            per_bucket.setdefault((name, labels), {})[le] = count
+
+        lines = []
+        described = set()
+
+        def describe(name, kind):
+            if name not in described:
+                described.add(name)
+                full = f'{self.namespace}_{name}'
+                lines.append(f'# HELP {full} {METRIC_HELP.get(name, name)}')
+                lines.append(f'# TYPE {full} {kind}')
+
+        for name, labels, value in counters:
+            describe(name, 'counter')
+            lines.append(f'{self.namespace}_{name}{_format_labels(json.loads(labels))} {_format_number(value)}')
+
+        for name, labels, count, total in histograms:
+            describe(name, 'histogram')
+            full = f'{self.namespace}_{name}'
+            pairs = json.loads(labels)
+            counts = per_bucket.get((name, labels), {})
+            cumulative = 0
+            for le in self.buckets + (float('inf'),):
+                cumulative += counts.get(le, 0)
+                lines.append(f'{full}_bucket{_format_labels(pairs + [["le", _format_number(le)]])} {cumulative}')
+            lines.append(f'{full}_sum{_format_labels(pairs)} {_format_number(total)}')
+            lines.append(f'{full}_count{_format_labels(pairs)} {count}')
+
+        return '\n'.join(lines) + '\n'
@@ -0,0 +1,185 @@
+"""
+Cache des rendus InDesign : une configuration déjà rendue ne repasse pas
+par InDesign.
+
+La clé est le JSON canonique du config.json écrit pour le rendu, sans
+`project_id` ni `created_at`, où chaque chemin d'image est remplacé par le
+SHA-256 de son contenu, complété par le hash du template et celui du script
+JSX. Même texte, mêmes images, mêmes instructions de mise en page : même
+`.indd`, qu'il suffit de lier dans `output/<project_id>.indd`.
+
+Les rendus sont stockés sous `<root>/blobs/` avec un index SQLite (mode WAL)
+partagé par les workers ; la taille totale est bornée et les rendus les
+moins récemment utilisés sont évincés en premier.
+"""
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+from image_cache import file_sha256, link_or_copy
+
+EXCLUDED_KEYS = ('project_id', 'created_at')
+COUNTERS = ('hits', 'misses', 'stores', 'evictions', 'evicted_bytes')
+
+
+def _canonical(value, digest):
+    if isinstance(value, dict):
+        return {
+            key: [digest(path) for path in item] if key == 'images' else _canonical(item, digest)
+            for key, item in value.items() if key not in EXCLUDED_KEYS
+        }
+    if isinstance(value, list):
+        return [_canonical(item, digest) for item in value]
+    return value
+
+
+def render_cache_key(config, template_sha256, script_sha256, digest=file_sha256):
+    """Clé d'un rendu ; `digest(chemin)` donne le hash du contenu d'une image."""
+    canonical = json.dumps({
+        'config': _canonical(config, digest),
+        'template_sha256': template_sha256,
+        'script_sha256': script_sha256
+    }, ensure_ascii=False, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+
+class RenderCache:
+    """Rendus .indd adressés par configuration, avec éviction LRU sur la taille."""
+
+    def __init__(self, root, max_bytes=2 * 1024 ** 3):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.blobs_dir = os.path.join(root, 'blobs')
+        os.makedirs(self.blobs_dir, exist_ok=True)
+        self.db_path = os.path.join(root, 'index.db')
+        self._lock = threading.Lock()
+        self._digests = {}  # (chemin, inode, taille, mtime) -> sha256
+        with self._connect() as db:
+            db.execute('PRAGMA journal_mode=WAL')
+            db.executescript('''
+                CREATE TABLE IF NOT EXISTS renders (
+                    key TEXT PRIMARY KEY,
+                    size INTEGER NOT NULL,
+                    created_at REAL NOT NULL,
+                    last_access REAL NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS renders_last_access ON renders(last_access);
+                CREATE TABLE IF NOT EXISTS counters (
+                    name TEXT PRIMARY KEY,
+                    value INTEGER NOT NULL
+                );
+            ''')
+
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path, timeout=30)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def _incr(self, db, name, amount=1):
+        db.execute(
+            'INSERT INTO counters(name, value) VALUES (?, ?) '
+            'ON CONFLICT(name) DO UPDATE SET value = value + excluded.value',
+            (name, amount)
+        )
+
+    def blob_path(self, key):
+        return os.path.join(self.blobs_dir, key[:2], f'{key}.indd')
+
+    def digest(self, path):
+        """SHA-256 d'un fichier, mémorisé tant que le fichier ne change pas."""
+        st = os.stat(path)
+        memo_key = (path, st.st_ino, st.st_size, st.st_mtime_ns)
+        with self._lock:
+            digest = self._digests.get(memo_key)
+        if digest is None:
+            digest = file_sha256(path)
+            with self._lock:
+                if len(self._digests) > 10000:
+                    self._digests.clear()
+                self._digests[memo_key] = digest
+        return digest
+
+    def key(self, config, template_path, script_path):
+        """Clé du rendu de `config` ; None si un fichier d'entrée est introuvable."""
+        try:
+            template_sha256 = self.digest(template_path) if template_path else None
+            return render_cache_key(config, template_sha256, self.digest(script_path), digest=self.digest)
+        except FileNotFoundError:
+            return None
+
+    def fetch(self, key, output_path):
+        """Hit : lie le rendu en cache à `output_path` et retourne True."""
+        path = self.blob_path(key)
+        with self._connect() as db:
+            row = db.execute('SELECT 1 FROM renders WHERE key = ?', (key,)).fetchone()
+            hit = bool(row) and os.path.exists(path)
+            if hit:
+                db.execute('UPDATE renders SET last_access = ? WHERE key = ?', (time.time(), key))
+            elif row:
+                db.execute('DELETE FROM renders WHERE key = ?', (key,))
+            self._incr(db, 'hits' if hit else 'misses')
+        if hit:
+            link_or_copy(path, output_path)
+        return hit
+
+    def store(self, key, output_path):
+        """Range le rendu produit pour `key` (lien, sinon copie) puis applique le quota."""
+        path = self.blob_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        link_or_copy(output_path, tmp_path)
+        os.replace(tmp_path, path)
+        now = time.time()
+        with self._connect() as db:
+            db.execute(
+                'INSERT INTO renders(key, size, created_at, last_access) VALUES (?, ?, ?, ?) '
+                'ON CONFLICT(key) DO UPDATE SET size = excluded.size, last_access = excluded.last_access',
+                (key, os.path.getsize(path), now, now)
+            )
+            self._incr(db, 'stores')
+        self.evict(keep=key)
+
+    def evict(self, keep=None):
+        """Supprime les rendus LRU tant que la taille totale dépasse max_bytes."""
+        with self._connect() as db:
+            total = db.execute('SELECT COALESCE(SUM(size), 0) FROM renders').fetchone()[0]
+            if total <= self.max_bytes:
+                return 0
+            evicted = 0
+            for key, size in db.execute('SELECT key, size FROM renders ORDER BY last_access ASC').fetchall():
+                if total <= self.max_bytes:
+                    break
+                if key == keep:
+                    continue
+                try:
+                    os.unlink(self.blob_path(key))
+                except FileNotFoundError:
+                    pass
+                db.execute('DELETE FROM renders WHERE key = ?', (key,))
+                total -= size
+                evicted += 1
+                self._incr(db, 'evictions')
+                self._incr(db, 'evicted_bytes', size)
+            return evicted
+
+    def stats(self):
+        with self._connect() as db:
+            counters = dict(db.execute('SELECT name, value FROM counters').fetchall())
+            entries, size = db.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM renders').fetchone()
+        stats = {name: counters.get(name, 0) for name in COUNTERS}
+        lookups = stats['hits'] + stats['misses']
+        stats.update({
+            'hit_ratio': round(stats['hits'] / lookups, 3) if lookups else None,
+            'entries': entries,
+            'size_bytes': size,
+            'max_bytes': self.max_bytes
+        })
+        return stats
@@ -0,0 +1,477 @@
+"""
+Pool de sessions de rendu InDesign.
+
+Chaque session est longue durée : InDesign est activé une seule fois au
+warm-up, puis les scripts sont lancés sans fichier AppleScript temporaire.
+Les sessions sont vérifiées (health check) et recyclées après N jobs.
+
+Toutes les sessions osascript d'une machine pilotent la même application
+InDesign, et `script args of script preferences` est un réglage global de
+l'application : un verrou de fichier (flock) par instance InDesign,
+partagé par les sessions et par les processus gunicorn, sérialise donc
+chaque couple « script args + do script ». RENDERER_POOL_SIZE est un nombre
+de sessions par processus, pas un nombre d'instances InDesign. L'ordre des
+rendus est décidé par la file des jobs, qui ne démarre pas plus de jobs de
+rendu que l'instance n'a d'emplacements : le verrou ne fait normalement
+qu'attendre la fin d'un script qui s'arrête. Cette attente, bornée par
+INDESIGN_LOCK_TIMEOUT_SECONDS, n'est pas décomptée du timeout du rendu.
+
+Un rendu peut être interrompu par la CancelScope de son job (annulation ou
+échéance) ou par son timeout. Tuer osascript n'arrête pas le script déjà
+lancé dans InDesign : l'arrêt est donc coopératif. Le renderer crée le
+fichier `stopPath` (scriptArg), que les scripts JSX vérifient entre leurs
+étapes pour fermer le document et rendre la main ; le verrou de l'instance
+reste tenu jusque-là, l'instance est donc vraiment libre quand le rendu
+suivant démarre. Faute de réponse après RENDERER_CANCEL_GRACE_SECONDS,
+osascript est tué, la session marquée `broken` et recyclée avant d'être
+réutilisée.
+
+Backends disponibles (RENDERER_BACKEND) :
+- osascript : InDesign via AppleScript (macOS)
+- fake      : écrit un .indd factice, pour les tests de charge sous Linux
+"""
+import fcntl
+import json
+import os
+import queue
+import re
+import random
+import socket
+import subprocess
+import tempfile
+import threading
+import time
+import uuid
+from contextlib import contextmanager, nullcontext
+
+from cancellation import DEADLINE_EXCEEDED
+from logs import get_logger
+
+logger = get_logger('renderers')
+
+
+def _applescript_string(value):
+    return '"' + str(value).replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+
+def _interrupted_result(cancel):
+    """Résultat d'un rendu interrompu par sa CancelScope."""
+    if cancel.reason == DEADLINE_EXCEEDED:
+        return {'success': False, 'error': 'Échéance du job dépassée', 'timeout': True}
+    return {'success': False, 'error': 'Rendu annulé', 'cancelled': True}
+
+
+class _Interrupted(Exception):
+    """Annulation survenue pendant l'attente d'une session libre."""
+
+
+class InstanceLock:
+    """Verrou exclusif inter-processus (flock) sur une instance InDesign.
+
+    flock porte sur le descripteur ouvert : deux sessions du même processus
+    s'excluent comme deux workers gunicorn."""
+
+    def __init__(self, path):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.path = path
+
+    @contextmanager
+    def hold(self, timeout, cancel=None):
+        """Tient le verrou pendant le bloc. Lève TimeoutError au-delà de
+        `timeout`, _Interrupted si `cancel` est annulée pendant l'attente."""
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            expires_at = time.monotonic() + timeout
+            while True:
+                try:
+                    fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    break
+                except BlockingIOError:
+                    if time.monotonic() >= expires_at:
+                        raise TimeoutError('InDesign occupé par un autre rendu')
+                    if cancel is not None and cancel.wait(0.1):
+                        raise _Interrupted()
+                    if cancel is None:
+                        time.sleep(0.1)
+            yield
+        finally:
+            os.close(fd)
+
+
+class RendererSession:
+    """Session de rendu : interface commune aux backends."""
+
+    backend = None
+
+    def __init__(self, session_id):
+        self.session_id = session_id
+        self.jobs_done = 0
+        self.created_at = time.time()
+        self.last_health_check = 0.0
+        self.broken = False
+
+    def warm_up(self):
+        pass
+
+    def healthy(self):
+        return True
+
+    def run_script(self, script_path, script_args, timeout, cancel=None):
+        """Exécute un script JSX, interrompu si `cancel` (CancelScope) est annulée.
+        Retourne {'success': bool, 'error': str?, 'timeout'/'cancelled': bool?}."""
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class OsascriptRenderer(RendererSession):
+    """Pilote InDesign via osascript, sans ré-activer l'application à chaque job."""
+
+    backend = 'osascript'
+
+    def __init__(self, session_id, app_name, instance_lock, cancel_grace=30.0, lock_timeout=120.0):
+        super().__init__(session_id)
+        self.app_name = app_name
+        self.instance_lock = instance_lock
+        self.cancel_grace = cancel_grace
+        self.lock_timeout = lock_timeout
+
+    def _osascript(self, applescript, timeout):
+        """osascript -e, tué au timeout."""
+        return subprocess.run(['osascript', '-e', applescript], capture_output=True, text=True, timeout=timeout)
+
+    def _osascript_stoppable(self, applescript, timeout, cancel, stop_path):
+        """osascript -e. Au timeout ou à l'annulation de `cancel`, le script JSX
+        est prié de s'arrêter (création de `stop_path`), puis osascript est tué
+        s'il n'a pas rendu la main après cancel_grace secondes.
+        Retourne (CompletedProcess, timeout atteint)."""
+        proc = subprocess.Popen(['osascript', '-e', applescript], stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE, text=True)
+        killer = threading.Timer(self.cancel_grace, proc.kill)
+        stopping = threading.Event()
+
+        def stop():
+            if stopping.is_set():
+                return
+            stopping.set()
+            with open(stop_path, 'w'):
+                pass
+            killer.start()
+
+        timed_out = False
+        try:
+            with cancel.on_cancel(stop) if cancel else nullcontext():
+                try:
+                    stdout, stderr = proc.communicate(timeout=timeout)
+                except subprocess.TimeoutExpired:
+                    timed_out = True
+                    stop()
+                    stdout, stderr = proc.communicate()
+        finally:
+            killer.cancel()
+        return subprocess.CompletedProcess(proc.args, proc.returncode, stdout, stderr), timed_out
+
+    def warm_up(self):
+        self._osascript(f'tell application {_applescript_string(self.app_name)} to activate', timeout=120)
+
+    def healthy(self):
+        try:
+            result = self._osascript(f'tell application {_applescript_string(self.app_name)} to get name', timeout=15)
+            return result.returncode == 0
+        except Exception:
+            return False
+
+    def run_script(self, script_path, script_args, timeout, cancel=None):
+        # Demande d'arrêt coopératif, vérifiée par le script JSX entre ses étapes
+        stop_path = os.path.join(tempfile.gettempdir(), f'magflow-stop-{uuid.uuid4().hex}')
+        args = ', '.join(
+            f'{{class:script arg, name:{_applescript_string(name)}, value:{_applescript_string(value)}}}'
+            for name, value in dict(script_args, stopPath=stop_path).items()
+        )
+        lines = [f'tell application {_applescript_string(self.app_name)}']
+        if args:
+            lines.append(f'    set script args of script preferences to {{{args}}}')
+        lines.append(f'    do script POSIX file {_applescript_string(script_path)} language javascript')
+        lines.append('end tell')
+        try:
+            # script args est global à l'application : un seul rendu à la fois par instance.
+            # Le timeout du rendu ne court qu'une fois l'instance obtenue
+            with self.instance_lock.hold(self.lock_timeout, cancel=cancel):
+                result, timed_out = self._osascript_stoppable('\n'.join(lines), timeout, cancel, stop_path)
+        except _Interrupted:
+            return _interrupted_result(cancel)
+        except TimeoutError as e:
+            return {'success': False, 'error': str(e), 'timeout': True}
+        if result.returncode < 0:
+            # Tué sans avoir rendu la main : le script a pu rester à mi-chemin dans
+            # InDesign, et `stop_path` est laissé en place pour qu'il s'arrête
+            self.broken = True
+        elif os.path.exists(stop_path):
+            os.unlink(stop_path)
+        if timed_out:
+            return {'success': False, 'error': 'Timeout lors de l\'exécution du script InDesign', 'timeout': True}
+        if cancel is not None and cancel.cancelled:
+            return _interrupted_result(cancel)
+        if result.returncode != 0:
+            return {'success': False, 'error': f'Erreur script InDesign: {result.stderr}'}
+        return {'success': True}
+
+
+class FakeRenderer(RendererSession):
+    """Backend factice : simule la latence d'InDesign et écrit des sorties stub."""
+
+    backend = 'fake'
+
+    def __init__(self, session_id, latency=0.0, jitter=0.0):
+        super().__init__(session_id)
+        self.latency = latency
+        self.jitter = jitter  # variation relative de la latence (0.2 = ±20 %)
+
+    def run_script(self, script_path, script_args, timeout, cancel=None):
+        latency = self.latency * random.uniform(1 - self.jitter, 1 + self.jitter) if self.jitter else self.latency
+        if latency > timeout:
+            if self._sleep(timeout, cancel):
+                return _interrupted_result(cancel)
+            return {'success': False, 'error': 'Timeout lors de l\'exécution du script InDesign', 'timeout': True}
+        if self._simulate_progress(script_args.get('progressPath'), latency, cancel=cancel):
+            return _interrupted_result(cancel)
+        name = os.path.basename(script_path)
+        if name == 'analyze_and_thumbnail.jsx':
+            return self._fake_analysis(script_args)
+        return self._fake_layout(script_args)
+
+    @staticmethod
+    def _sleep(seconds, cancel):
+        """Attend `seconds` ; True si `cancel` a été annulée entre-temps."""
+        if cancel is None:
+            time.sleep(seconds)
+            return False
+        return cancel.wait(seconds)
+
+    def _simulate_progress(self, progress_path, latency, steps=4, cancel=None):
+        """Attend `latency` en écrivant, comme les scripts JSX, une ligne de progression
+        par étape. True si le rendu a été annulé en route."""
+        for step in range(1, steps + 1):
+            if self._sleep(latency / steps, cancel):
+                return True
+            if progress_path:
+                with open(progress_path, 'a', encoding='utf-8') as f:
+                    f.write(json.dumps({'percent': step * 100 // steps, 'message': f'Étape {step}/{steps}'}) + '\n')
+        return False
+
+    def _fake_layout(self, script_args):
+        output_path = script_args.get('outputPath')
+        if not output_path:
+            return {'success': False, 'error': 'outputPath manquant'}
+        with open(script_args['configPath'], 'r', encoding='utf-8') as f:
+            config = json.load(f)
+        os.makedirs(os.path.dirname(output_path) or '.', exist_ok=True)
+        with open(output_path, 'w', encoding='utf-8') as f:
+            json.dump({'fake_indd': True, 'project_id': config.get('project_id'),
+                       'articles': len(config.get('articles', [])) or 1,
+                       'images': len(config.get('images', []))}, f)
+        return {'success': True}
+
+    def _fake_analysis(self, script_args):
+        results_path = script_args['resultsPath']
+        with open(script_args['configPath'], 'r', encoding='utf-8') as f:
+            config = json.load(f)
+        template_path = config['template_path']
+        stem = os.path.splitext(os.path.basename(template_path))[0]
+        thumb_name = config.get('thumbnail_name') or f'{stem}_thumbnail.jpg'
+        thumb_path = os.path.join(config['output_dir'], thumb_name)
+        from PIL import Image
+        Image.new('RGB', (int(config.get('thumbnail_width', 800)), int(config.get('thumbnail_height', 600))),
+                  (240, 240, 240)).save(thumb_path, 'JPEG')
+        results = {
+            'success': True,
+            'template': {
+                'filename': os.path.basename(template_path),
+                'path': template_path,
+                'placeholders': ['{{TITRE}}', '{{TEXTE}}'],
+                'image_slots': 1,
+                'fonts': [],
+                'colors': [],
+                'page_count': 1,
+                'width': 595.276,
+                'height': 841.89,
+                'units': 'points'
+            },
+            'thumbnail': {'path': thumb_path, 'filename': thumb_name},
+            'errors': []
+        }
+        with open(results_path, 'w', encoding='utf-8') as f:
+            json.dump(results, f)
+        return {'success': True}
+
+
+class RendererPool:
+    """Pool borné de sessions de rendu réutilisables."""
+
+    def __init__(self, factory, size=1, max_jobs_per_session=50, health_check_interval=60.0, backend=None,
+                 instance=None, instance_slots=None):
+        self._factory = factory
+        self.backend = backend
+        self.size = max(1, size)
+        # Instance de rendu partagée entre processus (clé de son verrou) et nombre
+        # de rendus simultanés qu'elle accepte ; None : pool propre au processus
+        self.instance = instance
+        self.instance_slots = instance_slots
+        self.max_jobs_per_session = max_jobs_per_session
+        self.health_check_interval = health_check_interval
+        self._idle = queue.Queue()
+        self._lock = threading.Lock()
+        self._next_id = 0
+        self._created = 0
+        self.stats_counters = {'jobs': 0, 'failures': 0, 'cancelled': 0, 'recycled': 0, 'unhealthy': 0}
+
+    def _new_session(self):
+        with self._lock:
+            self._next_id += 1
+            session_id = self._next_id
+        session = self._factory(session_id)
+        try:
+            session.warm_up()
+            session.last_health_check = time.time()
+        except Exception as e:
+            # Le health check du prochain acquire décidera si la session est utilisable
+            logger.warning('Warm-up de la session %s échoué: %s', session_id, e)
+        return session
+
+    def start(self, background=True):
+        """Crée et préchauffe toutes les sessions (en tâche de fond par défaut)."""
+        def _fill():
+            while True:
+                with self._lock:
+                    if self._created >= self.size:
+                        return
+                    self._created += 1
+                self._idle.put(self._new_session())
+
+        if background:
+            threading.Thread(target=_fill, name='renderer-warmup', daemon=True).start()
+        else:
+            _fill()
+
+    def _recycle(self, session, reason):
+        with self._lock:
+            self.stats_counters[reason] += 1
+        logger.info('Session %s recyclée (%s) après %s jobs', session.session_id, reason, session.jobs_done)
+        try:
+            session.close()
+        except Exception:
+            pass
+        return self._new_session()
+
+    def _wait_idle(self, timeout, cancel):
+        """Prochaine session libre ; l'attente s'interrompt si `cancel` est annulée."""
+        expires_at = None if timeout is None else time.monotonic() + timeout
+        while True:
+            if cancel is not None and cancel.cancelled:
+                raise _Interrupted()
+            remaining = None if expires_at is None else expires_at - time.monotonic()
+            if remaining is not None and remaining <= 0:
+                raise TimeoutError('Aucun renderer InDesign disponible')
+            # Sans scope d'annulation, une seule attente bloquante suffit
+            wait = remaining if cancel is None else (0.2 if remaining is None else min(0.2, remaining))
+            try:
+                return self._idle.get(timeout=wait)
+            except queue.Empty:
+                if cancel is None:
+                    raise TimeoutError('Aucun renderer InDesign disponible')
+
+    @contextmanager
+    def acquire(self, timeout=None, cancel=None):
+        with self._lock:
+            lazily_create = self._created < self.size and self._idle.empty()
+            if lazily_create:
+                self._created += 1
+        if lazily_create:
+            session = self._new_session()
+        else:
+            session = self._wait_idle(timeout, cancel)
+
+        if session.broken or session.jobs_done >= self.max_jobs_per_session:
+            session = self._recycle(session, 'recycled')
+        elif time.time() - session.last_health_check > self.health_check_interval:
+            session.last_health_check = time.time()
+            if not session.healthy():
+                session = self._recycle(session, 'unhealthy')
+        try:
+            yield session
+        finally:
+            self._idle.put(session)
+
+    def run(self, script_path, script_args, timeout, cancel=None):
+        """Exécute un script sur une session libre du pool ; `cancel` (CancelScope)
+        interrompt l'attente d'une session comme le rendu lui-même."""
+        try:
+            with self.acquire(timeout=timeout, cancel=cancel) as session:
+                try:
+                    result = session.run_script(script_path, script_args, timeout, cancel=cancel)
+                except Exception as e:
+                    session.broken = True
+                    result = {'success': False, 'error': f'Erreur lors de l\'exécution: {str(e)}'}
+                session.jobs_done += 1
+        except TimeoutError as e:
+            result = {'success': False, 'error': str(e), 'timeout': True}
+        except _Interrupted:
+            result = _interrupted_result(cancel)
+        with self._lock:
+            self.stats_counters['jobs'] += 1
+            if result.get('cancelled'):
+                self.stats_counters['cancelled'] += 1
+            elif not result.get('success'):
+                self.stats_counters['failures'] += 1
+        return result
+
+    @property
+    def slots(self):
+        """Rendus simultanés possibles (pour une instance partagée, tous processus confondus)."""
+        return self.size if self.instance_slots is None else min(self.size, self.instance_slots)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'backend': self.backend,
+                'size': self.size,
+                'slots': self.slots,
+                'started': self._created,
+                'idle': self._idle.qsize(),
+                'max_jobs_per_session': self.max_jobs_per_session,
+                **self.stats_counters
+            }
+
+
+def create_renderer_pool_from_env():
+    """Construit le pool d'après RENDERER_BACKEND, RENDERER_POOL_SIZE, etc."""
+    backend = os.getenv('RENDERER_BACKEND', 'osascript')
+    instance = instance_slots = None
+    if backend == 'fake':
+        latency = float(os.getenv('FAKE_RENDER_LATENCY', '0.5'))
+        jitter = float(os.getenv('FAKE_RENDER_JITTER', '0'))
+        factory = lambda session_id: FakeRenderer(session_id, latency=latency, jitter=jitter)
+    elif backend == 'osascript':
+        app_name = os.getenv('INDESIGN_APP_NAME', 'Adobe InDesign 2026')
+        slug = re.sub(r'[^A-Za-z0-9]+', '-', app_name).strip('-').lower()
+        instance_lock = InstanceLock(os.path.abspath(
+            os.getenv('INDESIGN_LOCK_PATH', os.path.join('cache', f'{slug}.lock'))
+        ))
+        # Une seule application InDesign par machine, qui exécute un script à la fois
+        instance, instance_slots = f'{socket.gethostname()}:{instance_lock.path}', 1
+        cancel_grace = float(os.getenv('RENDERER_CANCEL_GRACE_SECONDS', '30'))
+        lock_timeout = float(os.getenv('INDESIGN_LOCK_TIMEOUT_SECONDS', '120'))
+        factory = lambda session_id: OsascriptRenderer(session_id, app_name, instance_lock,
+                                                       cancel_grace, lock_timeout)
+    else:
+        raise ValueError(f'RENDERER_BACKEND inconnu: {backend}')
+    return RendererPool(
+        factory,
+        size=int(os.getenv('RENDERER_POOL_SIZE', '1')),
+        max_jobs_per_session=int(os.getenv('RENDERER_MAX_JOBS', '50')),
+        health_check_interval=float(os.getenv('RENDERER_HEALTH_INTERVAL', '60')),
+        backend=backend,
+        instance=instance,
+        instance_slots=instance_slots,
+    )
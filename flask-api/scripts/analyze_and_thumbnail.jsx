@@ -2,10 +2,17 @@
  * MagFlow - Analyse Template et Génération Miniature
  * Ce script ouvre un template InDesign, extrait ses métadonnées et génère une miniature
  * 
+ * Arguments (scriptArgs) : configPath et resultsPath. À défaut, le script lit
+ * analysis/config.json et écrit analysis/results.json. progressPath (optionnel)
+ * reçoit une ligne JSON par étape, relayée par Flask en événements de progression.
+ * stopPath (optionnel) : fichier créé par Flask pour demander l'arrêt, vérifié
+ * entre les étapes.
+ *
  * Configuration attendue dans config.json:
  * {
  *   "template_path": "/chemin/vers/template.indt",
  *   "output_dir": "/chemin/vers/output/",
+ *   "thumbnail_name": "template_<sha>_800x600_thumbnail.jpg",  // optionnel
  *   "thumbnail_width": 800,
  *   "thumbnail_height": 600
  * }
@@ -85,6 +92,17 @@ var BASE_PATH = scriptFile.parent.parent.fsName; // Remonte au dossier flask-api
 var CONFIG_PATH = BASE_PATH + '/analysis/config.json';
 var OUTPUT_PATH = BASE_PATH + '/analysis/results.json';
 
+// Chemins propres à chaque analyse, passés par Flask via scriptArgs
+// (analysis/jobs/<id>/config.json et results.json) : analyses parallèles isolées
+if (app.scriptArgs.isDefined('configPath')) {
+    CONFIG_PATH = app.scriptArgs.getValue('configPath');
+}
+if (app.scriptArgs.isDefined('resultsPath')) {
+    OUTPUT_PATH = app.scriptArgs.getValue('resultsPath');
+}
+var PROGRESS_PATH = app.scriptArgs.isDefined('progressPath') ? app.scriptArgs.getValue('progressPath') : '';
+var STOP_PATH = app.scriptArgs.isDefined('stopPath') ? app.scriptArgs.getValue('stopPath') : '';
+
 // ============================================
 // FONCTIONS UTILITAIRES
 // ============================================
@@ -109,6 +127,28 @@ function writeFile(filePath, content) {
     file.close();
 }
 
+function reportProgress(percent, message) {
+    if (!PROGRESS_PATH) {
+        return;
+    }
+    try {
+        var file = new File(PROGRESS_PATH);
+        file.encoding = 'UTF-8';
+        file.open('a');
+        file.writeln(JSON.stringify({ percent: Math.round(percent), message: message }));
+        file.close();
+    } catch (e) {
+        // Progression indicative : ne jamais interrompre l'analyse
+    }
+}
+
+// Point d'arrêt entre deux étapes (annulation, échéance ou timeout côté Flask)
+function throwIfStopped() {
+    if (STOP_PATH && new File(STOP_PATH).exists) {
+        throw new Error('Analyse interrompue à la demande de Flask');
+    }
+}
+
 function ensureFolder(folderPath) {
     var folder = new Folder(folderPath);
     if (!folder.exists) {
@@ -241,11 +281,24 @@ function extractDocumentInfo(doc) {
         units: 'points'
     };
     
+    // page.bounds est exprimé dans les unités des règles du document (souvent
+    // des millimètres) : on passe en points le temps de la lecture
+    var prefs = doc.viewPreferences;
+    var horizontalUnits = prefs.horizontalMeasurementUnits;
+    var verticalUnits = prefs.verticalMeasurementUnits;
     try {
+        prefs.horizontalMeasurementUnits = MeasurementUnits.POINTS;
+        prefs.verticalMeasurementUnits = MeasurementUnits.POINTS;
         var page = doc.pages[0];
         info.width = page.bounds[3] - page.bounds[1];
         info.height = page.bounds[2] - page.bounds[0];
-    } catch (e) {}
+    } catch (e) {
+        info.width = 0;
+        info.height = 0;
+    } finally {
+        prefs.horizontalMeasurementUnits = horizontalUnits;
+        prefs.verticalMeasurementUnits = verticalUnits;
+    }
     
     return info;
 }
@@ -329,6 +382,8 @@ function analyzeTemplate() {
         
         // Ouvrir le template
         var doc = app.open(templateFile);
+        reportProgress(20, 'Template ouvert');
+        throwIfStopped();
         
         // Extraire les métadonnées
         var placeholders = extractPlaceholders(doc);
@@ -336,12 +391,14 @@ function analyzeTemplate() {
         var fonts = extractFonts(doc);
         var colors = extractColors(doc);
         var docInfo = extractDocumentInfo(doc);
+        reportProgress(60, 'Métadonnées extraites');
+        throwIfStopped();
         
         // Extraire le nom du fichier
         var fileName = templateFile.name;
         
-        // Générer le chemin de la miniature
-        var thumbnailName = fileName.replace(/\.(indt|indd)$/i, '_thumbnail.jpg');
+        // Générer le chemin de la miniature (nom fourni par Flask, propre au contenu du template)
+        var thumbnailName = config.thumbnail_name || fileName.replace(/\.(indt|indd)$/i, '_thumbnail.jpg');
         var thumbnailPath = outputDir + thumbnailName;
         
         // S'assurer que le dossier de sortie existe
@@ -349,6 +406,7 @@ function analyzeTemplate() {
         
         // Générer la miniature
         var thumbnailResult = generateThumbnail(doc, thumbnailPath, thumbnailWidth, thumbnailHeight);
+        reportProgress(90, 'Miniature générée');
         
         // Fermer le document sans sauvegarder
         doc.close(SaveOptions.NO);
@@ -364,7 +422,8 @@ function analyzeTemplate() {
             colors: colors,
             page_count: docInfo.pageCount,
             width: docInfo.width,
-            height: docInfo.height
+            height: docInfo.height,
+            units: docInfo.units
         };
         
         if (thumbnailResult.success) {
@@ -390,6 +449,7 @@ function analyzeTemplate() {
     
     // Écrire les résultats
     writeFile(OUTPUT_PATH, JSON.stringify(results));
+    reportProgress(100, results.success ? 'Analyse terminée' : 'Analyse en échec');
     
     // Alert finale (optionnelle)
     // alert('Analyse terminée: ' + (results.success ? 'Succès' : 'Échec'));
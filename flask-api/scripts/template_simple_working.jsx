@@ -1,10 +1,46 @@
 /**
  * Script de génération de magazine InDesign (MagFlow)
  * Lit la configuration JSON et remplit le template
+ *
+ * Mode multi-articles : si config.articles est une liste, les spreads du
+ * template sont dupliqués pour chaque article et le numéro complet est
+ * produit en une seule ouverture/sauvegarde.
  */
 
 #target "InDesign"
 
+// Fichier de progression suivi par Flask (une ligne JSON par étape), optionnel
+var PROGRESS_PATH = app.scriptArgs.isDefined("progressPath") ? app.scriptArgs.getValue("progressPath") : "";
+// Fichier créé par Flask pour demander l'arrêt (annulation, échéance, timeout), optionnel
+var STOP_PATH = app.scriptArgs.isDefined("stopPath") ? app.scriptArgs.getValue("stopPath") : "";
+var STOPPED_MESSAGE = "Rendu interrompu à la demande de Flask";
+
+function escapeJsonString(str) {
+    return String(str).replace(/\\/g, "\\\\").replace(/"/g, '\\"').replace(/\n/g, "\\n").replace(/\r/g, "\\r");
+}
+
+function reportProgress(percent, message) {
+    if (!PROGRESS_PATH) {
+        return;
+    }
+    try {
+        var progressFile = new File(PROGRESS_PATH);
+        progressFile.encoding = "UTF-8";
+        progressFile.open("a");
+        progressFile.writeln('{"percent": ' + Math.round(percent) + ', "message": "' + escapeJsonString(message) + '"}');
+        progressFile.close();
+    } catch (e) {
+        // La progression est indicative : ne jamais interrompre le rendu
+    }
+}
+
+// Point d'arrêt entre deux étapes : libère InDesign au plus vite après une annulation
+function throwIfStopped() {
+    if (STOP_PATH && new File(STOP_PATH).exists) {
+        throw new Error(STOPPED_MESSAGE);
+    }
+}
+
 function main() {
     // Désactiver les dialogues
     app.scriptPreferences.userInteractionLevel = UserInteractionLevels.NEVER_INTERACT;
@@ -46,6 +82,8 @@ function main() {
         
         // Parser le JSON (eval sécurisé pour ExtendScript)
         var config = eval("(" + configContent + ")");
+        reportProgress(10, "Configuration lue");
+        throwIfStopped();
 
         // 2. Ouvrir le template
         // Le template peut être un nom (dans le dossier templates par défaut) ou un chemin absolu
@@ -82,9 +120,15 @@ function main() {
         }
 
         var doc = app.open(templateFile);
+        reportProgress(30, "Template ouvert");
+        throwIfStopped();
 
         // 3. Remplissage du contenu
-        processDocument(doc, config);
+        if (config.articles && config.articles.length) {
+            processIssue(doc, config.articles);
+        } else {
+            processDocument(doc, config);
+        }
 
         // 4. Sauvegarde
         // Le nom de fichier de sortie est basé sur le project_id
@@ -99,6 +143,13 @@ function main() {
         // et Flask s'occupera de le déplacer si nécessaire, ou on le met direct dans flask-api/output
         
         var outputFile = new File(outputFolder + "/" + outputName);
+
+        // Chemin de sortie explicite fourni par Flask (output/<project_id>.indd)
+        if (app.scriptArgs.isDefined("outputPath")) {
+            outputFile = new File(app.scriptArgs.getValue("outputPath"));
+        }
+        throwIfStopped();
+        reportProgress(90, "Sauvegarde du document");
         doc.save(outputFile);
         
         // Export PDF (optionnel, pour preview rapide)
@@ -106,15 +157,59 @@ function main() {
         // doc.exportFile(ExportFormat.PDF_TYPE, pdfFile);
 
         doc.close(SaveOptions.NO);
+        reportProgress(100, "Terminé");
 
     } catch (e) {
-        alert("Erreur InDesign : " + e.message + " (Ligne " + e.line + ")");
+        // Ne pas laisser le document ouvert dans l'instance partagée
+        try {
+            if (doc && doc.isValid) {
+                doc.close(SaveOptions.NO);
+            }
+        } catch (closeError) {}
+        if (e.message !== STOPPED_MESSAGE) {
+            alert("Erreur InDesign : " + e.message + " (Ligne " + e.line + ")");
+        }
     } finally {
         app.scriptPreferences.userInteractionLevel = UserInteractionLevels.INTERACT_WITH_ALL;
     }
 }
 
 function processDocument(doc, config) {
+    processItems(doc.allPageItems, config);
+}
+
+function processIssue(doc, articles) {
+    // Spreads d'origine du template = gabarit d'un article
+    var templateSpreads = [];
+    for (var s = 0; s < doc.spreads.length; s++) {
+        templateSpreads.push(doc.spreads[s]);
+    }
+
+    // Dupliquer le gabarit pour les articles 2..N avant tout remplissage
+    var articleSpreads = [templateSpreads];
+    for (var a = 1; a < articles.length; a++) {
+        var copies = [];
+        for (var t = 0; t < templateSpreads.length; t++) {
+            copies.push(templateSpreads[t].duplicate(LocationOptions.AT_END));
+        }
+        articleSpreads.push(copies);
+    }
+
+    for (var i = 0; i < articles.length; i++) {
+        var items = [];
+        for (var k = 0; k < articleSpreads[i].length; k++) {
+            var spreadItems = articleSpreads[i][k].allPageItems;
+            for (var n = 0; n < spreadItems.length; n++) {
+                items.push(spreadItems[n]);
+            }
+        }
+        processItems(items, articles[i]);
+        reportProgress(30 + 60 * (i + 1) / articles.length, "Article " + (i + 1) + "/" + articles.length);
+        throwIfStopped();
+    }
+}
+
+function processItems(allItems, config) {
     // A. Remplissage des Textes
     // On cherche les frames par leur nom de script (label) ou par contenu placeholder
     
@@ -138,8 +233,9 @@ function processDocument(doc, config) {
         if (config.layout_instructions.title_text) data.titre = config.layout_instructions.title_text;
     }
 
-    var allItems = doc.allPageItems;
-    
+    // Compteur d'images placées (propre à chaque article)
+    var imageIndex = 0;
+
     for (var i = 0; i < allItems.length; i++) {
         var item = allItems[i];
         
@@ -177,11 +273,8 @@ function processDocument(doc, config) {
             var h = bounds[2] - bounds[0];
             
             if (w > 20 && h > 20) {
-                // On utilise une propriété statique pour compter les images déjà placées
-                if (typeof main.imageIndex == 'undefined') main.imageIndex = 0;
-                
-                if (config.images && main.imageIndex < config.images.length) {
-                    var imagePath = config.images[main.imageIndex];
+                if (config.images && imageIndex < config.images.length) {
+                    var imagePath = config.images[imageIndex];
                     var imgFile = new File(imagePath);
                     
                     if (imgFile.exists) {
@@ -189,7 +282,7 @@ function processDocument(doc, config) {
                             item.place(imgFile);
                             item.fit(FitOptions.FILL_PROPORTIONALLY);
                             item.fit(FitOptions.CENTER_CONTENT);
-                            main.imageIndex++;
+                            imageIndex++;
                         } catch(e) {
                             // Ignorer erreur de placement
                         }
@@ -0,0 +1,151 @@
+"""
+Catalogue des templates disponibles, servi depuis la mémoire.
+
+Le catalogue joint la liste des fichiers de `indesign_templates/` aux analyses
+en cache (placeholders, polices, dimensions, miniature). Il n'est reconstruit
+que si un fichier a changé (inode, taille, mtime : un remplacement ou une
+réécriture sur place se voient aussi) ou si une analyse a été ajoutée/invalidée ;
+cette vérification elle-même n'a lieu qu'une fois toutes les
+`refresh_interval` secondes, les requêtes entre-temps répondent directement
+depuis l'index en mémoire.
+"""
+import hashlib
+import json
+import os
+import threading
+import time
+
+from image_cache import file_sha256
+
+
+class TemplateCatalog:
+    """Index en mémoire : fichiers templates + analyses en cache."""
+
+    def __init__(self, templates_dir, extensions, analysis_cache=None, store=None, refresh_interval=2.0):
+        self.templates_dir = templates_dir
+        self.extensions = tuple(extensions)
+        self.analysis_cache = analysis_cache
+        self.store = store
+        self.refresh_interval = refresh_interval
+        self._lock = threading.Lock()
+        self._entries = []
+        self._version = None
+        self._stamp = None
+        self._checked_at = 0
+        self._hashes = {}  # (inode, taille, mtime) -> sha256, évite de re-hacher
+        self.rebuilds = 0
+
+    def invalidate(self):
+        """Force une vérification à la prochaine lecture (ex. après une analyse)."""
+        with self._lock:
+            self._checked_at = 0
+
+    def snapshot(self):
+        """(version, entrées) à jour ; la version sert d'ETag."""
+        with self._lock:
+            now = time.time()
+            if now - self._checked_at >= self.refresh_interval:
+                self._checked_at = now
+                stamp = self._current_stamp()
+                if stamp != self._stamp:
+                    self._entries = self._build()
+                    self._version = hashlib.sha256(
+                        json.dumps(self._entries, sort_keys=True).encode('utf-8')
+                    ).hexdigest()[:32]
+                    self._stamp = stamp
+                    self.rebuilds += 1
+            return self._version, self._entries
+
+    def _files(self):
+        """[(nom, chemin, stat)] des templates du dossier, triés par nom."""
+        try:
+            names = sorted(os.listdir(self.templates_dir))
+        except FileNotFoundError:
+            names = []
+        files = []
+        for name in names:
+            if name.startswith('.') or os.path.splitext(name)[1].lower() not in self.extensions:
+                continue
+            path = os.path.join(self.templates_dir, name)
+            try:
+                files.append((name, path, os.stat(path)))
+            except FileNotFoundError:
+                continue
+        return files
+
+    def _current_stamp(self):
+        files = tuple((name, st.st_ino, st.st_size, st.st_mtime_ns) for name, _, st in self._files())
+        analyses = self.analysis_cache.generation() if self.analysis_cache else None
+        return files, analyses
+
+    def _sha256(self, name, path, st, indexed):
+        key = (st.st_ino, st.st_size, st.st_mtime_ns)
+        known = indexed.get(name)
+        if known and (known.get('inode'), known['size'], known.get('mtime_ns')) == key:
+            return known['sha256']
+        if key not in self._hashes:
+            self._hashes[key] = file_sha256(path)
+        return self._hashes[key]
+
+    def _build(self):
+        analyses = self.analysis_cache.latest_by_template() if self.analysis_cache else {}
+        indexed = self.store.current() if self.store else {}
+        entries = []
+        for name, path, st in self._files():
+            stem = os.path.splitext(name)[0]
+            sha256 = self._sha256(name, path, st, indexed)
+            results = analyses.get(sha256) or {}
+            info = results.get('template') or {}
+            thumbnail = results.get('thumbnail') or {}
+            thumbnail_url = thumbnail.get('url') or (
+                f"/api/thumbnails/{thumbnail['filename']}" if thumbnail.get('filename') else None
+            )
+            entries.append({
+                'name': stem,
+                'filename': name,
+                'sha256': sha256,
+                'version': (indexed.get(name) or {}).get('version'),
+                'size': st.st_size,
+                'modified_at': st.st_mtime,
+                'analyzed': bool(results),
+                'placeholders': info.get('placeholders', []),
+                'image_slots': info.get('image_slots'),
+                'fonts': info.get('fonts', []),
+                'colors': info.get('colors', []),
+                'page_count': info.get('page_count'),
+                'width': info.get('width'),
+                'height': info.get('height'),
+                'units': info.get('units'),
+                'thumbnail_url': thumbnail_url,
+                'thumbnail_variants': thumbnail.get('variants')
+            })
+        # Les hash de fichiers disparus ne servent plus
+        live = {(e['sha256']) for e in entries}
+        self._hashes = {k: v for k, v in self._hashes.items() if v in live}
+        return entries
+
+
+def _font_matches(fonts, needle):
+    needle = needle.lower()
+    for font in fonts:
+        if isinstance(font, dict):
+            names = (font.get('name', ''), font.get('family', ''))
+        else:
+            names = (str(font),)
+        if any(needle in n.lower() for n in names):
+            return True
+    return False
+
+
+def filter_templates(entries, page_count=None, image_slots=None, min_image_slots=None, font=None):
+    """Filtres du catalogue ; un template non analysé ne passe aucun filtre d'analyse."""
+    result = entries
+    if page_count is not None:
+        result = [e for e in result if e['page_count'] == page_count]
+    if image_slots is not None:
+        result = [e for e in result if e['image_slots'] == image_slots]
+    if min_image_slots is not None:
+        result = [e for e in result if (e['image_slots'] or 0) >= min_image_slots]
+    if font:
+        result = [e for e in result if _font_matches(e['fonts'], font)]
+    return result
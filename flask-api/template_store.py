@@ -0,0 +1,172 @@
+"""
+Stockage des templates InDesign adressé par contenu.
+
+- L'upload est écrit en streaming dans un fichier temporaire (sur le même
+  système de fichiers que le stockage) et haché au fil de l'eau : aucune
+  relecture ni copie supplémentaire.
+- Chaque version est rangée sous `.objects/<sha256><ext>` ; le fichier nommé
+  (`indesign_templates/<nom>`) est un lien vers la version courante, remplacé
+  atomiquement. Un nouvel upload sous le même nom n'écrase donc plus
+  l'ancienne version.
+- Un index SQLite nom -> versions permet de sauter l'écriture (et l'analyse)
+  quand les octets existent déjà. Il retient aussi l'inode et le mtime du
+  fichier nommé : son hash n'est réutilisé que si le fichier n'a pas bougé.
+"""
+import hashlib
+import os
+import sqlite3
+import tempfile
+import time
+from contextlib import contextmanager
+
+from image_cache import link_or_copy
+
+
+class HashingUpload:
+    """Fichier temporaire qui calcule SHA-256 et taille pendant l'écriture.
+
+    Sert de flux de fichier pour le parseur multipart de Werkzeug (write,
+    read, seek...). Le fichier est supprimé à la fermeture s'il n'a pas été
+    rangé dans le stockage entre-temps.
+    """
+
+    def __init__(self, tmp_dir):
+        fd, self.path = tempfile.mkstemp(dir=tmp_dir, suffix='.upload')
+        self._file = os.fdopen(fd, 'w+b')
+        self._digest = hashlib.sha256()
+        self.size = 0
+
+    def write(self, data):
+        self._digest.update(data)
+        self.size += len(data)
+        return self._file.write(data)
+
+    @property
+    def sha256(self):
+        return self._digest.hexdigest()
+
+    def close(self):
+        self._file.close()
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+
+    def __getattr__(self, name):
+        # read, readline, seek, tell, flush... délégués au fichier réel
+        return getattr(self._file, name)
+
+
+class TemplateStore:
+    """Templates par contenu + index nom -> versions."""
+
+    # Colonnes ajoutées après coup : (table, colonne, déclaration)
+    MIGRATIONS = (
+        ('template_versions', 'inode', 'INTEGER'),
+        ('template_versions', 'mtime_ns', 'INTEGER'),
+    )
+
+    def __init__(self, root):
+        self.root = root
+        self.objects_dir = os.path.join(root, '.objects')
+        self.tmp_dir = os.path.join(root, '.tmp')
+        os.makedirs(self.objects_dir, exist_ok=True)
+        os.makedirs(self.tmp_dir, exist_ok=True)
+        self.db_path = os.path.join(root, '.index.db')
+        with self._connect() as db:
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('''
+                CREATE TABLE IF NOT EXISTS template_versions (
+                    name TEXT NOT NULL,
+                    version INTEGER NOT NULL,
+                    sha256 TEXT NOT NULL,
+                    ext TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    uploaded_at REAL NOT NULL,
+                    PRIMARY KEY (name, version)
+                )
+            ''')
+            for table, column, declaration in self.MIGRATIONS:
+                if column not in {row[1] for row in db.execute(f'PRAGMA table_info({table})')}:
+                    db.execute(f'ALTER TABLE {table} ADD COLUMN {column} {declaration}')
+
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path, timeout=30)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def new_upload(self):
+        return HashingUpload(self.tmp_dir)
+
+    def object_path(self, sha256, ext):
+        return os.path.join(self.objects_dir, f'{sha256}{ext}')
+
+    def put(self, name, upload):
+        """Range un upload sous `name` (nom de fichier déjà sécurisé).
+
+        Retourne {'path', 'sha256', 'size', 'version', 'stored', 'unchanged'} :
+        `stored` est faux si les octets existaient déjà, `unchanged` vrai si
+        `name` pointait déjà sur ces octets.
+        """
+        ext = os.path.splitext(name)[1].lower()
+        sha256 = upload.sha256
+        upload.flush()
+        object_path = self.object_path(sha256, ext)
+        stored = not os.path.exists(object_path)
+        if stored:
+            os.replace(upload.path, object_path)
+
+        named_path = os.path.join(self.root, name)
+        with self._connect() as db:
+            # Verrou d'écriture immédiat : deux workers ne peuvent pas créer la même version
+            db.execute('BEGIN IMMEDIATE')
+            current = db.execute(
+                'SELECT version, sha256 FROM template_versions WHERE name = ? '
+                'ORDER BY version DESC LIMIT 1', (name,)
+            ).fetchone()
+            unchanged = bool(current and current[1] == sha256 and os.path.exists(named_path))
+            if unchanged:
+                version = current[0]
+            else:
+                version = (current[0] + 1) if current else 1
+                # Lien temporaire puis rename : le nom n'est jamais absent ni partiel
+                tmp_link = os.path.join(self.tmp_dir, f'{sha256}.{os.getpid()}{ext}')
+                link_or_copy(object_path, tmp_link)
+                os.replace(tmp_link, named_path)
+                st = os.stat(named_path)
+                db.execute(
+                    'INSERT INTO template_versions(name, version, sha256, ext, size, uploaded_at, inode, mtime_ns) '
+                    'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                    (name, version, sha256, ext, upload.size, time.time(), st.st_ino, st.st_mtime_ns)
+                )
+
+        return {
+            'path': named_path,
+            'sha256': sha256,
+            'size': upload.size,
+            'version': version,
+            'stored': stored,
+            'unchanged': unchanged
+        }
+
+    def versions(self, name):
+        with self._connect() as db:
+            rows = db.execute(
+                'SELECT version, sha256, size, uploaded_at FROM template_versions '
+                'WHERE name = ? ORDER BY version DESC', (name,)
+            ).fetchall()
+        return [{'version': v, 'sha256': s, 'size': size, 'uploaded_at': ts} for v, s, size, ts in rows]
+
+    def current(self):
+        """{nom: version courante} pour tous les templates indexés, avec l'inode
+        et le mtime du fichier nommé à son rangement."""
+        with self._connect() as db:
+            rows = db.execute(
+                'SELECT name, MAX(version), sha256, size, inode, mtime_ns FROM template_versions GROUP BY name'
+            ).fetchall()
+        return {name: {'version': v, 'sha256': s, 'size': size, 'inode': inode, 'mtime_ns': mtime_ns}
+                for name, v, s, size, inode, mtime_ns in rows}
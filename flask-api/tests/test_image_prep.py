@@ -0,0 +1,45 @@
+"""
+Plafond de sous-échantillonnage des images : la page du template analysé,
+en points, x PPI cible.
+"""
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from image_prep import ImagePreprocessor, max_edge_for_page  # noqa: E402
+from renderers import FakeRenderer  # noqa: E402
+
+
+def test_a4_page_in_points_gives_300_ppi_cap():
+    assert max_edge_for_page(595.276, 841.89, 300) == 3508
+
+
+def test_analysed_a4_template_gives_300_ppi_cap(tmp_path):
+    config_path = tmp_path / 'config.json'
+    results_path = tmp_path / 'results.json'
+    config_path.write_text(json.dumps({
+        'template_path': str(tmp_path / 'A4.indt'),
+        'output_dir': str(tmp_path),
+        'thumbnail_width': 80,
+        'thumbnail_height': 60
+    }))
+    result = FakeRenderer(1).run_script('analyze_and_thumbnail.jsx', {
+        'configPath': str(config_path),
+        'resultsPath': str(results_path)
+    }, timeout=10)
+    assert result['success']
+    template = json.loads(results_path.read_text())['template']
+
+    preprocessor = ImagePreprocessor(max_workers=0, target_ppi=300, default_max_edge=3508)
+    max_edge = preprocessor.max_edge(template['width'], template['height'], template['units'])
+    assert abs(max_edge - 3508) <= 1
+
+
+def test_page_not_in_points_falls_back_to_default():
+    preprocessor = ImagePreprocessor(max_workers=0, target_ppi=300, default_max_edge=3508)
+    # Ancienne analyse : 210 x 297 dans les unités des règles (millimètres)
+    assert preprocessor.max_edge(210, 297, None) == 3508
+    assert preprocessor.max_edge(210, 297, 'millimeters') == 3508
+    assert preprocessor.max_edge() == 3508
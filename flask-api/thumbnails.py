@@ -0,0 +1,137 @@
+"""
+Variantes des miniatures de templates et noms adressés par contenu.
+
+À la génération d'une miniature, on en dérive (Pillow) des versions `small`
+et `medium`, en JPEG et en WebP, plus une copie pleine taille. Tous ces
+fichiers sont nommés `<stem>.<hash>[.<taille>].<ext>` où `<hash>` est le
+SHA-256 (tronqué) de la miniature source : leur contenu ne change jamais,
+ils peuvent donc être servis avec `Cache-Control: immutable`.
+
+Les miniatures générées avant l'existence des variantes sont dérivées à la
+première demande. Celles dont l'extension n'est pas un format de variante
+(`.png`, `.jpeg`...) sont servies telles quelles, sans variantes.
+"""
+import os
+import re
+import shutil
+import threading
+from collections import OrderedDict
+
+from PIL import Image
+
+from image_cache import file_sha256
+
+HASH_LENGTH = 16
+
+# taille -> largeur max (None = pleine taille)
+THUMBNAIL_SIZES = {'small': 200, 'medium': 480, 'full': None}
+THUMBNAIL_FORMATS = {'jpg': ('JPEG', 'image/jpeg'), 'webp': ('WEBP', 'image/webp')}
+
+_HASHED_NAME = re.compile(
+    r'^(?P<stem>.+)\.(?P<hash>[0-9a-f]{%d})(?:\.(?P<size>small|medium))?\.(?P<ext>jpg|webp)$' % HASH_LENGTH
+)
+
+
+def variant_name(stem, digest, size='full', ext='jpg'):
+    suffix = '' if size == 'full' else f'.{size}'
+    return f'{stem}.{digest}{suffix}.{ext}'
+
+
+def parse_variant_name(filename):
+    """(stem, hash, taille, ext) pour un nom adressé par contenu, sinon None."""
+    match = _HASHED_NAME.match(filename)
+    if not match:
+        return None
+    return match.group('stem'), match.group('hash'), match.group('size') or 'full', match.group('ext')
+
+
+class ThumbnailVariants:
+    """Génère et retrouve les variantes des miniatures de `root`."""
+
+    def __init__(self, root, jpeg_quality=82, webp_quality=78, max_digests=1024):
+        self.root = root
+        self.variants_dir = os.path.join(root, 'variants')
+        os.makedirs(self.variants_dir, exist_ok=True)
+        self.jpeg_quality = jpeg_quality
+        self.webp_quality = webp_quality
+        self._lock = threading.Lock()
+        # (chemin, inode, taille, mtime) -> hash tronqué ; LRU borné, une miniature
+        # réécrite laisse derrière elle la clé de son ancienne version
+        self._digests = OrderedDict()
+        self.max_digests = max_digests
+
+    def _digest(self, path):
+        st = os.stat(path)
+        key = (path, st.st_ino, st.st_size, st.st_mtime_ns)
+        with self._lock:
+            digest = self._digests.get(key)
+            if digest is not None:
+                self._digests.move_to_end(key)
+                return digest
+        digest = file_sha256(path)[:HASH_LENGTH]
+        with self._lock:
+            self._digests[key] = digest
+            self._digests.move_to_end(key)
+            while len(self._digests) > self.max_digests:
+                self._digests.popitem(last=False)
+        return digest
+
+    def generate(self, source_path):
+        """Dérive toutes les variantes d'une miniature source.
+
+        Retourne {'hash', 'url', 'variants': {taille: {ext: url}}} ; les URLs
+        sont relatives à /api/thumbnails/.
+        """
+        digest = self._digest(source_path)
+        stem = os.path.splitext(os.path.basename(source_path))[0]
+        urls = {}
+        with Image.open(source_path) as source:
+            source = source.convert('RGB')
+            for size, max_width in THUMBNAIL_SIZES.items():
+                image = source
+                if max_width and source.width > max_width:
+                    image = source.copy()
+                    image.thumbnail((max_width, max_width * source.height // source.width), Image.LANCZOS)
+                for ext, (pil_format, _) in THUMBNAIL_FORMATS.items():
+                    name = variant_name(stem, digest, size, ext)
+                    path = os.path.join(self.variants_dir, name)
+                    if not os.path.exists(path):
+                        self._write(image, path, pil_format, copy_from=source_path if (size, ext) == ('full', 'jpg') else None)
+                    urls.setdefault(size, {})[ext] = f'/api/thumbnails/{name}'
+        return {'hash': digest, 'url': urls['full']['jpg'], 'variants': urls}
+
+    def _write(self, image, path, pil_format, copy_from=None):
+        # Écriture dans un fichier temporaire puis rename : jamais de variante partielle
+        tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        if copy_from:
+            # Copie (et non lien) : la source peut être réécrite par une nouvelle analyse
+            shutil.copyfile(copy_from, tmp_path)
+        elif pil_format == 'JPEG':
+            image.save(tmp_path, 'JPEG', quality=self.jpeg_quality, optimize=True, progressive=True)
+        else:
+            image.save(tmp_path, pil_format, quality=self.webp_quality, method=4)
+        os.replace(tmp_path, path)
+
+    def resolve(self, filename, size='full', ext=None):
+        """Fichier à servir pour /api/thumbnails/<filename>?size=&format=.
+
+        Retourne (chemin, hash, immuable) ou None. Un nom adressé par contenu
+        désigne déjà sa variante ; un nom historique est résolu via le hash
+        courant de la miniature (variantes générées au besoin), sauf s'il
+        n'est pas dans un format de variante : il est alors servi tel quel.
+        """
+        parsed = parse_variant_name(filename)
+        if parsed:
+            stem, digest, parsed_size, parsed_ext = parsed
+            path = os.path.join(self.variants_dir, filename)
+            return (path, f'{digest}-{parsed_size}-{parsed_ext}', True) if os.path.exists(path) else None
+
+        source_path = os.path.join(self.root, filename)
+        if not os.path.isfile(source_path):
+            return None
+        source_ext = os.path.splitext(filename)[1].lstrip('.').lower()
+        if source_ext not in THUMBNAIL_FORMATS or (size == 'full' and ext in (None, source_ext)):
+            return source_path, f'{self._digest(source_path)}-full-{source_ext}', False
+        info = self.generate(source_path)
+        name = variant_name(os.path.splitext(filename)[0], info['hash'], size, ext or 'jpg')
+        return os.path.join(self.variants_dir, name), f"{info['hash']}-{size}-{ext or 'jpg'}", False